@@ -0,0 +1,90 @@
+# Benchmarks for the libcappy block device inventory.
+#
+# Times parsing, indexing and incremental udev updates on lsblk JSON from large
+# storage hosts: recorded with `record` on a real machine, or generated with
+# multipath LUNs carrying LVM volumes. Results are appended as JSON lines
+# tagged with the git commit, like benchmarks.packages:
+#
+#   python -m benchmarks.blockdev record host.json
+#   python -m benchmarks.blockdev run --luns 100 1000 --fixtures host.json
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+from benchmarks.packages import git_commit
+from libcappy.blockdev import BlockInventory, lsblk
+from tests.hosts import large_host
+
+RESULTS = os.path.join(os.path.dirname(__file__), '..', '.benchmarks', 'blockdev.jsonl')
+PHASES = ['parse', 'rows', 'lookup', 'apply']
+
+
+def bench(data: dict) -> dict[str, float]:
+    timings = {}
+    start = time.perf_counter()
+    inventory = BlockInventory(data)
+    timings['parse'] = time.perf_counter() - start
+    start = time.perf_counter()
+    inventory.rows()
+    timings['rows'] = time.perf_counter() - start
+    names = list(inventory.devices)
+    start = time.perf_counter()
+    for dev in inventory:
+        inventory.get(dev.name)
+        if dev.uuid:
+            inventory.by_uuid[dev.uuid]
+        for mp in dev.mountpoints:
+            inventory.by_mountpoint[mp]
+    timings['lookup'] = time.perf_counter() - start
+    # a burst of udev remove events for a tenth of the devices; add and change events
+    # would time lsblk itself
+    start = time.perf_counter()
+    inventory.apply([('remove', n) for n in names[::10]])
+    timings['apply'] = time.perf_counter() - start
+    return {phase: round(timings[phase], 5) for phase in PHASES}
+
+
+def record(args):
+    with open(args.output, 'w') as f:
+        json.dump(lsblk(), f, indent=1)
+    print(f'Recorded the block devices of {platform.node()} to {args.output}')
+
+
+def run(args):
+    os.makedirs(os.path.dirname(args.results), exist_ok=True)
+    commit = git_commit()
+    cases = [(f'luns={n}', large_host(n)) for n in args.luns]
+    for path in args.fixtures:
+        with open(path) as f:
+            cases.append((os.path.basename(path), json.load(f)))
+    for name, data in cases:
+        for n in range(args.repeat):
+            timings = bench(data)
+            rec = {'commit': commit, 'time': time.time(), 'host': platform.node(), 'fixture': name, 'run': n, 'timings': timings}
+            print(json.dumps(rec))
+            with open(args.results, 'a') as f:
+                f.write(json.dumps(rec) + '\n')
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Benchmarks for the libcappy block device inventory')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    r = sub.add_parser('record', help="save this host's lsblk JSON as a fixture")
+    r.add_argument('output')
+    r.set_defaults(fn=record)
+    b = sub.add_parser('run', help='run the benchmarks and record the results')
+    b.add_argument('-o', '--results', default=RESULTS, help='results file (JSON lines)')
+    b.add_argument('--luns', type=int, nargs='*', default=[100, 1000])
+    b.add_argument('--fixtures', nargs='*', default=[], help='recorded lsblk JSON files')
+    b.add_argument('--repeat', type=int, default=3)
+    b.set_defaults(fn=run)
+    args = ap.parse_args(argv)
+    args.fn(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+# Benchmarks for the libcappy Copr project index.
+#
+# Builds a CoprIndex of synthetic projects and times the update and searches
+# with prefix, multi-word and misspelled queries. Results are appended as JSON
+# lines tagged with the git commit, like benchmarks.packages; a search slower
+# than the budget fails the run:
+#
+#   python -m benchmarks.coprindex run --projects 20000 100000 [--budget-ms 100]
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from benchmarks.packages import git_commit
+from libcappy.coprindex import CoprIndex
+
+RESULTS = os.path.join(os.path.dirname(__file__), '..', '.benchmarks', 'coprindex.jsonl')
+QUERIES = ['project-1999', 'owner42 proj', 'prjoect-77']
+
+
+def projects(n: int):
+    return ({'project': {'id': i, 'name': f'project-{i}', 'owner': f'owner{i % 500}', 'description': f'Packages number {i}',
+                         'instructions': ''}} for i in range(n))
+
+
+def bench(n: int, workdir: str) -> dict[str, float]:
+    timings = {}
+    with CoprIndex(os.path.join(workdir, f'copr-{n}.sqlite')) as index:
+        start = time.perf_counter()
+        index.update(projects(n))
+        timings['update'] = time.perf_counter() - start
+        for query in QUERIES:
+            start = time.perf_counter()
+            if not index.search(query):
+                raise RuntimeError(f'{query!r} found nothing')
+            timings[query] = time.perf_counter() - start
+    return {k: round(v, 5) for k, v in timings.items()}
+
+
+def run(args) -> int:
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    commit = git_commit()
+    slow = []
+    with tempfile.TemporaryDirectory(prefix='cappy-bench-') as workdir:
+        for n in args.projects:
+            timings = bench(n, workdir)
+            rec = {'commit': commit, 'time': time.time(), 'host': platform.node(), 'projects': n, 'timings': timings}
+            print(json.dumps(rec))
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(rec) + '\n')
+            slow += [f'{q!r} over {n} projects' for q in QUERIES if timings[q] * 1000 > args.budget_ms]
+    if slow:
+        print(f'Slower than {args.budget_ms}ms: {", ".join(slow)}', file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Benchmarks for the libcappy Copr project index')
+    ap.add_argument('-o', '--output', default=RESULTS, help='results file (JSON lines)')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    r = sub.add_parser('run', help='run the benchmarks and record the results')
+    r.add_argument('--projects', type=int, nargs='+', default=[20000])
+    r.add_argument('--budget-ms', type=float, default=100, help='the slowest a search may be')
+    r.set_defaults(fn=run)
+    args = ap.parse_args(argv)
+    return args.fn(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
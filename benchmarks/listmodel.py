@@ -0,0 +1,71 @@
+# Benchmarks for the libcappy list filter.
+#
+# Indexes a TableModel of synthetic locales with FilterIndex and times every
+# query typed one character at a time, the way the TUI filter runs them.
+# Results are appended as JSON lines tagged with the git commit, like
+# benchmarks.packages; a query slower than the budget fails the run:
+#
+#   python -m benchmarks.listmodel run --rows 30000 100000 [--budget-ms 100]
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+from benchmarks.packages import git_commit
+from libcappy.listmodel import FilterIndex, TableModel
+
+RESULTS = os.path.join(os.path.dirname(__file__), '..', '.benchmarks', 'listmodel.jsonl')
+QUERIES = ['l', 'lo', 'loc', 'loca', 'locale', 'locale 12', 'locale 1', 'swis', 'swiss germn', 'xx_0123']
+NAMES = ['English', 'German', 'French', 'Spanish', 'Swiss German', 'Portuguese']
+
+
+def locales(n: int) -> list[dict[str, str]]:
+    return [{'*': '', 'Locale': f'xx_{i:05d}.UTF-8', 'Name': f'{NAMES[i % len(NAMES)]} locale {i}'} for i in range(n)]
+
+
+def bench(rows: int) -> dict[str, float]:
+    model = TableModel(locales(rows))
+    start = time.perf_counter()
+    index = FilterIndex(model)
+    timings = {'index': time.perf_counter() - start}
+    for query in QUERIES:
+        start = time.perf_counter()
+        index.match(query)
+        timings[query] = time.perf_counter() - start
+    return {k: round(v, 5) for k, v in timings.items()}
+
+
+def run(args) -> int:
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    commit = git_commit()
+    slow = []
+    for rows in args.rows:
+        timings = bench(rows)
+        rec = {'commit': commit, 'time': time.time(), 'host': platform.node(), 'rows': rows, 'timings': timings}
+        print(json.dumps(rec))
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(rec) + '\n')
+        slow += [f'{q!r} over {rows} rows' for q in QUERIES if timings[q] * 1000 > args.budget_ms]
+    if slow:
+        print(f'Slower than {args.budget_ms}ms: {", ".join(slow)}', file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Benchmarks for the libcappy list filter')
+    ap.add_argument('-o', '--output', default=RESULTS, help='results file (JSON lines)')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    r = sub.add_parser('run', help='run the benchmarks and record the results')
+    r.add_argument('--rows', type=int, nargs='+', default=[30000])
+    r.add_argument('--budget-ms', type=float, default=100, help='the slowest a query may be')
+    r.set_defaults(fn=run)
+    args = ap.parse_args(argv)
+    return args.fn(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
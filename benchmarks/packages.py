@@ -0,0 +1,115 @@
+# Offline benchmarks for the libcappy package pipeline.
+#
+# Builds synthetic repos (see synthrepo.py), serves them from localhost and times
+# Packages.__init__, resolve, download and the rpm transaction into a scratch
+# installroot. Results are appended as JSON lines tagged with the git commit, so
+# runs on different commits can be compared:
+#
+#   python -m benchmarks.packages run --sizes 100 1000 5000
+#   python -m benchmarks.packages compare
+#
+# Needs rpmbuild, createrepo_c and python3-dnf; the rpm transaction needs root.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.synthrepo import PREFIX, RepoServer, build_repo
+
+RESULTS = os.path.join(os.path.dirname(__file__), '..', '.benchmarks', 'packages.jsonl')
+PHASES = ['init', 'repo load', 'depsolve', 'download', 'rpm transaction']
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def bench(size: int, workdir: str, transaction: bool) -> dict[str, float]:
+    # keep every cache of this run inside the scratch dir; read by libcappy.common at import
+    os.environ['CAPPY_CACHE_DIR'] = os.path.join(workdir, 'cache')
+    import dnf.callback
+    from libcappy import trace
+    from libcappy.packages import Packages
+
+    repo = build_repo(os.path.join(workdir, f'repo-{size}'), size)
+    shutil.rmtree(os.environ['CAPPY_CACHE_DIR'], ignore_errors=True)
+    root = tempfile.mkdtemp(prefix='installroot-', dir=workdir)
+    timings: dict[str, float] = {}
+    unsubscribe = trace.subscribe(lambda s: timings.__setitem__(s.name, timings.get(s.name, 0.0) + s.seconds))
+    try:
+        with RepoServer(repo) as server:
+            start = time.monotonic()
+            pkgs = Packages(installroot=root, opts={'releasever': '36', 'install_weak_deps': False},
+                            repos=[{'id': 'synth', 'baseurl': server.url, 'gpgcheck': False}], system_repos=False)
+            timings['init'] = time.monotonic() - start
+            assert pkgs.resolve([f'{PREFIX}-*'])
+            pkgs.download(pkgs.dnf.transaction.install_set, dnf.callback.NullDownloadProgress())
+            if transaction:
+                with trace.span('rpm transaction'):
+                    pkgs.dnf.do_transaction()
+            pkgs.metadata.close()
+    finally:
+        unsubscribe()
+        shutil.rmtree(root, ignore_errors=True)
+    return {phase: round(timings[phase], 4) for phase in PHASES if phase in timings}
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='cappy-bench-')
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    commit = git_commit()
+    for size in args.sizes:
+        for n in range(args.repeat):
+            timings = bench(size, workdir, not args.no_transaction)
+            record = {'commit': commit, 'time': time.time(), 'host': platform.node(), 'size': size, 'run': n, 'timings': timings}
+            print(json.dumps(record))
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+
+def compare(args):
+    # best-of-N per (commit, size) and phase, commits in the order they were first recorded
+    best: dict[tuple[str, int], dict[str, float]] = {}
+    with open(args.output) as f:
+        for line in f:
+            r = json.loads(line)
+            cur = best.setdefault((r['commit'], r['size']), {})
+            for phase, t in r['timings'].items():
+                cur[phase] = min(cur.get(phase, t), t)
+    commits = list(dict.fromkeys(c for c, _ in best))[-args.last:]
+    print(f'{"size":>6} {"phase":<16}' + ''.join(f'{c:>12}' for c in commits))
+    for size in sorted({s for _, s in best}):
+        for phase in PHASES:
+            cells = [best.get((c, size), {}).get(phase) for c in commits]
+            if any(v is not None for v in cells):
+                print(f'{size:>6} {phase:<16}' + ''.join(f'{v:>11.3f}s' if v is not None else f'{"-":>12}' for v in cells))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Offline benchmarks for the libcappy package pipeline')
+    ap.add_argument('-o', '--output', default=RESULTS, help='results file (JSON lines)')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    r = sub.add_parser('run', help='run the benchmarks and record the results')
+    r.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000])
+    r.add_argument('--repeat', type=int, default=3)
+    r.add_argument('--workdir', help='keep the synthetic repos here between runs')
+    r.add_argument('--no-transaction', action='store_true', help='skip the rpm transaction (does not need root)')
+    r.set_defaults(fn=run)
+    c = sub.add_parser('compare', help='compare recorded results between commits')
+    c.add_argument('--last', type=int, default=5, help='how many commits to show')
+    c.set_defaults(fn=compare)
+    args = ap.parse_args(argv)
+    args.fn(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+# Import time of the libcappy entry points.
+#
+# Imports each module in a fresh interpreter with -X importtime and records its
+# cumulative import time, and the slowest modules it pulls in, as JSON lines
+# tagged with the git commit, like benchmarks.packages. An entry point slower
+# than the budget fails the run:
+#
+#   python -m benchmarks.startup run [--budget-ms 150] [--repeat 5]
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from benchmarks.packages import git_commit
+
+RESULTS = os.path.join(os.path.dirname(__file__), '..', '.benchmarks', 'startup.jsonl')
+MODULES = ['libcappy.__main__', 'libcappy.installer']
+
+
+def import_times(module: str) -> dict[str, int]:
+    """{module: cumulative import time in us} from -X importtime."""
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True,
+                         cwd=os.path.join(os.path.dirname(__file__), '..'))
+    if out.returncode != 0:
+        raise RuntimeError(f'Importing {module} failed: {out.stderr.strip()}')
+    times = {}
+    for line in out.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line and 'self [us]' not in line:
+            _, cumulative, name = line.split('|')
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def run(args) -> int:
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    commit = git_commit()
+    slow = []
+    for module in args.modules:
+        # the fastest of a few runs, the others mostly measure the page cache
+        runs = [import_times(module) for _ in range(args.repeat)]
+        times = min(runs, key=lambda t: t[module])
+        top = sorted(((name, us) for name, us in times.items()
+                      # site and .pth imports come before the module's own
+                      if name != module and us <= times[module]), key=lambda t: -t[1])[:10]
+        rec = {'commit': commit, 'time': time.time(), 'host': platform.node(), 'module': module,
+               'import_ms': times[module] / 1000, 'slowest': dict((name, us / 1000) for name, us in top)}
+        print(json.dumps(rec))
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(rec) + '\n')
+        if module == 'libcappy.__main__' and times[module] / 1000 > args.budget_ms:
+            slow.append(f'{module} took {times[module] / 1000:.1f}ms')
+    if slow:
+        print(f'Slower than {args.budget_ms}ms: {", ".join(slow)}', file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Import time of the libcappy entry points')
+    ap.add_argument('-o', '--output', default=RESULTS, help='results file (JSON lines)')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    r = sub.add_parser('run', help='run the benchmark and record the results')
+    r.add_argument('--modules', nargs='+', default=MODULES)
+    r.add_argument('--repeat', type=int, default=5)
+    r.add_argument('--budget-ms', type=float, default=150, help='the slowest the TUI entry point may import')
+    r.set_defaults(fn=run)
+    args = ap.parse_args(argv)
+    return args.fn(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# Synthetic RPM repositories for the libcappy benchmarks.
+# Builds N empty-ish packages with a realistic dependency fan-out from a
+# single spec file, and serves the result over a local HTTP server.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import functools
+import http.server
+import os
+import random
+import subprocess
+import threading
+
+PREFIX = 'synth'
+
+
+def gen_spec(count: int, fanout: int = 4, payload: int = 4096, seed: int = 0) -> str:
+    """[summary]
+    Generates a spec file with count subpackages.
+
+    Package i requires up to 2*fanout packages picked from the ones before it, with a bias
+    towards low indices, so a few "library" packages end up with most of the reverse
+    dependencies, as in a real distribution. Every package carries payload bytes of
+    incompressible data.
+    """
+    rng = random.Random(seed)
+    lines = [
+        f'Name: {PREFIX}',
+        'Version: 1.0',
+        'Release: 1',
+        'Summary: Synthetic benchmark packages',
+        'License: MIT',
+        'BuildArch: noarch',
+        '%description',
+        'Synthetic benchmark packages.',
+    ]
+    files = []
+    for i in range(count):
+        name = f'{PREFIX}-{i:05d}'
+        lines += [f'%package -n {name}', f'Summary: Synthetic package {i}']
+        if i:
+            n = min(i, rng.randint(0, 2 * fanout))
+            deps = {int(i * rng.random() ** 2) for _ in range(n)}
+            lines += [f'Requires: {PREFIX}-{d:05d}' for d in sorted(deps)]
+        lines += [f'%description -n {name}', f'Synthetic package {i}.']
+        files += [f'%files -n {name}', f'/usr/share/{PREFIX}/{name}']
+    lines += [
+        '%prep',
+        '%build',
+        '%install',
+        f'mkdir -p %{{buildroot}}/usr/share/{PREFIX}',
+        f'for i in $(seq -f %05g 0 {count - 1}); do head -c {payload} /dev/urandom > %{{buildroot}}/usr/share/{PREFIX}/{PREFIX}-$i; done',
+    ]
+    return '\n'.join(lines + files) + '\n'
+
+
+def build_repo(path: str, count: int, fanout: int = 4, payload: int = 4096, seed: int = 0) -> str:
+    """Builds a repo of count synthetic packages under path, unless it is already there.
+
+    Returns the repo directory, to be served as the baseurl.
+    """
+    top = os.path.abspath(os.path.join(path, 'rpmbuild'))
+    repo = os.path.join(top, 'RPMS')
+    if os.path.exists(os.path.join(repo, 'repodata', 'repomd.xml')):
+        return repo
+    os.makedirs(os.path.join(top, 'SPECS'), exist_ok=True)
+    spec = os.path.join(top, 'SPECS', f'{PREFIX}.spec')
+    with open(spec, 'w') as f:
+        f.write(gen_spec(count, fanout, payload, seed))
+    subprocess.run(['rpmbuild', '-bb', '--quiet', '--define', f'_topdir {top}', '--define', '_binary_payload w1.gzdio', spec], check=True)
+    subprocess.run(['createrepo_c', '--quiet', repo], check=True)
+    return repo
+
+
+class RepoServer:
+    """Serves a directory over HTTP on localhost, standing in for a mirror."""
+
+    def __init__(self, path: str):
+        handler = functools.partial(_QuietHandler, directory=path)
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}/'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *_):
+        pass
@@ -0,0 +1,68 @@
+# Keypress-to-frame latency of the libcappy TUI list.
+#
+# Runs a ScrollList in a child process on a pseudo terminal, sends it keys and
+# times each one from the write until the terminal output settles. The bytes
+# written per key are recorded too: on a 115200 baud serial console or a BMC
+# session they are what the user actually waits for.
+#
+#   python -m benchmarks.tui run --rows 100 1000 100000 [--stream]
+#   python -m benchmarks.tui compare
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+from benchmarks.packages import git_commit
+from tests.terminal import KEYS, measure
+
+RESULTS = os.path.join(os.path.dirname(__file__), '..', '.benchmarks', 'tui.jsonl')
+
+
+def run(args):
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    commit = git_commit()
+    for rows in args.rows:
+        keys, maxrss = measure(rows, args.presses, stream=args.stream)
+        rec = {'commit': commit, 'time': time.time(), 'host': platform.node(), 'rows': rows, 'stream': args.stream,
+               'maxrss_kb': maxrss, 'keys': keys}
+        print(json.dumps(rec))
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(rec) + '\n')
+
+
+def compare(args):
+    # the latest run per (commit, rows), commits in the order they were first recorded
+    latest: dict[tuple[str, int], dict] = {}
+    with open(args.output) as f:
+        for line in f:
+            r = json.loads(line)
+            latest[(r['commit'], r['rows'])] = r['keys']
+    commits = list(dict.fromkeys(c for c, _ in latest))[-args.last:]
+    print(f'{"rows":>6} {"key":<10}' + ''.join(f'{c:>20}' for c in commits))
+    for rows in sorted({n for _, n in latest}):
+        for key in [*KEYS, 'filter']:
+            cells = [latest.get((c, rows), {}).get(key) for c in commits]
+            print(f'{rows:>6} {key:<10}' + ''.join(f'{v["latency_ms"]:>9.2f}ms {v["bytes"]:>6.0f}B ' if v else f'{"-":>20}' for v in cells))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Keypress-to-frame latency of the libcappy TUI list')
+    ap.add_argument('-o', '--output', default=RESULTS, help='results file (JSON lines)')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    r = sub.add_parser('run', help='run the benchmark and record the results')
+    r.add_argument('--rows', type=int, nargs='+', default=[100, 1000])
+    r.add_argument('--presses', type=int, default=100)
+    r.add_argument('--stream', action='store_true', help='feed the list from a generator')
+    r.set_defaults(fn=run)
+    c = sub.add_parser('compare', help='compare recorded results between commits')
+    c.add_argument('--last', type=int, default=5, help='how many commits to show')
+    c.set_defaults(fn=compare)
+    args = ap.parse_args(argv)
+    args.fn(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,28 +1,37 @@
 import argparse
 import curses
-import multiprocessing as mp
 import os
 import re
 import sys
-from typing import Any, Callable
-
-import yaml
+from typing import TYPE_CHECKING, Any, Callable
 
 from .common import DS, Q_T
-from .install import install
-from .installer import Wizard
+from .listmodel import TableModel
 from .ui import Box, Entry, Interface, ScrollList, Toggle, get_mid, new_box, popup
 
-ap = argparse.ArgumentParser()
-ap.add_argument('-c', '--chroot', type=str, help="Set custom chroot (must ends with /)", default='/mnt', dest='chroot')
-ap.add_argument('-d', '--skip-disk', action='store_true', help='Skip disk selection', dest='sd')
-ap.add_argument('-t', '--timeout', type=float, help="Set network timeout in seconds", default=10, dest='timeout')
-ap.add_argument('-w', '--skip-wizard', action='store_true', help='Skip the wizard. You need to have /tmp/cappyinstall.yml', dest='sw')
-args = ap.parse_args()
-chroot:str = args.chroot
-skipdisk = args.sd
-timeout = args.timeout
-skipwizard = args.sw
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+    from .installer import Wizard
+
+# Everything expensive (dnf, lsblk, locales, network) is imported or probed by main() or by
+# the screen that needs it, so --help and --skip-wizard do not wait for any of it.
+chroot: str
+skipdisk: bool
+timeout: float
+wizard: 'Wizard'
+locales_future: 'Future[DS]'
+keymaps_future: 'Future[DS]'
+envs_grps_future: 'Future[tuple[DS, DS]]'
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-c', '--chroot', type=str, help="Set custom chroot (must ends with /)", default='/mnt', dest='chroot')
+    ap.add_argument('-d', '--skip-disk', action='store_true', help='Skip disk selection', dest='sd')
+    ap.add_argument('-t', '--timeout', type=float, help="Set network timeout in seconds", default=10, dest='timeout')
+    ap.add_argument('-w', '--skip-wizard', action='store_true', help='Skip the wizard. You need to have /tmp/cappyinstall.yml', dest='sw')
+    return ap.parse_args(argv)
 
 
 class DummyFile(object):
@@ -30,24 +39,28 @@ class DummyFile(object):
 
 
 def th_envs_grps(q: Q_T):
+    from .installer import Wizard
     save_stdout = sys.stdout
     sys.stdout = DummyFile()
-    q.put(Wizard.fetch_envs_grps())
+    q.put(Wizard.fetch_envs_grps(fast=False))
     sys.stdout = save_stdout
 
 
-q: Q_T = mp.Queue()
-p = mp.Process(target=th_envs_grps, args=(q, ))
-
-
-wizard = Wizard()
-
-locales = [v.split('|') for v in wizard.locales().splitlines()]
-locales = [{'*': '', "Locale": code, "Name": name} for code, name in locales]
-keymaps = wizard.keymaps()
+def load_envs_grps() -> tuple[DS, DS]:
+    if (found := wizard.comps_envs_grps()) is not None:
+        return found
+    # no comps data to stream, have dnf load all the metadata in a child process
+    import multiprocessing as mp
+    q: Q_T = mp.Queue()
+    p = mp.Process(target=th_envs_grps, args=(q, ))
+    p.start()
+    try:
+        return q.get()
+    finally:
+        p.join()
 
 
-def gen_scrollList_hdl(ds: DS, retName: str, multisel: bool = False):
+def gen_scrollList_hdl(ds: DS | TableModel, retName: str, multisel: bool = False):
     def getFn(): return ds
 
     def keyhdl(k: str, sel: int):
@@ -69,14 +82,12 @@ def gen_scrollList_hdl(ds: DS, retName: str, multisel: bool = False):
     return getFn, keyhdl, parse
 
 
-lsblk = wizard.strip_lsblk(wizard.tidy_lsblk(wizard.lsblk())[1])
-def get_lsblk(): return lsblk
-
-
-def scrollList_hdl(ui: Interface, dsFn: Callable[[], DS], keyFn: Callable[[str, int], None], parseFn: Callable[[], str | list[str]], msg: str, req: bool = True):
+def scrollList_hdl(ui: Interface, dsFn: Callable[[], DS | TableModel], keyFn: Callable[[str, int], None], parseFn: Callable[[], str | list[str]], msg: str, req: bool = True):
     y, x = ui.w.getmaxyx()
-    cw, table = ScrollList.build_table(dsFn())
-    _y, _x = min(len(table.splitlines())+3, y-3), min(cw+4, x)
+    model = TableModel.of(dsFn())
+    # a streamed list is sized by its first screenful
+    model.load(y)
+    _y, _x = min(len(model)+4, y-3), min(model.width+2, x)
     box = Box(ui, _y, _x, 3, max((x-_x)//2-1, 0))
     listhdl = ScrollList(box)
     ui.draw(msg)
@@ -166,7 +177,36 @@ def add_user(ui: Interface) -> tuple[str, str]:
         return usernameEn.t, passwordEn.t
 
 
+def copr_hdl(ui: Interface) -> list[str]:
+    # pick Copr projects from the local index, built with `python -m libcappy.cli copr index`
+    from .coprindex import CoprIndex
+    with CoprIndex() as index:
+        if not len(index):
+            return []
+        picked: list[str] = []
+        while True:
+            ui.draw("Add Copr repositories", "Type a search and press ENTER, or * to browse them all. Leave it empty to continue.\n" + '\n'.join(picked))
+            box = new_box(ui, 3, 50)
+            box.write()
+            en = box.add_entry(48)
+            en.show(1, 1)
+            en.activate()
+            if not en.t:
+                return picked
+            ds: DS | TableModel
+            if en.t == '*':
+                # the whole index is too long to load up front, it is streamed in as the list scrolls
+                ds = TableModel(wizard.list_coprs(index))
+            elif not (ds := wizard.search_coprs(index, en.t)):
+                popup(ui, f'No Copr projects match {en.t!r}.')
+                continue
+            picked += [p for p in scrollList_hdl(ui, *gen_scrollList_hdl(ds, 'PROJECT', True), 'Select Copr projects\npress SPACE to select, and press ENTER to continue. (You may select multiple ones.)', False) if p not in picked]
+
+
 def lsblk_hdl(ui: Interface) -> list[dict[str, str]]:
+    lsblk = wizard.strip_lsblk(wizard.lsblk())
+    def get_lsblk(): return lsblk
+
     def lsblk_keyhdl(k: str, sel: int):
         if k == ' ':
             global curEn
@@ -214,11 +254,11 @@ def lsblk_hdl(ui: Interface) -> list[dict[str, str]]:
                 lsblk[sel]['OPTIONS'] = optionEn.t
                 lsblk[sel]['FSCK'] = '*' if fsckCh.state else ''
                 lsblk[sel]['DUMP'] = '*' if dumpCh.state else ''
-                return
+                return 'redraw'
 
     y, x = ui.w.getmaxyx()
-    cw, table = ScrollList.build_table(get_lsblk())
-    _y, _x = min(len(table.splitlines())+3, y-7), min(cw+4, x)
+    model = TableModel(get_lsblk())
+    _y, _x = min(len(model)+4, y-7), min(model.width+2, x)
     box = Box(ui, _y, _x, 7, max((x-_x)//2-1, 0))
     listhdl = ScrollList(box)
     ui.draw("Set mountpoints", f"Press SPACE to set mountpoint and options.\nPress ENTER when you're done.\n(it starts with {chroot})")
@@ -234,7 +274,7 @@ def lsblk_hdl(ui: Interface) -> list[dict[str, str]]:
     return ds
 
 
-def main(window: 'curses._CursesWindow'):
+def wizard_main(window: 'curses._CursesWindow'):
     ui = Interface(window)
 
     ui.draw("Welcome to Ultramarine Installer!", "This TUI wizard will guide you through the installation.")
@@ -242,19 +282,24 @@ def main(window: 'curses._CursesWindow'):
 
     selstr = 'Select your {}\npress SPACE to select, and press ENTER to continue.'
 
-    locale = scrollList_hdl(ui, *gen_scrollList_hdl(locales, 'Locale'), selstr.format('locale'))
-    keymap = scrollList_hdl(ui, *gen_scrollList_hdl(keymaps, 'Keymap'), selstr.format('keymap'))
+    if not locales_future.done():
+        ui.draw("Loading locales and keymaps...")
+    locale = scrollList_hdl(ui, *gen_scrollList_hdl(locales_future.result(), 'Locale'), selstr.format('locale'))
+    keymap = scrollList_hdl(ui, *gen_scrollList_hdl(keymaps_future.result(), 'Keymap'), selstr.format('keymap'))
     wizard.nmtui(ui, timeout)
     hostname = hostnamehdl(ui)
     username, password = add_user(ui)
     disks = [] if skipdisk else lsblk_hdl(ui)
-    ui.draw("Waiting for dnf to finish...", "This will take a while!")
-    envirns, agroups = q.get()
+    if not envs_grps_future.done():
+        ui.draw("Waiting for dnf to finish...", "This will take a while!")
+    envirns, agroups = envs_grps_future.result()
     envirn: list[str] = ["@"+scrollList_hdl(ui, *gen_scrollList_hdl(envirns, 'ID'), selstr.format('environment'))]
     groups = ["@"+s for s in scrollList_hdl(ui, *gen_scrollList_hdl(agroups, 'ID', True), selstr.format('groups')+' (You may select multiple ones.)', False)]
     bootloader = scrollList_hdl(ui, *gen_scrollList_hdl([{'*': '', 'NAME': 'grub'}, {'*': '', 'NAME': 'systemd-boot'}], 'NAME'), selstr.format('bootloader'))
+    coprs = copr_hdl(ui)
 
 
+    import yaml
     ui.draw("You will see your Cappy configuration file", "If you want to edit anything, just edit it.\nWhen you finish reviewing the file, press CTRL+X, Y, then ENTER to save the file.")
     ifgrub = ['grub2-efi-x64', 'shim', 'grub2-tools-efi', 'grub2-pc'] if bootloader == 'grub' else []
     password = password.replace('"', '\\"').replace('$', '\\$')  # just in case they try to inject
@@ -273,6 +318,7 @@ def main(window: 'curses._CursesWindow'):
                 f'useradd {username} -p $(mkpasswd "{password}") -m',
                 f"usermod -aG wheel {username}"  # sudoers
             ],
+            "copr": coprs,
             "bootloader": bootloader,
             "locale": locale,
             "keymap": keymap,
@@ -282,25 +328,42 @@ def main(window: 'curses._CursesWindow'):
     ui.wait()
 
 
-res = 'y'
-if not skipwizard:
-    p.start()
-    print("This program requires a terminal with size >= x=84, y=10")
-    size = os.get_terminal_size()
-    print(f"The current size is: x={size.columns}, y={size.lines}")
-    print("Press Ctrl+C to stop and try again.")
-    print("Press F11 to open in fullscreen.")
-    print("You might also need to press and hold Fn alongside.")
-    try:
-        input("Press ENTER to get to the next screen.")
-    except KeyboardInterrupt:
-        exit()
-    main(curses.initscr())  #? curses.wrap() will handle some error, which we don't like
-    curses.endwin()
-    os.system('nano /tmp/cappyinstall.yml')  # subprocess will run it in the bg unfortunately
-    res = input("You've reached the end of the wizard. Ready to install? [y/N] ")
-    p.join()
-if res and res in 'Yy':
-    print("!! THIS WILL ERASE YOUR DATA IF NOT CONFIGURED PROPERLY !!")
-    if input("Still continue? [yes] ") == 'yes':
-        install()
+def main(argv: list[str] | None = None):
+    global chroot, skipdisk, timeout, wizard, locales_future, keymaps_future, envs_grps_future
+    args = parse_args(argv)
+    chroot, skipdisk, timeout = args.chroot, args.sd, args.timeout
+    res = 'y'
+    if not args.sw:
+        from concurrent.futures import ThreadPoolExecutor
+
+        from .installer import Wizard
+        wizard = Wizard()
+        # loaded in the background while the first screens are up
+        loader = ThreadPoolExecutor(3, thread_name_prefix='cappy-wizard')
+        locales_future = loader.submit(wizard.locales)
+        keymaps_future = loader.submit(wizard.keymaps)
+        envs_grps_future = loader.submit(load_envs_grps)
+        print("This program requires a terminal with size >= x=84, y=10")
+        size = os.get_terminal_size()
+        print(f"The current size is: x={size.columns}, y={size.lines}")
+        print("Press Ctrl+C to stop and try again.")
+        print("Press F11 to open in fullscreen.")
+        print("You might also need to press and hold Fn alongside.")
+        try:
+            input("Press ENTER to get to the next screen.")
+        except KeyboardInterrupt:
+            exit()
+        wizard_main(curses.initscr())  #? curses.wrap() will handle some error, which we don't like
+        curses.endwin()
+        os.system('nano /tmp/cappyinstall.yml')  # subprocess will run it in the bg unfortunately
+        res = input("You've reached the end of the wizard. Ready to install? [y/N] ")
+        loader.shutdown(wait=False)
+    if res and res in 'Yy':
+        print("!! THIS WILL ERASE YOUR DATA IF NOT CONFIGURED PROPERLY !!")
+        if input("Still continue? [yes] ") == 'yes':
+            from .install import install
+            install()
+
+
+if __name__ == '__main__':
+    main()
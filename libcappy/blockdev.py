@@ -0,0 +1,263 @@
+# LibCappy block device inventory.
+# One structured lsblk call turned into typed records, indexed by name, UUID
+# and mountpoint, and kept up to date from udev events.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import json
+import logging
+import os
+import subprocess
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+LSBLK_COLUMNS = ['NAME', 'KNAME', 'PATH', 'PKNAME', 'TYPE', 'SIZE', 'FSTYPE', 'FSVER', 'LABEL', 'UUID',
+                 'PARTUUID', 'FSAVAIL', 'FSUSE%', 'MOUNTPOINTS', 'RM', 'RO', 'MODEL']
+
+
+def human_size(size: int | None) -> str:
+    """Formats a byte count the way lsblk does without --bytes, e.g. 931.5G."""
+    if size is None:
+        return ''
+    value = float(size)
+    for unit in 'BKMGTPE':
+        if value < 1024 or unit == 'E':
+            break
+        value /= 1024
+    if unit == 'B':
+        return f'{size}B'
+    return f'{value:.1f}'.removesuffix('.0') + unit
+
+
+@dataclass
+class BlockDevice:
+    name: str
+    kname: str
+    path: str
+    type: str
+    size: int
+    fstype: str | None = None
+    fsver: str | None = None
+    label: str | None = None
+    uuid: str | None = None
+    partuuid: str | None = None
+    fsavail: int | None = None
+    fsuse: str | None = None
+    mountpoints: list[str] = field(default_factory=list)
+    removable: bool = False
+    readonly: bool = False
+    model: str | None = None
+    pkname: str | None = None
+    # multipath members and LVM PVs give a device several parents
+    parents: list[str] = field(default_factory=list)
+    children: list[str] = field(default_factory=list)
+
+    @classmethod
+    def from_lsblk(cls, d: dict[str, Any]) -> 'BlockDevice':
+        return cls(
+            name=d['name'],
+            kname=d.get('kname') or d['name'],
+            path=d.get('path') or f"/dev/{d['name']}",
+            type=d.get('type') or '',
+            size=int(d.get('size') or 0),
+            fstype=d.get('fstype'),
+            fsver=d.get('fsver'),
+            label=d.get('label'),
+            uuid=d.get('uuid'),
+            partuuid=d.get('partuuid'),
+            fsavail=int(d['fsavail']) if d.get('fsavail') is not None else None,
+            fsuse=d.get('fsuse%'),
+            mountpoints=[mp for mp in d.get('mountpoints') or [d.get('mountpoint')] if mp],
+            removable=bool(d.get('rm')),
+            readonly=bool(d.get('ro')),
+            model=d.get('model'),
+            pkname=d.get('pkname'),
+        )
+
+    def rows(self) -> list[dict[str, str]]:
+        """The device as Wizard table rows: one per mountpoint, like `lsblk -l` prints them."""
+        row = {
+            'NAME': self.name,
+            'TYPE': self.type,
+            'FSTYPE': self.fstype or '',
+            'FSVER': self.fsver or '',
+            'LABEL': self.label or '',
+            'SIZE': human_size(self.size),
+            'UUID': self.uuid or '',
+            'FSAVAIL': human_size(self.fsavail),
+            'FSUSE%': self.fsuse or '',
+        }
+        return [dict(row, MOUNTPOINTS=mp) for mp in self.mountpoints or ['']]
+
+
+def parse_lsblk(data: dict[str, Any]) -> dict[str, BlockDevice]:
+    """Flattens the device tree of `lsblk --json --bytes` into records by name.
+
+    Devices with several parents appear once under each of them in the tree; they are merged
+    into one record that lists every parent.
+    """
+    devices: dict[str, BlockDevice] = {}
+    stack: list[tuple[dict[str, Any], str | None]] = [(d, None) for d in reversed(data.get('blockdevices', []))]
+    while stack:
+        d, parent = stack.pop()
+        dev = devices.get(d['name'])
+        if dev is None:
+            dev = devices[d['name']] = BlockDevice.from_lsblk(d)
+        if parent and parent not in dev.parents:
+            dev.parents.append(parent)
+            devices[parent].children.append(dev.name)
+        stack.extend((c, dev.name) for c in reversed(d.get('children', [])))
+    return devices
+
+
+def lsblk(*devices: str) -> dict[str, Any]:
+    """Runs lsblk once for devices (all of them if none are given) and returns its JSON."""
+    out = subprocess.run(['lsblk', '--json', '--bytes', '--output', ','.join(LSBLK_COLUMNS), *devices],
+                         capture_output=True, text=True)
+    if out.returncode not in (0, 32) and not out.stdout:
+        # 32: none of the devices were found, e.g. they were removed before we got to them
+        raise OSError(f'lsblk failed: {out.stderr.strip()}')
+    return json.loads(out.stdout or '{}')
+
+
+class BlockInventory:
+    """[summary]
+    The block devices of the host, indexed by name, UUID and mountpoint.
+
+    refresh() reads every device with a single lsblk call. apply() updates only the devices
+    named in udev events, so a long running wizard can follow hotplugs without rescanning.
+
+    Arguments:
+    data: dict, lsblk JSON to build the inventory from instead of running lsblk
+    """
+
+    def __init__(self, data: dict[str, Any] | None = None):
+        self.devices: dict[str, BlockDevice] = {}
+        self.by_uuid: dict[str, BlockDevice] = {}
+        self.by_mountpoint: dict[str, BlockDevice] = {}
+        if data is not None:
+            self._load(parse_lsblk(data))
+        else:
+            self.refresh()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self) -> Iterator[BlockDevice]:
+        return iter(self.devices.values())
+
+    def __getitem__(self, name: str) -> BlockDevice:
+        return self.devices[name.removeprefix('/dev/')]
+
+    def get(self, name: str) -> BlockDevice | None:
+        return self.devices.get(name.removeprefix('/dev/'))
+
+    def _index(self, dev: BlockDevice):
+        if dev.uuid:
+            self.by_uuid[dev.uuid] = dev
+        for mp in dev.mountpoints:
+            self.by_mountpoint[mp] = dev
+
+    def _unindex(self, dev: BlockDevice):
+        if dev.uuid and self.by_uuid.get(dev.uuid) is dev:
+            del self.by_uuid[dev.uuid]
+        for mp in dev.mountpoints:
+            if self.by_mountpoint.get(mp) is dev:
+                del self.by_mountpoint[mp]
+
+    def _load(self, devices: dict[str, BlockDevice]):
+        for dev in devices.values():
+            old = self.devices.get(dev.name)
+            if old:
+                self._unindex(old)
+                # parents outside of the refreshed subtree still hold on to the device
+                dev.parents += [p for p in old.parents if p not in dev.parents and p not in devices]
+            self.devices[dev.name] = dev
+            self._index(dev)
+            # a device read on its own, e.g. a new partition, only knows its parent by name
+            if dev.pkname and not dev.parents and (parent := self.devices.get(dev.pkname)):
+                dev.parents.append(parent.name)
+                if dev.name not in parent.children:
+                    parent.children.append(dev.name)
+
+    def _remove(self, name: str):
+        dev = self.devices.pop(name, None)
+        if dev is None:
+            return
+        self._unindex(dev)
+        for parent in dev.parents:
+            if p := self.devices.get(parent):
+                p.children = [c for c in p.children if c != name]
+        for child in dev.children:
+            if c := self.devices.get(child):
+                c.parents = [p for p in c.parents if p != name]
+                if not c.parents:
+                    self._remove(child)
+
+    def refresh(self, names: Iterable[str] | None = None):
+        """Reads devices again: all of them, or only names and the devices stacked on them."""
+        if names is None:
+            self.devices.clear()
+            self.by_uuid.clear()
+            self.by_mountpoint.clear()
+            self._load(parse_lsblk(lsblk()))
+            return
+        names = [n.removeprefix('/dev/') for n in names]
+        if not names:
+            return
+        found = parse_lsblk(lsblk(*(f'/dev/{n}' for n in names)))
+        for name in names:
+            if name not in found:
+                self._remove(name)
+        # the subtrees may have lost children since the last read
+        for name in found:
+            if old := self.devices.get(name):
+                for child in old.children:
+                    if child not in found and (c := self.devices.get(child)):
+                        c.parents = [p for p in c.parents if p != name]
+                        if not c.parents:
+                            self._remove(child)
+        self._load(found)
+
+    def apply(self, events: Iterable[tuple[str, str]]):
+        """Applies udev (action, device name) events, re-reading only the devices they name."""
+        changed: list[str] = []
+        for action, name in events:
+            if action == 'remove':
+                self._remove(name)
+                changed = [n for n in changed if n != name]
+            elif name not in changed:
+                changed.append(name)
+        self.refresh(changed)
+
+    def rows(self) -> list[dict[str, str]]:
+        """Every device as Wizard table rows."""
+        return [row for dev in self.devices.values() for row in dev.rows()]
+
+
+def udev_events() -> Iterator[tuple[str, str]]:
+    """Yields (action, device name) for block device uevents as they happen.
+
+    Uses pyudev if it is installed, and `udevadm monitor` otherwise.
+    """
+    try:
+        import pyudev
+    except ImportError:
+        pyudev = None
+    if pyudev:
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by('block')
+        for device in iter(monitor.poll, None):
+            yield device.action, device.sys_name
+        return
+    proc = subprocess.Popen(['udevadm', 'monitor', '--udev', '--subsystem-match=block'],
+                            stdout=subprocess.PIPE, text=True)
+    try:
+        for line in proc.stdout:
+            # UDEV  [1234.567890] change   /devices/.../block/sda/sda1 (block)
+            parts = line.split()
+            if len(parts) >= 4 and parts[0] == 'UDEV':
+                yield parts[2], os.path.basename(parts[3])
+    finally:
+        proc.terminate()
@@ -0,0 +1,133 @@
+# LibCappy host-level package cache.
+# RPMs are stored once by checksum and placed into any number of installroots.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import fcntl
+import logging
+import os
+import re
+import shutil
+from dataclasses import dataclass
+
+from .common import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+# ioctl number of FICLONE, from linux/fs.h
+FICLONE = 0x40049409
+
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(size: str | int) -> int:
+    """Parses a byte count such as 4096, '512M' or '20G'."""
+    if isinstance(size, int):
+        return size
+    m = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', size.upper())
+    if not m:
+        raise ValueError(f'Invalid size: {size!r}')
+    return int(float(m[1]) * SIZE_UNITS[m[2]])
+
+
+def place(src: str, dst: str):
+    """Puts a copy of src at dst as cheaply as the filesystems allow: hardlink, then reflink, then a plain copy."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return
+        except OSError:
+            shutil.copyfileobj(s, d, 1 << 20)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    hit_bytes: int = 0
+    stored_bytes: int = 0
+    evicted: int = 0
+
+    def __str__(self):
+        return (f'{self.hits} hits ({self.hit_bytes / (1 << 20):.1f} MiB), {self.misses} misses, '
+                f'{self.stored_bytes / (1 << 20):.1f} MiB stored, {self.evicted} evicted')
+
+
+class PackageCache:
+    """[summary]
+    A content-addressed RPM store that any number of installroots can share.
+
+    Objects live at <path>/objects/<algo>/<xx>/<digest>.rpm. An object's mtime is
+    bumped on every hit, so eviction can drop the least recently used ones first.
+
+    Arguments:
+    path: string, the cache directory (default: CACHE_DIR)
+    budget: int or string such as '20G', the size cap for stored RPMs. None means unlimited
+    """
+
+    def __init__(self, path: str = CACHE_DIR, budget: str | int | None = None):
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        # repo metadata lives next to the objects, see libcappy.metadata
+        self.metadata_dir = os.path.join(path, 'dnf')
+        self.budget = parse_size(budget) if budget is not None else None
+        self.stats = CacheStats()
+        os.makedirs(self.objects, exist_ok=True)
+
+    def object_path(self, checksum: str) -> str:
+        """checksum is '<algo>:<hexdigest>', as in repo metadata."""
+        algo, digest = checksum.split(':', 1)
+        return os.path.join(self.objects, algo, digest[:2], digest + '.rpm')
+
+    def fetch(self, checksum: str, dest: str) -> bool:
+        """Places the object for checksum at dest. Returns False on a miss."""
+        obj = self.object_path(checksum)
+        try:
+            os.utime(obj)
+        except FileNotFoundError:
+            self.stats.misses += 1
+            return False
+        place(obj, dest)
+        self.stats.hits += 1
+        self.stats.hit_bytes += os.path.getsize(obj)
+        return True
+
+    def store(self, checksum: str, src: str):
+        """Adds a verified file to the cache."""
+        obj = self.object_path(checksum)
+        if os.path.exists(obj):
+            os.utime(obj)
+            return
+        # place under a temporary name first so other installroots never see half a file
+        tmp = f'{obj}.{os.getpid()}.tmp'
+        place(src, tmp)
+        os.replace(tmp, obj)
+        self.stats.stored_bytes += os.path.getsize(obj)
+
+    def evict(self):
+        """Drops least recently used objects until the cache fits its budget."""
+        if self.budget is None:
+            return
+        entries: list[tuple[float, int, str]] = []
+        total = 0
+        for root, _, files in os.walk(self.objects):
+            for file in files:
+                path = os.path.join(root, file)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.budget:
+                break
+            os.remove(path)
+            total -= size
+            self.stats.evicted += 1
+        logger.debug(f'Package cache is {total} bytes after eviction')
@@ -20,6 +20,7 @@ def install(
 ):
     """Install a package"""
     pkg = packages.Packages()
+    print(f'Loaded repositories in {pkg.load_info}')
     print(f'Installing {package}')
     #pkg.install([package])
     pkg.update()
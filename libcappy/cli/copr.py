@@ -0,0 +1,35 @@
+import typer
+import time
+from libcappy.coprindex import CoprIndex
+from libcappy.repository import COPR_URL
+app = typer.Typer()
+
+@app.command()
+def index(
+    copr_url: str = typer.Option(COPR_URL, help='Copr API URL'),
+    search: str = typer.Option(None, help='Only index projects matching this Copr search query'),
+):
+    """
+    Builds or refreshes the local Copr search index.
+    """
+    with CoprIndex() as idx:
+        stats = idx.sync(copr_url, search=search)
+        typer.echo(f'{stats}, {len(idx)} projects indexed')
+
+@app.command()
+def search(
+    query: str = typer.Argument(..., help='Words to search for, prefixes match'),
+    limit: int = typer.Option(20, '--limit', '-n', help='Maximum number of results'),
+):
+    """
+    Searches the local Copr index.
+    """
+    with CoprIndex() as idx:
+        if not len(idx):
+            typer.echo('The Copr index is empty, run `copr index` first.', err=True)
+            raise typer.Exit(1)
+        start = time.monotonic()
+        results = idx.search(query, limit)
+        for r in results:
+            typer.echo(f"{r['full_name']:<40} {r['description'].splitlines()[0] if r['description'] else ''}")
+        typer.echo(f'{len(results)} results in {(time.monotonic() - start) * 1000:.1f}ms', err=True)
@@ -6,3 +6,7 @@ DS: TypeAlias = list[dict[str, str]]
 Q_T: TypeAlias = "Queue[tuple[DS, DS]]"
 
 os.environ.setdefault("ESCDELAY", "10")
+
+# host-level cache shared by every installroot
+CACHE_DIR = os.environ.get("CAPPY_CACHE_DIR", "/var/cache/cappy")
+METADATA_DIR = os.path.join(CACHE_DIR, "dnf")
@@ -0,0 +1,214 @@
+# LibCappy comps reader.
+# Lists comps environments and groups by streaming the groupfile out of
+# repodata, without building a dnf.Base or loading any package metadata.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import bz2
+import glob
+import gzip
+import logging
+import lzma
+import os
+import platform
+import subprocess
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+from typing import IO, Iterator
+from urllib.parse import urljoin
+from urllib.request import urlopen
+
+from .common import METADATA_DIR
+
+logger = logging.getLogger(__name__)
+
+# where dnf and libcappy.metadata leave downloaded repodata
+CACHE_DIRS = [METADATA_DIR, '/var/cache/dnf', '/var/cache/libdnf5']
+REPO_DIRS = ['/etc/yum.repos.d']
+# the groupfile compressions open_stream() can decode
+GROUPFILE_SUFFIXES = ('.xml', '.gz', '.xz', '.bz2', '.zst')
+
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+REPO_NS = '{http://linux.duke.edu/metadata/repo}'
+METALINK_NS = '{http://www.metalinker.org/}'
+
+Records = tuple[list[dict[str, str]], list[dict[str, str]]]
+
+
+def _languages() -> list[str]:
+    # de_DE.UTF-8 -> ['de_DE', 'de'], the order ui_name picks translations in
+    lang = os.environ.get('LC_ALL') or os.environ.get('LC_MESSAGES') or os.environ.get('LANG') or ''
+    lang = lang.split('.')[0].split('@')[0]
+    if not lang or lang in ('C', 'POSIX'):
+        return []
+    return [lang, lang.split('_')[0]] if '_' in lang else [lang]
+
+
+@contextmanager
+def open_stream(fileobj: IO[bytes], name: str) -> Iterator[IO[bytes]]:
+    """Decompresses fileobj on the fly, going by the compression suffix of name."""
+    if name.endswith('.gz'):
+        yield gzip.GzipFile(fileobj=fileobj)
+    elif name.endswith('.xz'):
+        yield lzma.LZMAFile(fileobj)
+    elif name.endswith('.bz2'):
+        yield bz2.BZ2File(fileobj)
+    elif name.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            zstandard = None
+        if zstandard:
+            yield zstandard.ZstdDecompressor().stream_reader(fileobj)
+            return
+        proc = subprocess.Popen(['zstd', '-dc'], stdin=fileobj, stdout=subprocess.PIPE)
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            proc.wait()
+    else:
+        yield fileobj
+
+
+def parse(stream: IO[bytes], languages: list[str] | None = None) -> Records:
+    """Streams a comps groupfile and returns its environments and groups.
+
+    Records are {'id', 'name', 'description'} dicts like libcappy.metadata.Metadata.comps()
+    returns, sorted by display_order and name. Names and descriptions are translated to the
+    first of languages the groupfile has, as dnf's ui_name does.
+    """
+    languages = _languages() if languages is None else languages
+    envs: list[tuple[int, dict[str, str]]] = []
+    groups: list[tuple[int, dict[str, str]]] = []
+    # (value, rank) of the best translation seen so far, lower ranks are better
+    fields: dict[str, tuple[str, int]] = {}
+    order = 1024
+    depth = 0
+    for event, elem in ET.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        tag = elem.tag
+        if depth == 2 and tag in ('id', 'name', 'description'):
+            lang = elem.get(XML_LANG)
+            if lang is None:
+                rank = len(languages)
+            elif lang in languages:
+                rank = languages.index(lang)
+            else:
+                rank = None
+            if rank is not None and (tag not in fields or rank < fields[tag][1]):
+                fields[tag] = ((elem.text or '').strip(), rank)
+        elif depth == 2 and tag == 'display_order' and elem.text:
+            order = int(elem.text)
+        elif depth == 1:
+            if tag in ('group', 'environment'):
+                record = {k: fields.get(k, ('', 0))[0] for k in ('id', 'name', 'description')}
+                (groups if tag == 'group' else envs).append((order, record))
+            # categories and langpacks are skipped, and nothing below them is needed again
+            fields = {}
+            order = 1024
+            elem.clear()
+    return ([r for _, r in sorted(envs, key=lambda e: (e[0], e[1]['name']))],
+            [r for _, r in sorted(groups, key=lambda g: (g[0], g[1]['name']))])
+
+
+def merge(parts: list[Records]) -> Records:
+    """Merges the records of several repos. The first repo to define an id wins."""
+    merged: list[dict[str, dict[str, str]]] = [{}, {}]
+    for part in parts:
+        for kind, records in zip(merged, part):
+            for r in records:
+                kind.setdefault(r['id'], r)
+    return list(merged[0].values()), list(merged[1].values())
+
+
+def cached_groupfiles(dirs: list[str] | None = None) -> list[str]:
+    """The newest comps groupfile of every repo found in the repodata caches."""
+    newest: dict[str, str] = {}
+    for top in CACHE_DIRS if dirs is None else dirs:
+        for path in glob.glob(os.path.join(top, '*', 'repodata', '*comps*.xml*')):
+            # open_stream() can not decode zchunk, the repo has a plain compressed copy too
+            if not path.endswith(GROUPFILE_SUFFIXES):
+                continue
+            repo = os.path.basename(os.path.dirname(os.path.dirname(path)))
+            # repo dirs are <repoid>-<hash of the repo config>
+            repoid = repo.rsplit('-', 1)[0]
+            if repoid not in newest or os.path.getmtime(path) > os.path.getmtime(newest[repoid]):
+                newest[repoid] = path
+    return [newest[r] for r in sorted(newest)]
+
+
+def _repomd_urls(repo: dict, timeout: float) -> list[str]:
+    if repo.get('baseurl'):
+        return [urljoin(url.rstrip('/') + '/', 'repodata/repomd.xml') for url in repo['baseurl']]
+    if repo.get('metalink'):
+        with urlopen(repo['metalink'], timeout=timeout) as f:
+            tree = ET.parse(f)
+        urls = [u for u in tree.iter(f'{METALINK_NS}url') if (u.text or '').startswith(('https://', 'http://'))]
+        return [u.text for u in sorted(urls, key=lambda u: -int(u.get('preference', 0)))][:3]
+    return []
+
+
+def download_groupfile(repo: dict, timeout: float = 10) -> Records | None:
+    """Fetches and streams the groupfile of a repo, given as libcappy.repository.parse_repo_file() options."""
+    try:
+        repomd_urls = _repomd_urls(repo, timeout)
+    except (OSError, ET.ParseError) as e:
+        logger.debug(f"Could not fetch the metalink of {repo.get('id')}: {e}")
+        return None
+    for repomd_url in repomd_urls:
+        try:
+            with urlopen(repomd_url, timeout=timeout) as f:
+                repomd = ET.parse(f)
+            hrefs = {d.get('type'): d.find(f'{REPO_NS}location').get('href') for d in repomd.iter(f'{REPO_NS}data')}
+            # zchunk needs libzck, every repo with group_zck also has a plain compressed copy
+            href = next((hrefs[t] for t in ('group_gz', 'group_xz', 'group') if t in hrefs), None)
+            if href is None:
+                return None
+            # repomd.xml sits in repodata/, hrefs are relative to the repo root
+            url = urljoin(repomd_url, '../' + href)
+            with urlopen(url, timeout=timeout) as f, open_stream(f, href) as stream:
+                return parse(stream)
+        except (OSError, ET.ParseError) as e:
+            logger.debug(f'Could not fetch comps from {repomd_url}: {e}')
+    return None
+
+
+def system_repos(dirs: list[str] | None = None) -> list[dict]:
+    """The enabled repos configured on the host, with $releasever and $basearch filled in."""
+    from .repository import parse_repo_file
+    subs = {
+        'releasever': platform.freedesktop_os_release().get('VERSION_ID', 'rawhide'),
+        'basearch': platform.machine(),
+        'arch': platform.machine(),
+    }
+    repos = []
+    for top in REPO_DIRS if dirs is None else dirs:
+        for path in sorted(glob.glob(os.path.join(top, '*.repo'))):
+            with open(path) as f:
+                repos += [r for r in parse_repo_file(f.read(), subs) if r.get('enabled', True)]
+    return repos
+
+
+def load(cache_dirs: list[str] | None = None, download: bool = True, timeout: float = 10) -> Records | None:
+    """Comps environments and groups from cached repodata, or else from the host's repos.
+
+    Returns None if neither has any comps data, so the caller can fall back to a full dnf load.
+    """
+    parts = []
+    for path in cached_groupfiles(cache_dirs):
+        try:
+            with open(path, 'rb') as f, open_stream(f, path) as stream:
+                parts.append(parse(stream))
+        except (OSError, ET.ParseError) as e:
+            logger.debug(f'Skipping {path}: {e}')
+    if not parts and download:
+        # repos are fetched one after another; the first few usually hold all the comps anyway
+        for repo in system_repos():
+            if found := download_groupfile(repo, timeout):
+                parts.append(found)
+    if not parts or not any(envs or groups for envs, groups in parts):
+        return None
+    return merge(parts)
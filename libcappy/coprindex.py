@@ -0,0 +1,244 @@
+# LibCappy Copr search index.
+# A local SQLite full-text index of the Copr project listing, so searching
+# does not need a round trip to Copr for every query.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Any, Iterable, Iterator
+
+from .common import CACHE_DIR
+from .repository import COPR_URL, AsyncCopr
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS projects (
+    id INTEGER PRIMARY KEY,
+    owner TEXT NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL,
+    instructions TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS projects_fts USING fts5(
+    name, owner, description, instructions,
+    content='projects', content_rowid='id', prefix='2 3', tokenize="unicode61 tokenchars '-_.'"
+);
+CREATE TABLE IF NOT EXISTS trigrams (
+    tri TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    PRIMARY KEY (tri, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS trigrams_id ON trigrams (id);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+# column weights for bm25(): a hit in the name counts the most
+WEIGHTS = (10.0, 5.0, 2.0, 1.0)
+
+# the least trigram similarity for a fuzzy match
+MIN_SIMILARITY = 0.3
+# how many trigram postings a fuzzy search reads at most
+FUZZY_POSTINGS = 5000
+
+
+@dataclass
+class IndexStats:
+    added: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    seconds: float = 0.0
+
+    def __str__(self):
+        return f'{self.added} added, {self.updated} updated, {self.unchanged} unchanged in {self.seconds:.1f}s'
+
+
+def trigrams(text: str) -> set[str]:
+    """The trigrams of text, padded so that short names and word starts still match."""
+    text = f'  {text.lower()} '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _dice(a: set[str], b: set[str]) -> float:
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def _fields(project: dict[str, Any]) -> dict[str, Any]:
+    # the listing wraps every project as {'project': {...}, '_links': {...}}
+    p = project.get('project', project)
+    owner = p.get('owner') or p.get('group') or ''
+    return {
+        'id': int(p['id']),
+        'owner': owner,
+        'name': p.get('name') or '',
+        'description': p.get('description') or '',
+        'instructions': p.get('instructions') or '',
+        'data': json.dumps(p, sort_keys=True),
+    }
+
+
+class CoprIndex:
+    """[summary]
+    An on-disk full-text index of Copr projects.
+
+    Projects are upserted by their Copr id, so refreshing the index only rewrites projects that
+    changed. search() ranks prefix matches on names, owners, descriptions and instructions with
+    bm25, and falls back to trigram similarity on names for misspelt queries.
+
+    Arguments:
+    path: string, the SQLite database (default: CACHE_DIR/copr-index.sqlite)
+    """
+
+    def __init__(self, path: str = os.path.join(CACHE_DIR, 'copr-index.sqlite')):
+        self.path = path
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        version = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if version and int(version[0]) != INDEX_VERSION:
+            logger.info(f'{path} was built by another version of libcappy, rebuilding it')
+            self.db.executescript('DROP TABLE projects; DROP TABLE projects_fts; DROP TABLE trigrams; DELETE FROM meta;')
+            self.db.executescript(SCHEMA)
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(INDEX_VERSION),))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT count(*) FROM projects').fetchone()[0]
+
+    @property
+    def updated(self) -> float | None:
+        """When the index was last refreshed, as a timestamp."""
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'updated'").fetchone()
+        return float(row[0]) if row else None
+
+    def update(self, projects: Iterable[dict[str, Any]], stats: IndexStats | None = None) -> IndexStats:
+        """Adds or refreshes projects, as returned by the Copr listing, in one transaction."""
+        stats = stats or IndexStats()
+        with self.db:
+            for project in projects:
+                row = _fields(project)
+                row['digest'] = hashlib.sha1(row['data'].encode()).hexdigest()
+                old = self.db.execute('SELECT * FROM projects WHERE id = ?', (row['id'],)).fetchone()
+                if old and old['digest'] == row['digest']:
+                    stats.unchanged += 1
+                    continue
+                if old:
+                    # external content tables need the old values to drop them from the index
+                    self.db.execute("INSERT INTO projects_fts (projects_fts, rowid, name, owner, description, instructions) "
+                                    "VALUES ('delete', ?, ?, ?, ?, ?)",
+                                    (old['id'], old['name'], old['owner'], old['description'], old['instructions']))
+                    self.db.execute('DELETE FROM trigrams WHERE id = ?', (row['id'],))
+                    stats.updated += 1
+                else:
+                    stats.added += 1
+                self.db.execute('INSERT OR REPLACE INTO projects VALUES (:id, :owner, :name, :description, :instructions, :digest, :data)', row)
+                self.db.execute('INSERT INTO projects_fts (rowid, name, owner, description, instructions) VALUES (?, ?, ?, ?, ?)',
+                                (row['id'], row['name'], row['owner'], row['description'], row['instructions']))
+                self.db.executemany('INSERT OR IGNORE INTO trigrams VALUES (?, ?)',
+                                    ((t, row['id']) for t in trigrams(row['name']) | trigrams(f"{row['owner']}/{row['name']}")))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('updated', ?)", (str(time.time()),))
+        return stats
+
+    async def refresh(self, copr: AsyncCopr, page_amount: int = 100, search: str | None = None) -> IndexStats:
+        """Pulls the whole paginated listing through copr, committing every page as it arrives."""
+        stats = IndexStats()
+        start = time.monotonic()
+        async for page in copr.iter_pages(page_amount, search):
+            self.update(page, stats)
+        stats.seconds = time.monotonic() - start
+        logger.info(f'Indexed Copr projects: {stats}')
+        return stats
+
+    def sync(self, copr_url: str = COPR_URL, search: str | None = None, **kwargs) -> IndexStats:
+        """refresh() for synchronous callers. kwargs are passed on to AsyncCopr."""
+        async def run():
+            async with AsyncCopr(copr_url, **kwargs) as copr:
+                return await self.refresh(copr, search=search)
+        return asyncio.run(run())
+
+    @staticmethod
+    def _match(query: str) -> str:
+        # every word has to match as a prefix, in any column
+        words = re.findall(r'[\w.-]+', query)
+        return ' AND '.join('"' + w.replace('"', '""') + '"*' for w in words)
+
+    def search(self, query: str, limit: int = 20, fuzzy: bool = True) -> list[dict[str, Any]]:
+        """Projects matching query, best first.
+
+        Each result has the project's owner, name, full_name, description, instructions and
+        score. If prefix matching finds fewer than limit projects, the rest are filled with
+        the names closest to the query by trigram similarity.
+        """
+        results: list[dict[str, Any]] = []
+        if match := self._match(query):
+            rows = self.db.execute(
+                f'SELECT p.*, bm25(projects_fts, {", ".join(map(str, WEIGHTS))}) AS rank '
+                'FROM projects_fts JOIN projects p ON p.id = projects_fts.rowid '
+                'WHERE projects_fts MATCH ? ORDER BY rank LIMIT ?', (match, limit)).fetchall()
+            results = [self._result(row, -row['rank']) for row in rows]
+        if fuzzy and len(results) < limit and (tris := trigrams(query.strip())):
+            seen = {r['id'] for r in results}
+            # count shared trigrams over the rarest ones only, common ones like 'pro' would
+            # make every project a candidate
+            df = {t: self.db.execute('SELECT count(*) FROM trigrams WHERE tri = ?', (t,)).fetchone()[0] for t in tris}
+            rare: list[str] = []
+            postings = 0
+            for t in sorted((t for t in tris if df[t]), key=df.__getitem__):
+                if rare and postings + df[t] > FUZZY_POSTINGS:
+                    break
+                rare.append(t)
+                postings += df[t]
+            marks = ', '.join('?' * len(rare))
+            rows = self.db.execute(
+                f'SELECT p.*, count(*) AS shared FROM trigrams t JOIN projects p ON p.id = t.id '
+                f'WHERE t.tri IN ({marks}) GROUP BY t.id ORDER BY shared DESC, p.name LIMIT ?',
+                (*rare, limit * 5)).fetchall() if rare else []
+            close = []
+            for row in rows:
+                # Dice coefficient against the name or owner/name, whichever is closer
+                similarity = max(_dice(tris, trigrams(row['name'])), _dice(tris, trigrams(f"{row['owner']}/{row['name']}")))
+                if row['id'] not in seen and similarity >= MIN_SIMILARITY:
+                    close.append(self._result(row, similarity))
+            close.sort(key=lambda r: -r['score'])
+            results += close[:limit - len(results)]
+        return results
+
+    def projects(self) -> Iterator[dict[str, Any]]:
+        """Every project in the index by owner and name, read from the database as it is iterated."""
+        for row in self.db.execute('SELECT * FROM projects ORDER BY owner, name'):
+            yield self._result(row, 0)
+
+    @staticmethod
+    def _result(row: sqlite3.Row, score: float) -> dict[str, Any]:
+        return {
+            'id': row['id'],
+            'owner': row['owner'],
+            'name': row['name'],
+            'full_name': f"{row['owner']}/{row['name']}",
+            'description': row['description'],
+            'instructions': row['instructions'],
+            'score': score,
+        }
@@ -0,0 +1,225 @@
+# LibCappy raw disk images.
+# Builds a sparse raw image partitioned after the install's volumes, attaches
+# it as a loop device for the install, and compresses it multithreaded while
+# reading only the parts of it that hold data.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import errno
+import logging
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Iterator
+
+from .blockdev import human_size
+from .cache import parse_size
+from .provision import partition_path
+from .trace import span
+
+logger = logging.getLogger(__name__)
+
+# compressor command lines, without the thread count
+COMPRESSORS = {
+    'zstd': (['zstd', '-q', '-c'], '.zst'),
+    'xz': (['xz', '-q', '-c'], '.xz'),
+}
+# how much of a hole is written to the compressor at once
+ZEROS = bytes(1 << 20)
+
+
+@dataclass
+class ImageReport:
+    """What building and compressing a disk image took."""
+    path: str
+    size: int
+    allocated: int
+    data: int
+    output: str
+    output_size: int
+    build_seconds: float
+    compress_seconds: float
+
+    def __str__(self) -> str:
+        return (f'{self.path}: {human_size(self.size)} raw, {human_size(self.allocated)} allocated, '
+                f'{human_size(self.data)} of data, built in {self.build_seconds:.1f}s\n'
+                f'{self.output}: {human_size(self.output_size)}, compressed in {self.compress_seconds:.1f}s')
+
+
+def data_extents(fd: int) -> Iterator[tuple[int, int]]:
+    """The (offset, length) of every data extent of a file, found with SEEK_DATA and SEEK_HOLE.
+
+    Filesystems without hole support report the whole file as one extent.
+    """
+    end = os.fstat(fd).st_size
+    offset = 0
+    while offset < end:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:  # only a hole is left
+                return
+            raise
+        offset = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, offset - start
+
+
+def compress(path: str, output: str, method: str = 'zstd', level: int | None = None, threads: int = 0) -> int:
+    """Compresses the file at path into output with a multithreaded compressor. Returns the bytes of data read.
+
+    Data extents are spliced into the compressor with sendfile(), holes are written as zeros
+    from memory, so the holes of a sparse image are never read from disk.
+    """
+    cmd, _ = COMPRESSORS[method]
+    cmd = cmd + [f'-T{threads}'] + ([f'-{level}'] if level is not None else [])
+    data = 0
+    with open(path, 'rb') as src, open(output + '.tmp', 'wb') as dst:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=dst)
+        try:
+            pipe = proc.stdin.fileno()
+            pos = 0
+            size = os.fstat(src.fileno()).st_size
+            for start, length in [*data_extents(src.fileno()), (size, 0)]:
+                _write_zeros(pipe, start - pos)
+                sent = 0
+                while sent < length:
+                    n = os.sendfile(pipe, src.fileno(), start + sent, length - sent)
+                    if n == 0:
+                        raise OSError(errno.EIO, f'{path} ended early')
+                    sent += n
+                data += length
+                pos = start + length
+        finally:
+            proc.stdin.close()
+            returncode = proc.wait()
+    if returncode != 0:
+        os.unlink(output + '.tmp')
+        raise RuntimeError(f'{cmd[0]} failed with exit code {returncode}')
+    os.replace(output + '.tmp', output)
+    return data
+
+
+def _write_zeros(fd: int, count: int):
+    view = memoryview(ZEROS)
+    while count > 0:
+        count -= os.write(fd, view[:min(count, len(ZEROS))])
+
+
+class DiskImage:
+    """[summary]
+    A raw disk image as the output of an install, instead of the disks on the host.
+
+    The image is a sparse file with a partition per volume, in the order of `volumes`, each the
+    `size` of its volume; one without a size takes the rest of the image. Volumes that share a
+    device or a `partition` key share a partition, see layout(). attach() creates
+    it, attaches it as a loop device and points the install's volumes at its partitions with
+    `format: true`, so Installer.provision() partitions and formats it and the rest of the
+    install goes into it. emit() compresses the finished image and reports on it.
+
+    Arguments:
+    path: string, where the raw image is written; the compressed one gets the compressor's suffix
+    size: string or int, the size of the image, e.g. '8G'
+    table: string, the partition table type (default: gpt)
+    compress: string, 'zstd', 'xz' or 'none'
+    level: int, the compression level (default: the compressor's)
+    threads: int, compression threads, 0 for one per CPU
+    keep_raw: bool, whether to keep the raw image next to the compressed one
+    """
+
+    def __init__(self, path: str, size: str | int, table: str = 'gpt', compress: str = 'zstd', level: int | None = None,
+                 threads: int = 0, keep_raw: bool = False):
+        if compress != 'none' and compress not in COMPRESSORS:
+            raise ValueError(f'Unknown compression {compress!r}, expected none or one of {list(COMPRESSORS)}')
+        self.path = os.path.abspath(path)
+        self.size = parse_size(size)
+        self.table = table
+        self.compress = compress
+        self.level = level
+        self.threads = threads
+        self.keep_raw = keep_raw
+        self.started = 0.0
+        self.built = 0.0
+
+    @staticmethod
+    def partition(volume: dict[str, Any]) -> dict[str, Any]:
+        if volume.get('partition_type'):
+            kind = volume['partition_type']
+        elif volume.get('filesystem') == 'swap':
+            kind = 'swap'
+        elif volume.get('mountpoint') in ('/boot/efi', '/efi'):
+            kind = 'uefi'
+        else:
+            kind = 'linux'
+        return {'size': volume.get('size'), 'type': kind}
+
+    @classmethod
+    def layout(cls, volumes: list[dict[str, Any]]) -> tuple[list[dict[str, Any]], list[int]]:
+        """The partitions for volumes, and the partition number of every volume.
+
+        Volumes with the same `partition` key, or else the same `device`, share one partition
+        and so one filesystem, like btrfs subvolumes; the first of them with a size sets its size.
+        Every other volume gets a partition of its own.
+        """
+        partitions: list[dict[str, Any]] = []
+        groups: dict[Any, int] = {}
+        numbers = []
+        for n, volume in enumerate(volumes):
+            group = volume.get('partition', volume.get('device', ('volume', n)))
+            if group not in groups:
+                partitions.append(cls.partition(volume))
+                groups[group] = len(partitions)
+            elif not partitions[groups[group] - 1]['size']:
+                partitions[groups[group] - 1]['size'] = volume.get('size')
+            numbers.append(groups[group])
+        return partitions, numbers
+
+    @contextmanager
+    def attach(self, config: dict[str, Any]) -> Iterator[str]:
+        """Creates the sparse image and attaches it as a loop device for the block, with the config pointed at it.
+
+        Everything on the image has to be unmounted before the block ends.
+        """
+        self.started = time.monotonic()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as f:
+            f.truncate(self.size)
+        loop = subprocess.run(['losetup', '--find', '--show', '--partscan', self.path],
+                              capture_output=True, text=True, check=True).stdout.strip()
+        logger.info(f'Attached {self.path} ({human_size(self.size)}) as {loop}')
+        try:
+            volumes = config['volumes']
+            partitions, numbers = self.layout(volumes)
+            config['provision'] = {'disks': [{'device': loop, 'table': self.table, 'partitions': partitions}]}
+            for volume, n in zip(volumes, numbers):
+                volume['device'] = partition_path(loop, n)
+                volume['format'] = True
+            yield loop
+        finally:
+            subprocess.run(['losetup', '--detach', loop], capture_output=True)
+            self.built = time.monotonic()
+
+    def emit(self) -> ImageReport:
+        """Compresses the detached image. Returns its sizes and how long it took to build and compress."""
+        st = os.stat(self.path)
+        start = time.monotonic()
+        if self.compress == 'none':
+            output, data = self.path, sum(length for _, length in _extents(self.path))
+        else:
+            output = self.path + COMPRESSORS[self.compress][1]
+            with span('compress image', method=self.compress, size=st.st_size):
+                data = compress(self.path, output, self.compress, self.level, self.threads)
+        report = ImageReport(self.path, st.st_size, st.st_blocks * 512, data, output, os.path.getsize(output),
+                             self.built - self.started, time.monotonic() - start)
+        if output != self.path and not self.keep_raw:
+            os.unlink(self.path)
+        logger.info(f'{report}')
+        return report
+
+
+def _extents(path: str) -> list[tuple[int, int]]:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return list(data_extents(fd))
+    finally:
+        os.close(fd)
@@ -0,0 +1,178 @@
+# LibCappy fan-out installs.
+# Installs one resolved and downloaded package set into many installroots at
+# once, with an rpm transaction of their own or an image of the first rootfs.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+from .imagecache import ImageCache
+from .installer import Installer
+from .trace import span
+
+logger = logging.getLogger(__name__)
+
+MODES = ['rpm', 'copy']
+# what defines the package set is resolved once for every target, so targets can not override it
+SHARED_KEYS = {'packages', 'dnf_options', 'copr', 'local_repo', 'cache', 'lockfile', 'pipeline'}
+
+
+def target_configs(config: dict[str, Any]) -> list[dict[str, Any]]:
+    """The install config of every entry of `targets`: the config with the target's keys on top.
+
+    A target key replaces the config's, so a target with its own volumes lists all of them.
+    """
+    base = {k: v for k, v in config.items() if k not in ('targets', 'fanout')}
+    configs = []
+    for n, target in enumerate(config.get('targets') or []):
+        if not target.get('installroot'):
+            raise ValueError(f'Target {n} has no installroot')
+        if shared := SHARED_KEYS & target.keys():
+            raise ValueError(f"Target {target['installroot']} overrides {', '.join(sorted(shared))}, "
+                             'which all targets share')
+        configs.append({**base, **target})
+    roots = [os.path.abspath(c['installroot']) for c in configs]
+    if len(set(roots)) != len(roots):
+        raise ValueError('Two targets have the same installroot')
+    return configs
+
+
+def rpm_install(root: str, paths: list[str]):
+    """Installs downloaded RPMs into root, in one transaction of an rpm process of its own.
+
+    librpm chroots the whole process to run scriptlets, so transactions into different roots
+    can not run in threads of one process.
+    """
+    os.makedirs(root, exist_ok=True)
+    with span('rpm transaction', root=root, packages=len(paths)):
+        proc = subprocess.run(['rpm', '--root', os.path.abspath(root), '--install', '--quiet', *paths],
+                              capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f'The rpm transaction into {root} failed: {proc.stderr.strip()}')
+
+
+class FanOut:
+    """[summary]
+    Installs the same package set into the installroots of the install config's `targets`.
+
+    The repos are loaded and the package set resolved once, by the first target's Installer,
+    which the others share. In rpm mode the packages are also downloaded once, to a staging
+    directory on the host, and every target runs an rpm transaction of its own from there. In
+    copy mode the first target is installed as usual and the others unpack an ImageCache image
+    of its rootfs, from the configured image cache or one in the staging directory.
+    Either way each target is mounted, configured and made bootable with its own settings, such
+    as its hostname and the UUIDs of its volumes.
+
+    Arguments:
+    config: dict, the install config with `targets`, a list of per target overrides
+    workers: int, how many targets are installed at once (default: `fanout.workers`, or 4)
+    mode: string, 'rpm' or 'copy' (default: `fanout.mode`, or rpm)
+    """
+
+    def __init__(self, config: dict[str, Any], workers: int | None = None, mode: str | None = None):
+        options = config.get('fanout') or {}
+        self.workers = workers or options.get('workers', 4)
+        self.mode = mode or options.get('mode', 'rpm')
+        if self.mode not in MODES:
+            raise ValueError(f'Unknown fan-out mode {self.mode!r}, expected one of {MODES}')
+        configs = target_configs(config)
+        if not configs:
+            raise ValueError('The install config has no targets')
+        self.primary = Installer(configs[0])
+        self.installers = [self.primary] + [Installer(c, packages=self.primary.packages) for c in configs[1:]]
+        for installer in self.installers[1:]:
+            installer.copr_files = self.primary.copr_files
+        self.resolved: tuple[list[str], list | None] | None = None
+        self.paths: list[str] = []
+        self.staging: str | None = None
+        self.images: ImageCache | None = None
+        # the image key of the first target's rootfs, which copy mode waits for
+        self._installed: Future = Future()
+
+    def _staging(self) -> str:
+        if self.staging is None:
+            self.staging = tempfile.mkdtemp(prefix='cappy-fanout-', dir='/var/tmp')
+        return self.staging
+
+    def close(self):
+        if self.staging:
+            shutil.rmtree(self.staging, ignore_errors=True)
+            self.staging = None
+
+    def prepare(self):
+        """Resolves the package set and, in rpm mode, downloads it."""
+        packages = self.primary.packages
+        if (resolved := self.primary.resolve()) is None:
+            raise RuntimeError('Could not resolve the package set')
+        self.resolved = resolved
+        if self.mode == 'copy':
+            self.images = self.primary.image_cache() or ImageCache(os.path.join(self._staging(), 'images'))
+            return
+        # not into the first installroot: it is not mounted yet
+        for repo in packages.dnf.repos.iter_enabled():
+            repo.pkgdir = os.path.join(self._staging(), repo.id)
+        locked = resolved[1]
+        pkgs = list(packages.dnf.transaction.install_set) if locked is None else list(locked)
+        logger.info(f'Downloading {len(pkgs)} packages for {len(self.installers)} targets')
+        packages.download(pkgs, packages.downprogress)
+        self.paths = [pkg.localPkg() for pkg in pkgs]
+
+    def rootfs(self, n: int) -> Callable[[], None]:
+        """The step filling target n's mounted installroot, in place of Installer.instRoot."""
+        installer = self.installers[n]
+
+        def install():
+            if self.mode == 'rpm':
+                installer.add_coprs()
+                rpm_install(installer.chroot_path, self.paths)
+                installer.autorelabel()
+            elif n == 0:
+                try:
+                    installer.instRoot(self.resolved)
+                    # imaged right away, before this target's own configuration goes into it
+                    key = ImageCache.key(self.resolved[0], installer.config['dnf_options'])
+                    if not self.images.lookup(key):
+                        self.images.store(key, installer.chroot_path)
+                except BaseException as e:
+                    self._installed.set_exception(e)
+                    raise
+                self._installed.set_result(key)
+            else:
+                self.images.extract(self._installed.result(), installer.chroot_path)
+                installer.add_coprs()
+                installer.autorelabel()
+        return install
+
+    def run(self, fn: Callable[[int, Installer], Any]) -> dict[str, BaseException | None]:
+        """Calls fn(n, installer) for every target, `workers` of them at once.
+
+        A failing target does not stop the others. Returns the error of every target by
+        installroot, None for the ones that succeeded.
+        """
+        errors: dict[str, BaseException | None] = {}
+        lock = threading.Lock()
+
+        def one(n: int, installer: Installer):
+            try:
+                with span('target', root=installer.chroot_path):
+                    fn(n, installer)
+                error = None
+            except BaseException as e:
+                logger.error(f'Installing to {installer.chroot_path} failed: {e}')
+                error = e
+                if n == 0 and not self._installed.done():
+                    # copy mode targets would otherwise wait for the first one forever
+                    self._installed.set_exception(e)
+            with lock:
+                errors[installer.chroot_path] = error
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='cappy-target') as pool:
+            for n, installer in enumerate(self.installers):
+                pool.submit(one, n, installer)
+        return {i.chroot_path: errors[i.chroot_path] for i in self.installers}
@@ -0,0 +1,182 @@
+# LibCappy HTTP response cache.
+# Keeps GET responses from Copr on disk, revalidates them with ETag and
+# If-Modified-Since once they are older than the TTL, and falls back to
+# them when the network is down.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any
+
+import requests
+import requests.adapters
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from .cache import parse_size
+from .common import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class HTTPCacheStats:
+    hits: int = 0
+    misses: int = 0
+    revalidations: int = 0
+    stale: int = 0
+    evicted: int = 0
+
+    def __str__(self):
+        return f'{self.hits} hits, {self.misses} misses, {self.revalidations} revalidated, {self.stale} stale, {self.evicted} evicted'
+
+
+class HTTPCache:
+    """[summary]
+    A persistent cache of HTTP GET responses.
+
+    Every entry is a JSON metadata file plus the raw body, named after the URL's sha256.
+    Entries younger than ttl are served without a request. Older ones are revalidated with
+    their ETag and Last-Modified, and still served if the server cannot be reached or times out.
+    The directory is only created when the first entry is stored.
+
+    Arguments:
+    path: string, the cache directory (default: CACHE_DIR/http)
+    ttl: float, seconds an entry is used without revalidation
+    max_size: int or string such as '64M', the size cap for stored bodies
+    """
+
+    def __init__(self, path: str = os.path.join(CACHE_DIR, 'http'), ttl: float = 3600, max_size: str | int = '64M'):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = parse_size(max_size)
+        self.stats = HTTPCacheStats()
+
+    @classmethod
+    def from_config(cls, value: Any) -> 'HTTPCache | None':
+        """The cache an `http_cache` config value asks for: false for none, true, empty or missing
+        for the defaults, or a mapping of the arguments."""
+        if value is False:
+            return None
+        if value is None or value is True:
+            return cls()
+        if isinstance(value, dict):
+            return cls(**value)
+        raise ValueError(f'http_cache must be true, false or a mapping of ttl, max_size and path, not {value!r}')
+
+    def _file(self, url: str, ext: str) -> str:
+        return os.path.join(self.path, hashlib.sha256(url.encode()).hexdigest() + ext)
+
+    def get(self, url: str) -> tuple[dict[str, Any], bytes] | None:
+        """The cached metadata and body of url, if there are any."""
+        try:
+            with open(self._file(url, '.json')) as f:
+                meta = json.load(f)
+            with open(self._file(url, '.body'), 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url:
+            return None
+        return meta, body
+
+    def fresh(self, meta: dict[str, Any]) -> bool:
+        return time.time() - meta['time'] < self.ttl
+
+    @staticmethod
+    def conditional_headers(meta: dict[str, Any]) -> dict[str, str]:
+        cached = CaseInsensitiveDict(meta['headers'])
+        headers = {}
+        if etag := cached.get('ETag'):
+            headers['If-None-Match'] = etag
+        if modified := cached.get('Last-Modified'):
+            headers['If-Modified-Since'] = modified
+        return headers
+
+    def put(self, url: str, status: int, headers: dict[str, str], body: bytes):
+        meta = {'url': url, 'status': status, 'headers': dict(headers), 'time': time.time()}
+        # created with the first entry, so a cache that is never written to leaves nothing behind
+        os.makedirs(self.path, exist_ok=True)
+        for ext, data in (('.body', body), ('.json', json.dumps(meta).encode())):
+            tmp = self._file(url, ext + '.tmp')
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._file(url, ext))
+        self.evict()
+
+    def touch(self, url: str, meta: dict[str, Any]):
+        """Marks an entry as fresh again after a 304."""
+        meta['time'] = time.time()
+        with open(self._file(url, '.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def evict(self):
+        """Drops the least recently stored entries until the bodies fit max_size."""
+        entries = []
+        total = 0
+        for file in os.listdir(self.path):
+            if file.endswith('.body'):
+                st = os.stat(os.path.join(self.path, file))
+                entries.append((st.st_mtime, st.st_size, file[:-5]))
+                total += st.st_size
+        entries.sort()
+        for _, size, name in entries:
+            if total <= self.max_size:
+                break
+            for ext in ('.body', '.json'):
+                try:
+                    os.remove(os.path.join(self.path, name + ext))
+                except FileNotFoundError:
+                    pass
+            total -= size
+            self.stats.evicted += 1
+
+
+class CachingAdapter(requests.adapters.HTTPAdapter):
+    """A requests transport adapter that answers GET requests through an HTTPCache."""
+
+    def __init__(self, cache: HTTPCache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def _response(self, request: requests.PreparedRequest, meta: dict[str, Any], body: bytes) -> requests.Response:
+        response = requests.Response()
+        response.status_code = meta['status']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = body
+        response.url = request.url or ''
+        response.request = request
+        response.reason = 'OK (cached)'
+        return response
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super().send(request, **kwargs)
+        url = request.url
+        cached = self.cache.get(url)
+        if cached and self.cache.fresh(cached[0]):
+            self.cache.stats.hits += 1
+            return self._response(request, *cached)
+        if cached:
+            request.headers.update(self.cache.conditional_headers(cached[0]))
+        try:
+            response = super().send(request, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if not cached:
+                raise
+            logger.warning(f'{url} is unreachable, using the cached response')
+            self.cache.stats.stale += 1
+            return self._response(request, *cached)
+        if response.status_code == 304 and cached:
+            self.cache.stats.revalidations += 1
+            self.cache.touch(url, cached[0])
+            return self._response(request, *cached)
+        self.cache.stats.misses += 1
+        if response.status_code == 200:
+            self.cache.put(url, response.status_code, response.headers, response.content)
+        return response
@@ -0,0 +1,87 @@
+# LibCappy golden rootfs image cache.
+# Installs with the same resolved package set are unpacked from an archive
+# of the first one instead of going through rpm again.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+from typing import Any
+
+from .common import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+# API filesystems and caches that never belong in an image
+EXCLUDES = ['proc/*', 'sys/*', 'dev/*', 'run/*', 'tmp/*', 'var/cache/dnf/*']
+
+FORMATS = ['squashfs', 'tar.zst']
+
+
+class ImageCache:
+    """[summary]
+    Compressed rootfs images keyed by the resolved package set.
+
+    Images are squashfs (built and unpacked with one thread per CPU) when squashfs-tools is
+    installed, and multithreaded zstd tarballs otherwise.
+
+    Arguments:
+    path: string, where images are kept (default: CACHE_DIR/images)
+    format: string, 'squashfs' or 'tar.zst'. None picks squashfs if available
+    threads: int, compression threads, 0 for one per CPU
+    """
+
+    def __init__(self, path: str = os.path.join(CACHE_DIR, 'images'), format: str | None = None, threads: int = 0):
+        if format is None:
+            format = 'squashfs' if shutil.which('mksquashfs') else 'tar.zst'
+        if format not in FORMATS:
+            raise ValueError(f'Unknown image format {format!r}, expected one of {FORMATS}')
+        self.path = path
+        self.format = format
+        self.threads = threads or os.cpu_count() or 1
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(nevras: list[str], opts: dict[str, Any] | None = None) -> str:
+        """Hashes a resolved NEVRA set together with the dnf options that produced it."""
+        data = json.dumps({'nevras': sorted(nevras), 'opts': opts or {}}, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def image(self, key: str) -> str:
+        return os.path.join(self.path, f'{key}.{self.format}')
+
+    def lookup(self, key: str) -> str | None:
+        return path if os.path.exists(path := self.image(key)) else None
+
+    def store(self, key: str, root: str):
+        """Archives the rootfs at root under key."""
+        start = time.monotonic()
+        image = self.image(key)
+        tmp = f'{image}.{os.getpid()}.tmp'
+        logger.info(f'Storing {root} as {image}')
+        if self.format == 'squashfs':
+            subprocess.run(['mksquashfs', root, tmp, '-noappend', '-comp', 'zstd', '-xattrs',
+                            '-processors', str(self.threads), '-quiet', '-wildcards', '-e'] + EXCLUDES, check=True)
+        else:
+            subprocess.run(['tar', '--create', '--file', tmp, '--use-compress-program', f'zstd -T{self.threads}',
+                            '--xattrs', "--xattrs-include=*", '--acls', '--numeric-owner', '--directory', root]
+                           + [f'--exclude=./{e}' for e in EXCLUDES] + ['.'], check=True)
+        os.replace(tmp, image)
+        logger.info(f'Stored {os.path.getsize(image) / (1 << 20):.0f} MiB image in {time.monotonic() - start:.1f}s')
+
+    def extract(self, key: str, root: str):
+        """Unpacks the image stored under key into root."""
+        start = time.monotonic()
+        image = self.image(key)
+        os.makedirs(root, exist_ok=True)
+        logger.info(f'Extracting {image} to {root}')
+        if self.format == 'squashfs':
+            subprocess.run(['unsquashfs', '-f', '-q', '-p', str(self.threads), '-d', root, image], check=True)
+        else:
+            subprocess.run(['tar', '--extract', '--file', image, '--use-compress-program', 'zstd -d', '--preserve-permissions',
+                            '--xattrs', "--xattrs-include=*", '--acls', '--numeric-owner', '--directory', root], check=True)
+        logger.info(f'Extracted image in {time.monotonic() - start:.1f}s')
@@ -1,31 +1,116 @@
 import os
-from libcappy.installer import Installer
+from contextlib import ExitStack
+from typing import Callable
+from libcappy import trace
+from libcappy.diskimage import DiskImage
+from libcappy.installer import Config, Installer
+from libcappy.scheduler import Scheduler
 
+CONFIG = '/tmp/cappyinstall.yml'
 
-def install():
-    print("Initialising...")
-    installer = Installer('/tmp/cappyinstall.yml')
-    fstab = installer.cfgparse.fstab()
-    print("Mounting partitions...")
-    installer.mount(fstab)
-    print("Installing to chroot...")
-    installer.instRoot()
-    print("genfstab...")
-    installer.fstab(fstab)
-    print("Installing bootloader...")
-    chroot: str = installer.cfgparse.config['installroot']
+
+def step(msg: str, fn, *args):
+    def run():
+        print(msg)
+        return fn(*args)
+    return run
+
+
+def plan(installer: Installer, stack: ExitStack, rootfs: Callable | None = None, label: str = '') -> Scheduler:
+    # the install steps of one installroot. rootfs fills the mounted installroot, instRoot by default
     bootloader: str = installer.cfgparse.config['bootloader']
+    sched = Scheduler()
+    # pushed first so it runs last, once the container no longer holds the mounts
+    stack.push(lambda exc_type, *_: exc_type is not None and installer.mounts.unmount_all())
+    sched.add('provision', step(f"{label}Creating filesystems...", installer.provision))
+    # the volumes only have their UUIDs once they are provisioned
+    sched.add('mount', step(f"{label}Mounting partitions...", lambda: installer.mount(installer.cfgparse.fstab())), ['provision'])
+    sched.add('instRoot', step(f"{label}Installing to chroot...", rootfs or installer.instRoot), ['mount'])
+    sched.add('fstab', step(f"{label}genfstab...", lambda: installer.fstab(installer.cfgparse.fstab())), ['instRoot'])
+    sched.add('firstboot', step(f"{label}Running systemd-firstboot", installer.systemd_firstboot), ['instRoot'])
+    # boot the chroot container once for the bootloader and post-install commands
+    sched.add('container', lambda: stack.enter_context(installer.nspawn_session()), ['instRoot'])
     if bootloader == 'grub':
-        installer.grubGen()
+        sched.add('grubTemplate', installer.grubTemplate, ['instRoot'])
+        sched.add('bootloader', step(f"{label}Installing bootloader...", installer.grubConfigure), ['grubTemplate', 'fstab', 'container'])
     elif bootloader == 'systemd-boot':
-        installer.systemdBoot()
+        sched.add('bootloader', step(f"{label}Installing bootloader...", installer.systemdBoot), ['fstab', 'container'])
     else:
         print(f"ERROR: Bootloader '{bootloader}' not supported")
         print(f"ERROR: You have to install one to boot Ultramarine Linux!")
-    print("Running systemd-firstboot")
-    installer.systemd_firstboot()
-    print("Running post-install scripts...")
-    installer.postInstall()
-    os.remove(os.path.join(chroot, 'machine-id'))
+        sched.add('bootloader', lambda: None, ['instRoot'])
+    sched.add('postInstall', step(f"{label}Running post-install scripts...", installer.postInstall), ['bootloader', 'firstboot', 'container'])
+    return sched
+
+
+def finish(installer: Installer, sched: Scheduler, label: str = ''):
+    installer.mounts.unmount_api()
+    os.remove(os.path.join(installer.chroot_path, 'machine-id'))
+    if report := sched.results.get('provision'):
+        print(report)
+    print(f"{label}{sched.report()}")
+
 
+def install():
+    print("Initialising...")
+    config = Config(CONFIG).config
+    if config.get('targets'):
+        return install_targets(config)
+    installer = Installer(config)
+    if image := installer.disk_image():
+        return install_image(installer, image)
+    with ExitStack() as stack:
+        sched = plan(installer, stack)
+        try:
+            sched.run()
+        finally:
+            # trace: path to export spans to, as JSON lines (*.jsonl) or a Chrome trace
+            if path := installer.cfgparse.config.get('trace'):
+                trace.export(path)
+    finish(installer, sched)
     print("Ultramarine Linux has been installed.")
+
+
+def install_image(installer: Installer, image: DiskImage):
+    # disk_image: the volumes are partitions of a sparse raw image, compressed when it is done
+    with image.attach(installer.config):
+        with ExitStack() as stack:
+            sched = plan(installer, stack)
+            try:
+                sched.run()
+            finally:
+                if path := installer.cfgparse.config.get('trace'):
+                    trace.export(path)
+        finish(installer, sched)
+        installer.mounts.unmount_all()
+    print("Compressing the image...")
+    print(image.emit())
+    print("Ultramarine Linux has been installed to a disk image.")
+
+
+def install_targets(config: dict):
+    # targets: one resolved package set installed into several installroots, see libcappy.fanout
+    from libcappy.fanout import FanOut
+    fan = FanOut(config)
+    print(f"Resolving packages for {len(fan.installers)} targets...")
+
+    def one(n: int, installer: Installer):
+        label = f"[{installer.chroot_path}] "
+        with ExitStack() as stack:
+            sched = plan(installer, stack, fan.rootfs(n), label)
+            sched.run()
+        finish(installer, sched, label)
+
+    try:
+        fan.prepare()
+        errors = fan.run(one)
+    finally:
+        fan.close()
+        if path := config.get('trace'):
+            trace.export(path)
+    failed = {root: e for root, e in errors.items() if e is not None}
+    for root, e in failed.items():
+        print(f"ERROR: Installing to {root} failed: {e}")
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(errors)} targets failed")
+    print(f"Ultramarine Linux has been installed to {len(errors)} targets.")
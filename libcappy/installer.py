@@ -5,20 +5,29 @@
 
 import logging
 import os
-import re
 import shutil
 import subprocess
-from typing import Any
+from contextlib import contextmanager
+from typing import Any, Iterator
 from urllib.request import urlopen
 
 import yaml
-from dnf import Base
 
 from libcappy.common import DS
 from libcappy.ui import Interface
 
-from .packages import Packages
-from .repository import Copr
+from . import comps, locales
+from .blockdev import BlockInventory
+from .cache import PackageCache
+from .coprindex import CoprIndex
+from .diskimage import DiskImage
+from .httpcache import HTTPCache
+from .imagecache import ImageCache
+from .lockfile import Lockfile
+from .mount import MountTable
+from .nspawn import NSPAWN_ARGS, NspawnResult, NspawnSession
+from .repository import Copr, add_files, prepare_coprs
+from .trace import span
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +41,7 @@ class Config(object):
         # set the default values if not specified
         if 'installroot' not in self.config:
             self.config['installroot'] = '/mnt/sysimage'
+        self.config.setdefault('nspawn_session', True)
 
 
 class CfgParser:
@@ -78,68 +88,234 @@ class Installer:
     [summary]
     Libcappy installer module. This class is used to bootstrap a minimal Fedora/Ultramarine chroot from scratch,
     Similar to the likes of Arch Linux's pacstrap.
+
+    Copr responses are cached on the host in CACHE_DIR/http unless the config sets `http_cache: false`;
+    see HTTPCache.from_config() for the other values.
     """
 
-    def __init__(self, config: str):
+    def __init__(self, config: str | dict[str, Any], packages: Any = None):
         """
         Initializes the Installer class.
 
         Arguments:
-        chroot_path {[type]} -- [description]
+        config -- path to the YAML configuration, or its already loaded `install` section
+        packages -- a Packages to share with another installer, instead of loading the repos again;
+                    the local and Copr repos are then not set up again either
         """
-        self.config = Config(config).config
+        self.config = Config(config).config if isinstance(config, str) else config
         self.cfgparse = CfgParser(self.config)
         self.chroot_path = self.config['installroot']
-        self.packages = Packages(installroot=self.chroot_path, opts=self.config['dnf_options'])
-        self.copr = Copr()
+        self.mounts = MountTable(self.chroot_path)
+        # http_cache: on by default, false to always fetch from Copr, or a mapping with ttl / max_size
+        self.http_cache = HTTPCache.from_config(self.config.get('http_cache'))
+        self.copr = Copr(cache=self.http_cache)
+        self.copr_files: dict[str, bytes] = {}
+        if packages is None:
+            repo_options = self.repo_options()
+            if coprs := self.copr_repos():
+                repo_options['repos'] = repo_options.get('repos', []) + coprs
+            # dnf is slow to import, so only installs pay for it and the wizard does not
+            from .packages import Packages
+            packages = Packages(installroot=self.chroot_path, opts=self.config['dnf_options'], cache=self.package_cache(), **repo_options)
+        self.packages = packages
+        self.session: NspawnSession | None = None
         self.logger = logger
         self.logger.debug('Initializing Installer class')
 
-    def nspawn(self, command: str):
+    def package_cache(self) -> PackageCache | None:
+        """Returns the shared host package cache from the `cache` config key, if there is one.
+
+        `cache` is either true, for the default location, or a mapping with `path` and `budget`.
+        """
+        cache = self.config.get('cache')
+        if not cache:
+            return None
+        if isinstance(cache, dict):
+            return PackageCache(**cache)
+        return PackageCache()
+
+    def image_cache(self) -> ImageCache | None:
+        """Returns the golden image cache from the `image_cache` config key, if there is one.
+
+        `image_cache` is either true or a mapping with `path`, `format`, `threads` and `rebuild`.
+        """
+        cache = self.config.get('image_cache')
+        if not cache:
+            return None
+        if not isinstance(cache, dict):
+            cache = self.config['image_cache'] = {}
+        return ImageCache(**{k: v for k, v in cache.items() if k != 'rebuild'})
+
+    def lockfile(self) -> Lockfile | None:
+        """Returns the transaction lockfile from the `lockfile` config key, if there is one."""
+        path = self.config.get('lockfile')
+        return Lockfile(path) if path else None
+
+    def disk_image(self) -> DiskImage | None:
+        """Returns the raw disk image to install into, from the `disk_image` config key, if there is one.
+
+        `disk_image` is a mapping with `path` and `size`, and optionally `table`, `compress`, `level`,
+        `threads` and `keep_raw`.
+        """
+        image = self.config.get('disk_image')
+        return DiskImage(**image) if image else None
+
+    def repo_options(self) -> dict[str, Any]:
+        """Repository arguments for Packages, from the `local_repo` config key.
+
+        A local repo (as built by libcappy.repository.repo_from_cache) replaces the system repos,
+        so the install can run fully offline.
+        """
+        local = self.config.get('local_repo')
+        if not local:
+            return {}
+        repo = {'id': 'cappy-local', 'name': 'Cappy local repository'}
+        if isinstance(local, dict):
+            repo.update(local)
+        else:
+            repo['baseurl'] = 'file://' + os.path.abspath(local)
+        return {'repos': [repo], 'system_repos': False}
+
+    def copr_repos(self) -> list[dict[str, Any]]:
+        """Fetches the Copr projects of the `copr` config key and returns them as repos for Packages.
+
+        Entries are owner/project strings. The repo files and keys are all fetched at once, for the
+        chroot matching `releasever` and `arch` in dnf_options. They are only written into the
+        installroot by add_coprs(), once it is mounted; the host reads the keys from COPR_KEY_DIR.
+        """
+        projects = self.config.get('copr')
+        if not projects:
+            return []
+        self.copr_files, repos = prepare_coprs(projects, self.config.get('dnf_options'), cache=self.http_cache)
+        return repos
+
+    def add_coprs(self):
+        """Adds the .repo files and keys of the Copr projects to the installroot."""
+        add_files(self.chroot_path, self.copr_files)
+
+    @contextmanager
+    def nspawn_session(self):
+        """Boots the chroot container once and routes every nspawn() call inside the block to it.
+
+        Nested blocks reuse the outer session. Does nothing if `nspawn_session` is disabled in the config.
+        """
+        if self.session or not self.config['nspawn_session']:
+            yield self.session
+            return
+        with NspawnSession(self.chroot_path) as session:
+            self.session = session
+            try:
+                yield session
+            finally:
+                self.session = None
+
+    def nspawn(self, command: str, independent: bool = False) -> NspawnResult | None:
         """Calls systemd-nspawn to do the bidding
 
         Args:
             command ([type]): command
+            independent (bool): the command does not depend on the ones before it,
+                so it may run concurrently with them inside a session
+
+        Returns the result of the command, or None if it was queued as independent.
         """
         self.logger.info(f'Running command: "{command}" on chroot')
-        subprocess.run([
-            'systemd-nspawn',
-            '--quiet',
-            '--capability=CAP_SYS_ADMIN,CAP_SYS_RAWIO',
-            '-D',
-            self.chroot_path,
-            '/bin/bash',
-            '-c',
-            command
-        ])
-
-    def instRoot(self):
+        if self.session:
+            if independent:
+                # runs in the background, its time is covered by the span of whatever waits for it
+                self.session.submit(command)
+                return None
+            with span('nspawn', command=command, session=True) as attrs:
+                result = self.session.run(command)
+                attrs['returncode'] = result.returncode
+            return result
+        with span('nspawn', command=command, session=False) as attrs:
+            proc = subprocess.run(NSPAWN_ARGS + [
+                '-D',
+                self.chroot_path,
+                '/bin/bash',
+                '-c',
+                command
+            ])
+            attrs['returncode'] = proc.returncode
+        return NspawnResult(command, proc.returncode, '')
+
+    def resolve(self) -> tuple[list[str], list | None] | None:
+        """Resolves the package set, from the lockfile while it is still valid.
+
+        Returns the NEVRAs and the locked packages, which are None after a fresh depsolve, or None
+        if the depsolve failed.
+        """
+        specs, opts = self.config['packages'], self.config['dnf_options']
+        if lock := self.lockfile():
+            checksums = self.packages.metadata.repomd_checksums()
+            if (nevras := lock.packages(specs, opts, checksums)) is not None:
+                if (locked := self.packages.locked_packages(nevras)) is not None:
+                    self.logger.info(f'Installing {len(locked)} locked packages from {lock.path}')
+                    return sorted(str(pkg) for pkg in locked), locked
+        if not self.packages.resolve(specs):
+            return None
+        nevras = self.packages.resolved_nevras()
+        if lock:
+            lock.write(specs, opts, checksums, nevras)
+        return nevras, None
+
+    def instRoot(self, resolved: tuple[list[str], list | None] | None = None):
         """instRoot
-        Initializes the chroot directory.
+        Initializes the chroot directory. Raises RuntimeError if the package set can not be resolved.
+
+        Arguments:
+            resolved -- the result of an earlier resolve(), so the package set is not resolved twice
         """
         if not os.path.exists(self.chroot_path):
             os.makedirs(self.chroot_path)
         self.logger.debug('Created chroot directory')
         self.logger.info('Initializing chroot directory')
-        self.packages.install(self.config['packages'])
+        self.add_coprs()
+        opts = self.config['dnf_options']
+        if resolved is None and (resolved := self.resolve()) is None:
+            raise RuntimeError('Could not resolve the package set')
+        nevras, locked = resolved
+        images = self.image_cache()
+        key = ImageCache.key(nevras, opts)
+        if images and images.lookup(key) and not self.config['image_cache'].get('rebuild'):
+            self.logger.info(f'Found a cached image for this package set ({key[:12]})')
+            images.extract(key, self.chroot_path)
+        else:
+            # pipeline: true, or a mapping with batch_size / parallel_downloads
+            pipeline = self.config.get('pipeline') or False
+            if isinstance(pipeline, dict):
+                self.packages.transact(pipeline=True, pkgs=locked, **pipeline)
+            else:
+                self.packages.transact(pipeline=pipeline, pkgs=locked)
+            if images:
+                images.store(key, self.chroot_path)
+        self.autorelabel()
+        self.logger.info('Installed packages')
+
+    def autorelabel(self):
         # create /.autorelabel
         with open(os.path.join(self.chroot_path, '.autorelabel'), 'w') as f:
             f.write('1')
-        self.logger.info('Installed packages')
 
     def postInstall(self):
         """postInstall
         Runs the post-installation commands.
         """
         self.logger.info('Running post-installation commands')
-        self.nspawn('systemctl disable auditd')
-        self.nspawn('systemctl enable dbus')
-        self.nspawn('systemctl enable systemd-resolved')
-        self.nspawn('systemctl enable NetworkManager')
-        self.nspawn('setenforce 0')
-        self.nspawn(f"sed -i 's/^SELINUX=enforcing/SELINUX=permissive/' {os.path.join(self.config['installroot'], 'etc/selinux/config'])}")
-        for command in self.config['postinstall']:
-            self.nspawn(command)
+        with self.nspawn_session():
+            self.nspawn('systemctl disable auditd', independent=True)
+            self.nspawn('systemctl enable dbus', independent=True)
+            self.nspawn('systemctl enable systemd-resolved', independent=True)
+            self.nspawn('systemctl enable NetworkManager', independent=True)
+            self.nspawn('setenforce 0')
+            self.nspawn("sed -i 's/^SELINUX=enforcing/SELINUX=permissive/' /etc/selinux/config")
+            for command in self.config['postinstall']:
+                # entries are either a plain command or {command: ..., independent: true}
+                if isinstance(command, dict):
+                    self.nspawn(command['command'], independent=command.get('independent', False))
+                else:
+                    self.nspawn(command)
 
     def fstab(self, table: list[dict[str, str | bool]]):
         """fstab
@@ -166,38 +342,96 @@ class Installer:
         """[summary]
         Configures GRUB for the chroot.
         """
+        self.grubTemplate()
+        self.grubConfigure()
+
+    def root_uuid(self) -> str:
+        return [d for d in self.cfgparse.config['volumes'] if d['mountpoint'] == '/'][0]['uuid']
+
+    def grubTemplate(self):
+        """[summary]
+        Writes the GRUB EFI stub configuration. Only needs the packages to be installed.
+        """
         self.logger.info('Configuring GRUB')
+        with span('bootloader', step='grub template'):
+            self._grubTemplate()
+
+    def _grubTemplate(self):
         # open the template from __file__/templates/grub.cfg
         with open(os.path.join(os.path.dirname(__file__), 'templates', 'grub.cfg'), 'r') as template:
             with open(os.path.join(self.chroot_path, 'boot/efi/EFI/fedora/grub.cfg'), 'w') as f:
                 # replace @UUID@ with the UUID of the root partition then write to file
-                root: str = [d for d in self.cfgparse.config['volumes'] if d['mountpoint'] == '/'][0]['uuid']
-                f.write(template.read().replace('@UUID@', root))
+                f.write(template.read().replace('@UUID@', self.root_uuid()))
 
         # copy boot/efi/EFI/fedora/grub.cfg to boot/efi/EFI/BOOT/grub.cfg
         shutil.copy(os.path.join(self.chroot_path, 'boot/efi/EFI/fedora/grub.cfg'), os.path.join(self.chroot_path, 'boot/efi/EFI/BOOT/grub.cfg'))
-        self.nspawn('grubby --remove-args="rd.live.image" --update-kernel ALL')
-        self.nspawn('grubby --remove-args="root" --update-kernel=ALL --copy-default')
-        self.nspawn(f'grubby --add-args="root={root}" --update-kernel=ALL --copy-default')
-        os.system(f'mount --bind /etc/resolv.conf {os.path.join(root, "etc/resolv.conf")}')
-        os.system(f'mount --bind /dev {os.path.join(root, "dev")}')
-        os.system(f'mount --bind /proc {os.path.join(root, "proc")}')
-        os.system(f'mount --bind /sys {os.path.join(root, "sys")}')
-        os.system(f"chroot {root} grub2-mkconfig -o /boot/grub2/grub.cfg")
+
+    def grubConfigure(self):
+        """[summary]
+        Updates the kernel entries and generates the main GRUB configuration.
+        """
+        with span('bootloader', step='grub configure'):
+            self._grubConfigure()
+
+    def _grubConfigure(self):
+        root = self.root_uuid()
+        with self.nspawn_session():
+            self.nspawn('grubby --remove-args="rd.live.image" --update-kernel ALL')
+            self.nspawn('grubby --remove-args="root" --update-kernel=ALL --copy-default')
+            self.nspawn(f'grubby --add-args="root={root}" --update-kernel=ALL --copy-default')
+        with self.api_mounts():
+            subprocess.run(['chroot', self.chroot_path, 'grub2-mkconfig', '-o', '/boot/grub2/grub.cfg'], check=True)
 
     def systemdBoot(self):
         # make /efi
         os.makedirs(os.path.join(self.chroot_path, 'boot', 'efi'), exist_ok=True)
-        self.nspawn('bootctl install --boot-path=/boot --esp-path=/boot')
-        self.nspawn('kernel-install add $(uname -r) /lib/modules/$(uname -r)/vmlinuz')
-        self.nspawn('dnf reinstall $(rpm -qa|grep kernel-core)')
+        with span('bootloader', step='systemd-boot'), self.nspawn_session():
+            self.nspawn('bootctl install --boot-path=/boot --esp-path=/boot')
+            self.nspawn('kernel-install add $(uname -r) /lib/modules/$(uname -r)/vmlinuz')
+            self.nspawn('dnf reinstall -y $(rpm -qa|grep kernel-core)')
+
+    def provision(self) -> str | None:
+        """Partitions the disks under `provision` and creates the filesystems of volumes with `format: true`.
+
+        The volumes get the UUIDs of their new filesystems. Returns the time every device took, or None
+        if there was nothing to provision.
+        """
+        from .provision import Provisioner
+        provisioner = Provisioner(self.config['volumes'], (self.config.get('provision') or {}).get('disks'))
+        if not provisioner.plan().steps:
+            return None
+        with span('provision', devices=len(provisioner.sched.steps)):
+            provisioner.run()
+        return provisioner.report()
 
     def mount(self, table: list[dict[str, str | bool]]):
-        chroot = self.config['installroot']
-        for entry in table:
-            path: str = os.path.join(chroot, entry['mountpoint'][1:])
-            os.system(f'mkdir -p {path}')
-            os.system(f"mount {entry['device']} {path}" + (f" -o {entry['opts']}"))
+        """Mounts the fstab volumes under the install root, then binds the API filesystems in.
+
+        Everything is unmounted again if a mount fails. The mounts are kept in self.mounts.
+        """
+        with span('mount', volumes=len(table)):
+            self.mounts.mount_all(self.mounts.volumes(table))
+            try:
+                self.mounts.bind_api()
+            except BaseException:
+                self.mounts.unmount_all()
+                raise
+
+    @contextmanager
+    def api_mounts(self):
+        """The host's /dev, /proc, /sys and resolv.conf bound into the root for chroot commands.
+
+        Reuses the binds mount() made for the whole install, and otherwise unbinds them again after
+        the block. resolv.conf is only bound for the block, over a resolv.conf the root already has.
+        """
+        owned = not self.mounts.api
+        self.mounts.bind_api()
+        try:
+            with self.mounts.resolv():
+                yield
+        finally:
+            if owned:
+                self.mounts.unmount_api()
 
     def systemd_firstboot(self):
         root, keymap, locale, hostname = self.config['installroot'], self.config['keymap'], self.config['locale'], self.config['hostname']
@@ -205,101 +439,24 @@ class Installer:
 
 class Wizard:
     @staticmethod
-    def lsblk():
-        parts: DS = []
-        lines = subprocess.getoutput("lsblk -l").splitlines()
-        lines.pop(0)
-        for l in lines:
-            if l[0] == ' ':
-                parts.append(parts[-1].copy())
-                parts[-1]['MOUNTPOINTS'] = l.strip()
-                continue
-            ls = l.split() + ['']  # in case no mp
-            parts.append({
-                'NAME': ls[0],
-                'SIZE': ls[3],
-                'TYPE': ls[5],
-                'MOUNTPOINTS': ls[6]  # mountpoint
-            })
-
-        lines = subprocess.getoutput("lsblk -lf").splitlines()
-        fields = re.findall(r'\S+\s*', lines.pop(0), re.RegexFlag.M)
-        last_field = fields[-1]
-        i: int = 0
-        for l in lines:
-            left = 0
-            cur: dict[str, str] = {}
-            for field in fields:
-                if last_field == field:
-                    value = l[left:]
-                else:
-                    length = len(field)
-                    value = l[left:left+length]
-                    left += length
-                v = value.strip()
-                # first field
-                if (f := field.rstrip().upper()) == 'NAME':
-                    if not v:  # v == ''
-                        assert ' ' not in (mp := l.strip())  # make sure it's only 1 col
-                        p = parts[i].copy()
-                        p['MOUNTPOINTS'] = mp
-                        found = False
-                        for n, part in enumerate(parts):
-                            if part['MOUNTPOINTS'] == mp:
-                                found = True
-                                break
-                        if found:
-                            parts[n].update(p)
-                        break  # just a thing with a different mountpoint
-                    for n, part in enumerate(parts):
-                        if part['NAME'] == v:
-                            cur = part
-                            i = n
-                            break
-                if not v:
-                    continue
-                cur[f] = v
-            if any(cur):
-                parts[i] = cur
-        return parts
-
-    @staticmethod
-    def tidy_lsblk(dicts: DS, dummy: str = '') -> tuple[set[str], DS]:
-        fields: set[str] = set([f for d in dicts for f in d] + ['NEW MOUNTPOINT', 'OPTIONS', 'FSCK', 'DUMP'])
-        newDicts: DS = []
-        default = {k: dummy for k in fields}
-        for d in dicts:
-            new = default.copy()
-            new.update(d)
-            newDicts.append(new)
-        return fields, newDicts
+    def lsblk(inventory: BlockInventory | None = None) -> DS:
+        # one row per device and mountpoint, with the columns of `lsblk -l` and `lsblk -lf`
+        return (inventory or BlockInventory()).rows()
 
     @staticmethod
     def strip_lsblk(parts: DS):
         # we don't allow users to select their installation media as the target
-        lsblk = [d for d in parts if d['MOUNTPOINTS'] not in ['/', '/boot/efi', '/boot']]
         cols = ['NAME', 'TYPE', 'FSTYPE', 'FSVER', 'LABEL', 'SIZE', 'MOUNTPOINTS', 'NEW MOUNTPOINT', 'OPTIONS', 'DUMP', 'FSCK', 'UUID', 'FSAVAIL', 'FSUSE%']
-        ds: DS = []
-        for d in lsblk:
-            new = {}
-            for col in cols:
-                new[col] = d[col]
-            ds.append(new)
-        return ds
+        return [{col: d.get(col, '') for col in cols} for d in parts if d['MOUNTPOINTS'] not in ['/', '/boot/efi', '/boot']]
 
     def localectl(self):
         return subprocess.getoutput("localectl list-locales --no-pager").splitlines()
 
-    def locales(self):
-        #! fix when build
-        # Temporary fix, checks if local build exists and if so, uses it, else use the system one
-        if os.path.exists(os.path.join(os.path.dirname(__file__), 'parse_locales/target/release/cappy_parse_locales')):
-            return subprocess.getoutput(os.path.join(os.path.dirname(__file__), 'parse_locales/target/release/cappy_parse_locales'))
-        else:
-            return subprocess.getoutput(os.path.join("/usr/bin/cappy_parse_locales"))
+    def locales(self) -> DS:
+        return [{'*': '', 'Locale': code, 'Name': name} for code, name in locales.locales()]
 
-    def keymaps(self):
-        return [{"*": '', "Keymap": v} for v in subprocess.getoutput("localectl list-keymaps --no-pager").splitlines()]
+    def keymaps(self) -> DS:
+        return [{"*": '', "Keymap": v} for v in locales.keymaps()]
 
     def nmtui(self, ui: Interface, timeout: float):
         while True:
@@ -320,11 +477,33 @@ class Wizard:
                         break
 
     @staticmethod
-    def fetch_envs_grps() -> tuple[DS, DS]:
-        with Base() as base:
-            # TODO: Option to load local repo for offline mode
-            base.read_all_repos()
-            base.fill_sack()
-            comps = base.comps
-            assert comps != None, "dnf.Base().comps failed miserably ;("  # might be None
-            return [{'*': '', 'ID': env.id, 'NAME': env.ui_name, 'DESCRIPTION': env.ui_description or ''} for env in comps.environments_iter()], [{'*': '', 'ID': grp.id, 'NAME': grp.ui_name, 'DESCRIPTION': grp.ui_description or ''} for grp in comps.groups_iter() if grp.id != 'core']
+    def copr_row(project: dict[str, Any]) -> dict[str, str]:
+        return {'*': '', 'PROJECT': project['full_name'], 'DESCRIPTION': (project['description'].splitlines() or [''])[0][:60]}
+
+    @staticmethod
+    def search_coprs(index: CoprIndex, query: str, limit: int = 50) -> DS:
+        return [Wizard.copr_row(r) for r in index.search(query, limit)]
+
+    @staticmethod
+    def list_coprs(index: CoprIndex) -> Iterator[dict[str, str]]:
+        """Every indexed project as a row, streamed from the index as the list scrolls."""
+        return (Wizard.copr_row(r) for r in index.projects())
+
+    @staticmethod
+    def envs_grps_table(envs: DS, groups: DS) -> tuple[DS, DS]:
+        return [{'*': '', 'ID': env['id'], 'NAME': env['name'], 'DESCRIPTION': env['description']} for env in envs], [{'*': '', 'ID': grp['id'], 'NAME': grp['name'], 'DESCRIPTION': grp['description']} for grp in groups if grp['id'] != 'core']
+
+    @staticmethod
+    def comps_envs_grps() -> tuple[DS, DS] | None:
+        """Environments and groups streamed straight from repodata, or None if there is none to read."""
+        found = comps.load()
+        return Wizard.envs_grps_table(*found) if found else None
+
+    @staticmethod
+    def fetch_envs_grps(fast: bool = True) -> tuple[DS, DS]:
+        # TODO: Option to load local repo for offline mode
+        if fast and (found := Wizard.comps_envs_grps()):
+            return found
+        from .metadata import Metadata
+        with Metadata() as metadata:
+            return Wizard.envs_grps_table(*metadata.comps())
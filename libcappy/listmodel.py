@@ -0,0 +1,286 @@
+# LibCappy list models for the TUI.
+# The formatting, scrolling and filtering state behind ui.ScrollList, kept free
+# of curses. Only the rows on screen are ever formatted.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import heapq
+import re
+from bisect import bisect_right
+from itertools import accumulate, islice
+from math import ceil
+from typing import Iterable, Iterator
+
+from .common import DS
+
+# fuzzy matches need this share of the query's trigrams
+MIN_SIMILARITY = 0.5
+# fuzzy matches are only looked for when a query has fewer exact matches than this, so they
+# make up for typos without burying the exact matches
+FUZZY_BELOW = 100
+# at most this many fuzzy matches are shown, the most similar ones
+FUZZY_LIMIT = 50
+# fuzzy matching is skipped when the query's rarest trigrams occur more often than this
+FUZZY_POSTINGS = 20000
+# characters that start a word, a match after one ranks above one inside a word
+WORD_STARTS = ' -_.:/('
+
+
+class TableModel:
+    """[summary]
+    A dataset shown as fixed width table lines, formatted only when they are drawn.
+
+    The rows are the dataset's own dicts: nothing is copied or formatted per row, and edits to a
+    row show up the next time it is drawn. Column widths are running maximums; they grow as rows
+    are loaded, and when a row is drawn with a longer value than any before.
+
+    The source can be a list, or any iterable such as a generator over the pages of a listing.
+    Rows are then pulled from it with load() as the list is scrolled towards its end. The model
+    can stand in for the dataset itself: it indexes and iterates over the rows loaded so far.
+
+    Arguments:
+    source: list or iterable of dicts with the same keys, the first row's keys are the columns
+    """
+
+    def __init__(self, source: Iterable[dict[str, str]]):
+        self.source = source
+        self.rows: DS = source if isinstance(source, list) else []
+        self._more: Iterator[dict[str, str]] | None = None if isinstance(source, list) else iter(source)
+        self.cols: list[str] = []
+        self.widths: list[int] = []
+        self._grow(self.rows)
+
+    @classmethod
+    def of(cls, ds: 'DS | TableModel') -> 'TableModel':
+        return ds if isinstance(ds, TableModel) else cls(ds)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i: int) -> dict[str, str]:
+        return self.rows[i]
+
+    def __iter__(self) -> Iterator[dict[str, str]]:
+        return iter(self.rows)
+
+    @property
+    def done(self) -> bool:
+        """Whether every row of the source is loaded."""
+        return self._more is None
+
+    @property
+    def width(self) -> int:
+        """The length of every line."""
+        return sum(self.widths) + len(self.widths) - 1
+
+    @property
+    def header(self) -> str:
+        return self._format(self.cols)
+
+    def _grow(self, rows: DS):
+        if rows and not self.cols:
+            self.cols = list(rows[0].keys())
+            self.widths = [len(c) for c in self.cols]
+        # a column at a time, max() over a generator is much faster than a loop over the rows
+        for n, c in enumerate(self.cols):
+            self.widths[n] = max(self.widths[n], max((len(r[c]) for r in rows), default=0))
+
+    def load(self, count: int | None = None) -> int:
+        """Pulls rows from the source until there are count of them, or all if count is None.
+
+        Returns how many rows were added.
+        """
+        if self._more is None or (count is not None and count <= len(self.rows)):
+            return 0
+        want = None if count is None else count - len(self.rows)
+        new = list(islice(self._more, want))
+        if want is None or len(new) < want:
+            self._more = None
+        self.rows += new
+        self._grow(new)
+        return len(new)
+
+    def _format(self, values: list[str]) -> str:
+        return "│".join(v + ' '*(self.widths[i]-len(v)) for i, v in enumerate(values))
+
+    def line(self, i: int) -> str:
+        """Row i as a table line. A value longer than its column widens it, and so every line."""
+        values = [self.rows[i][c] for c in self.cols]
+        for n, v in enumerate(values):
+            if len(v) > self.widths[n]:
+                self.widths[n] = len(v)
+        return self._format(values)
+
+
+class Viewport:
+    """[summary]
+    The selection and scroll offsets of a list shown in a window of rows x cols characters.
+
+    Moves wrap around at both ends. Every move returns the window lines that need repainting
+    (None for all of them), so the renderer leaves the rest of the screen alone.
+    """
+
+    def __init__(self, length: int, rows: int, cols: int, width: int):
+        self.length = length
+        self.rows = rows
+        self.cols = cols
+        self.width = width
+        self.sel = 0
+        self.sy = 0
+        self.sx = 0
+
+    @property
+    def max_sx(self) -> int:
+        return max(self.width - self.cols, 0)
+
+    def line(self, row: int) -> int | None:
+        """The window line a row is shown on, if it is visible."""
+        return row - self.sy if self.sy <= row < self.sy + self.rows else None
+
+    def visible(self) -> range:
+        return range(self.sy, min(self.sy + self.rows, self.length))
+
+    def select(self, sel: int) -> set[int] | None:
+        """Moves the selection to sel, scrolling as little as possible to keep it visible."""
+        old_sel, old_sy = self.sel, self.sy
+        if self.length == 0:
+            sel = 0
+        elif sel >= self.length:
+            sel = 0
+        elif sel < 0:
+            sel = self.length - 1
+        self.sel = sel
+        if self.sy + self.rows - 1 < sel:
+            self.sy = sel - self.rows + 1
+        if self.sy > sel:
+            self.sy = sel
+        if self.sy != old_sy:
+            return None
+        return {line for line in (self.line(old_sel), self.line(sel)) if line is not None}
+
+    def scroll_x(self, sx: int):
+        """Scrolls horizontally, wrapping at both ends. Pads take care of this without repainting."""
+        if sx > self.max_sx:
+            sx = 0
+        if sx < 0:
+            sx = self.max_sx
+        self.sx = sx
+
+    def resize(self, length: int, width: int):
+        self.length = length
+        self.width = width
+        self.scroll_x(min(self.sx, self.max_sx))
+
+
+def _trigrams(text: str) -> set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class FilterIndex:
+    """[summary]
+    A search index over the rows of a TableModel for filtering it as the user types.
+
+    Every row is kept as one lowercase string of its fields, each starting with a newline, so a
+    query matches inside a field but not across two. Substring matches are narrowed down from
+    the matches of the query typed so far. Fuzzy matches are looked up by the query's rarest
+    trigrams, so no trigram index has to be built up front.
+
+    Arguments:
+    model: the table to index
+    skip: columns that are not searched, like the selection marks
+    """
+
+    def __init__(self, model: TableModel, skip: tuple[str, ...] = ('*',)):
+        self.skip = skip
+        self.cols = model.cols
+        self.texts: list[str] = []
+        self._all: tuple[str, list[int]] | None = None
+        # (query, matching rows in table order) of the queries typed so far, each extending the last
+        self._stack: list[tuple[str, list[int]]] = []
+        self.sync(model)
+
+    def _text(self, row: dict[str, str]) -> str:
+        return ''.join('\n' + row[c].lower() for c in self.cols if c not in self.skip)
+
+    def sync(self, model: TableModel, changed: Iterable[int] = ()) -> bool:
+        """Reindexes the changed rows of model and indexes the rows loaded since the last sync.
+
+        Returns whether anything that is searched changed, and so whether a query needs to run again.
+        """
+        dirty = False
+        for i in changed:
+            if i < len(self.texts) and (text := self._text(model.rows[i])) != self.texts[i]:
+                self.texts[i] = text
+                dirty = True
+        if len(self.texts) != len(model):
+            del self.texts[len(model):]
+            self.texts += [self._text(r) for r in model.rows[len(self.texts):]]
+            dirty = True
+        # toggling a selection mark changes nothing that is searched
+        if dirty:
+            self._all = None
+            self._stack = []
+        return dirty
+
+    def _joined(self) -> tuple[str, list[int]]:
+        # all rows in one string and where each starts, str.count() and str.find() on it
+        # run over every row at C speed
+        if self._all is None:
+            self._all = ''.join(self.texts), list(accumulate((len(t) for t in self.texts), initial=0))
+        return self._all
+
+    def _fuzzy(self, query: str, exclude: set[int]) -> list[int]:
+        wanted = _trigrams('\n' + query)
+        need = ceil(MIN_SIMILARITY * len(wanted))
+        joined, starts = self._joined()
+        # a row with `need` of the trigrams has one of any len(wanted) - need + 1 of them,
+        # so the rows with one of the rarest that many are all the rows that can match
+        counts = {t: joined.count(t) for t in wanted}
+        rarest = sorted(wanted, key=counts.__getitem__)[:len(wanted) - need + 1]
+        if sum(counts[t] for t in rarest) > FUZZY_POSTINGS:
+            # too common to be a typo of anything in particular
+            return []
+        candidates: set[int] = set()
+        for t in rarest:
+            pos = joined.find(t)
+            while pos != -1:
+                candidates.add(bisect_right(starts, pos) - 1)
+                pos = joined.find(t, pos + 1)
+        scored = []
+        for i in candidates - exclude:
+            text = self.texts[i]
+            found = len([t for t in wanted if t in text])
+            if found >= need:
+                scored.append((-found, i))
+        return [i for _, i in heapq.nsmallest(FUZZY_LIMIT, scored)]
+
+    def match(self, query: str) -> list[int] | None:
+        """The rows matching query, best first, or None for an empty query.
+
+        Rows with the query at the start of a field come first, then at the start of a word, then
+        anywhere. Queries of four characters or more with few matches are followed by fuzzy
+        matches, ranked by how many of the query's trigrams the row has.
+        """
+        query = query.lower().strip()
+        if not query:
+            self._stack = []
+            return None
+        while self._stack and not query.startswith(self._stack[-1][0]):
+            self._stack.pop()
+        if self._stack and self._stack[-1][0] == query:
+            hits = self._stack[-1][1]
+        else:
+            candidates = self._stack[-1][1] if self._stack else range(len(self.texts))
+            texts = self.texts
+            hits = [i for i in candidates if query in texts[i]]
+            self._stack.append((query, hits))
+        # ranked in three buckets in one pass, a sort with a key function is twice as slow
+        field = '\n' + query
+        word = re.compile(f'[{re.escape(WORD_STARTS)}]{re.escape(query)}').search
+        buckets: tuple[list[int], list[int], list[int]] = ([], [], [])
+        for i in hits:
+            text = self.texts[i]
+            buckets[0 if field in text else 1 if word(text) else 2].append(i)
+        ranked = buckets[0] + buckets[1] + buckets[2]
+        if len(query) >= 4 and len(hits) < FUZZY_BELOW:
+            ranked += self._fuzzy(query, set(hits))
+        return ranked
@@ -0,0 +1,107 @@
+# LibCappy locale and keymap listings for the wizard.
+# Both are slow to produce (locale -av reads every locale, localectl walks the
+# keymap tree), so results are cached on disk until the underlying data changes.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+from typing import Callable, TypeVar
+
+from .common import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+CACHE_PATH = os.path.join(CACHE_DIR, 'wizard')
+
+LOCALE_HELPERS = [
+    os.path.join(os.path.dirname(__file__), 'parse_locales/target/release/cappy_parse_locales'),
+    '/usr/bin/cappy_parse_locales',
+]
+# what `locale -av` reads: the compiled archive and any locales compiled next to it
+LOCALE_SOURCES = ['/usr/lib/locale/locale-archive', '/usr/lib/locale']
+KEYMAP_DIRS = ['/usr/lib/kbd/keymaps', '/usr/share/kbd/keymaps']
+
+
+def _key(paths: list[str]) -> list[tuple[str, int]]:
+    key = []
+    for path in paths:
+        try:
+            key.append((path, os.stat(path).st_mtime_ns))
+        except OSError:
+            continue
+    return key
+
+
+def cached(name: str, sources: list[str], fn: Callable[[], T]) -> T:
+    """Returns fn(), cached in CACHE_PATH/name.json until the mtime of one of sources changes."""
+    key = [list(k) for k in _key(sources)]
+    path = os.path.join(CACHE_PATH, f'{name}.json')
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        if data['key'] == key:
+            return data['value']
+    except (OSError, ValueError, KeyError):
+        pass
+    value = fn()
+    try:
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'key': key, 'value': value}, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        # not being able to cache only makes the next start slower
+        logger.debug(f'Could not cache {name}: {e}')
+    return value
+
+
+def parse_locale_av(text: str) -> list[list[str]]:
+    """[code, title] pairs from the output of `locale -av`, like cappy_parse_locales prints them."""
+    return [[m[1], m[2]] for m in re.finditer(r'(?s)le: (\S+).+?le \| (.+?)\n', text)]
+
+
+def _locales() -> list[list[str]]:
+    for helper in LOCALE_HELPERS:
+        if os.path.exists(helper):
+            out = subprocess.run([helper], capture_output=True, text=True).stdout
+            return [line.split('|', 1) for line in out.splitlines() if '|' in line]
+    return parse_locale_av(subprocess.run(['locale', '-av'], capture_output=True, text=True).stdout)
+
+
+def _keymap_dir_names(dirs: list[str]) -> list[str]:
+    # what localectl list-keymaps does: every *.map(.gz) file outside of include/ directories
+    names = set()
+    for top in dirs:
+        for root, subdirs, files in os.walk(top):
+            subdirs[:] = [d for d in subdirs if d != 'include']
+            for f in files:
+                if (name := re.sub(r'\.map(\.gz|\.bz2|\.xz|\.zst)?$', '', f)) != f:
+                    names.add(name)
+    return sorted(names)
+
+
+def _keymaps() -> list[str]:
+    if shutil.which('localectl'):
+        out = subprocess.run(['localectl', 'list-keymaps', '--no-pager'], capture_output=True, text=True)
+        if out.returncode == 0:
+            return out.stdout.splitlines()
+    return _keymap_dir_names(KEYMAP_DIRS)
+
+
+def locales() -> list[list[str]]:
+    """The installable locales as [code, title] pairs."""
+    return cached('locales', LOCALE_SOURCES, _locales)
+
+
+def keymaps() -> list[str]:
+    """The names of the available console keymaps."""
+    # directory mtimes change when keymaps are added or removed anywhere below them
+    dirs = [root for top in KEYMAP_DIRS for root, _, _ in os.walk(top)]
+    return cached('keymaps', dirs or KEYMAP_DIRS, _keymaps)
@@ -0,0 +1,64 @@
+# LibCappy transaction lockfiles.
+# Records a resolved transaction as exact NEVRAs so later installs can skip the depsolve.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import logging
+import os
+from typing import Any
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+LOCK_VERSION = 1
+
+
+class Lockfile:
+    """[summary]
+    A YAML file holding the NEVRAs of a resolved transaction and the repo metadata it was resolved against.
+
+    The lock only applies while the package specs, the dnf options and every repo's repomd.xml
+    checksum are unchanged. Nothing in it depends on the host, so the same lock reproduces the same
+    install on any machine that sees the same repo metadata.
+
+    Arguments:
+    path: string, the lockfile path
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data: dict[str, Any] | None = None
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data = yaml.safe_load(f)
+
+    @staticmethod
+    def _state(specs: list[str], opts: dict[str, Any], checksums: dict[str, str | None]) -> dict[str, Any]:
+        return {
+            'version': LOCK_VERSION,
+            'specs': list(specs),
+            'dnf_options': {k: str(v) for k, v in (opts or {}).items()},
+            'repos': dict(sorted(checksums.items())),
+        }
+
+    def packages(self, specs: list[str], opts: dict[str, Any], checksums: dict[str, str | None]) -> list[str] | None:
+        """The locked NEVRAs, or None if the lock is missing or stale."""
+        if not self.data:
+            return None
+        state = {k: self.data.get(k) for k in ('version', 'specs', 'dnf_options', 'repos')}
+        if state != self._state(specs, opts, checksums):
+            logger.info(f'{self.path} is stale, resolving again')
+            return None
+        if None in checksums.values():
+            return None
+        return self.data['packages']
+
+    def write(self, specs: list[str], opts: dict[str, Any], checksums: dict[str, str | None], nevras: list[str]):
+        self.data = self._state(specs, opts, checksums)
+        self.data['packages'] = sorted(nevras)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write('# Generated by libcappy. Lists the exact packages installed for the specs below.\n')
+            yaml.safe_dump(self.data, f, sort_keys=False)
+        os.replace(tmp, self.path)
+        logger.info(f'Wrote {len(nevras)} packages to {self.path}')
@@ -0,0 +1,183 @@
+# LibCappy repository metadata loading.
+# One place that builds a dnf.Base, so Packages, the Wizard and the CLI share
+# the solv files and comps data dnf leaves on disk.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+import dnf
+import dnf.exceptions
+import dnf.repo
+
+from .common import METADATA_DIR
+from .trace import span
+
+logger = logging.getLogger(__name__)
+
+STAMP_FILE = 'cappy-metadata.json'
+
+
+@dataclass
+class LoadInfo:
+    """How a Metadata load went."""
+    key: str
+    seconds: float
+    from_cache: bool
+
+    def __str__(self):
+        return f'{self.seconds * 1000:.0f}ms ({"cached" if self.from_cache else "refreshed"}, {self.key[:12]})'
+
+
+class Metadata:
+    """[summary]
+    Loads repository metadata into a dnf.Base, reusing what earlier processes left on disk.
+
+    After a successful load, the repo configuration and the checksums of every repomd.xml are
+    recorded in the cachedir. Later loads with the same configuration within metadata_expire read
+    the solv files straight from the cache without contacting any mirror. Comps environments and
+    groups are cached as plain records under the same key.
+
+    Arguments:
+    installroot: string, the root to install into. None means the host
+    opts: dict, dnf options as in the `dnf_options` config section
+    cachedir: string, where metadata is kept (default: METADATA_DIR)
+    repos: list of dicts of repo options for extra repositories, e.g. {'id': 'local', 'baseurl': 'file:///srv/repo'}
+    system_repos: bool, whether to load the repos configured on the system
+    """
+
+    def __init__(self, installroot=None, opts=None, cachedir=None, repos=None, system_repos=True):
+        self.base = dnf.Base()
+        self.conf = self.base.conf
+        self.cachedir = cachedir or METADATA_DIR
+        self.conf.set_or_append_opt_value('cachedir', self.cachedir)
+        if installroot:
+            self.conf.set_or_append_opt_value('installroot', os.path.abspath(installroot))
+        for opt, value in (opts or {}).items():
+            match opt:
+                case 'arch' | 'basearch':
+                    self.conf.substitutions[opt] = value
+                case 'releasever':
+                    self.conf.substitutions['releasever'] = str(value)
+                case _:
+                    self.conf._set_value(opt, value)
+        if system_repos:
+            self.base.read_all_repos(opts=self.conf.substitutions)
+        for repo in repos or []:
+            repo = dict(repo)
+            if isinstance(repo.get('baseurl'), str):
+                repo['baseurl'] = [repo['baseurl']]
+            self.base.repos.add_new_repo(repo.pop('id'), self.conf, **repo)
+        self.info: LoadInfo | None = None
+        self.comps_info: LoadInfo | None = None
+
+    def close(self):
+        self.base.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def config_key(self) -> str:
+        """A digest of everything in the repo configuration that changes what metadata we get."""
+        h = hashlib.sha256()
+        h.update(json.dumps(sorted(self.conf.substitutions.items())).encode())
+        for repo in sorted(self.base.repos.iter_enabled(), key=lambda r: r.id):
+            h.update(json.dumps([repo.id, list(repo.baseurl), repo.metalink, repo.mirrorlist]).encode())
+        return h.hexdigest()
+
+    def repomd_checksums(self) -> dict[str, str | None]:
+        """sha256 of each enabled repo's cached repomd.xml, or None if it is not cached yet."""
+        sums: dict[str, str | None] = {}
+        for repo in self.base.repos.iter_enabled():
+            try:
+                with open(os.path.join(repo._repo.getCachedir(), 'repodata', 'repomd.xml'), 'rb') as f:
+                    sums[repo.id] = hashlib.sha256(f.read()).hexdigest()
+            except OSError:
+                sums[repo.id] = None
+        return sums
+
+    def key(self) -> str:
+        """The cache key: the repo configuration plus the metadata checksums."""
+        sums = self.repomd_checksums()
+        return hashlib.sha256((self.config_key() + json.dumps(sorted(sums.items()))).encode()).hexdigest()
+
+    def _stamps(self) -> dict:
+        try:
+            with open(os.path.join(self.cachedir, STAMP_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def fresh(self) -> bool:
+        """Whether the cached metadata for this configuration can be used without asking the mirrors."""
+        stamp = self._stamps().get(self.config_key())
+        if not stamp or stamp['key'] != self.key():
+            return False
+        expire = self.conf.metadata_expire
+        return expire < 0 or time.time() - stamp['time'] < expire
+
+    def fill(self) -> LoadInfo:
+        """Fills the sack, from the cache when it is fresh. Only does the work once."""
+        if self.info:
+            return self.info
+        with span('repo load') as attrs:
+            self.info = self._fill()
+            attrs['from_cache'] = self.info.from_cache
+        logger.info(f'Loaded repositories in {self.info}')
+        return self.info
+
+    def _fill(self) -> LoadInfo:
+        start = time.monotonic()
+        from_cache = self.fresh()
+        if from_cache:
+            for repo in self.base.repos.iter_enabled():
+                repo._repo.setSyncStrategy(dnf.repo.SYNC_ONLY_CACHE)
+            try:
+                self.base.fill_sack()
+            except dnf.exceptions.RepoError as e:
+                logger.warning(f'Cached metadata is unusable, refreshing: {e}')
+                from_cache = False
+                for repo in self.base.repos.iter_enabled():
+                    repo._repo.setSyncStrategy(dnf.repo.SYNC_TRY_CACHE)
+        if not from_cache:
+            self.base.fill_sack()
+            stamps = self._stamps()
+            stamps[self.config_key()] = {'key': self.key(), 'time': time.time()}
+            os.makedirs(self.cachedir, exist_ok=True)
+            with open(os.path.join(self.cachedir, STAMP_FILE), 'w') as f:
+                json.dump(stamps, f)
+        return LoadInfo(self.key(), time.monotonic() - start, from_cache)
+
+    def comps(self) -> tuple[list[dict[str, str]], list[dict[str, str]]]:
+        """Comps environments and groups as lists of {'id', 'name', 'description'} records.
+
+        Served from the on-disk cache without filling the sack when the metadata is fresh.
+        """
+        start = time.monotonic()
+        if self.fresh():
+            path = os.path.join(self.cachedir, f'cappy-comps-{self.key()}.json')
+            try:
+                with open(path) as f:
+                    envs, groups = json.load(f)
+                self.comps_info = LoadInfo(self.key(), time.monotonic() - start, True)
+                logger.info(f'Loaded comps in {self.comps_info}')
+                return envs, groups
+            except (OSError, ValueError):
+                pass
+        info = self.fill()
+        comps = self.base.comps
+        assert comps != None, "dnf.Base().comps failed miserably ;("  # might be None
+        envs = [{'id': env.id, 'name': env.ui_name, 'description': env.ui_description or ''} for env in comps.environments_iter()]
+        groups = [{'id': grp.id, 'name': grp.ui_name, 'description': grp.ui_description or ''} for grp in comps.groups_iter()]
+        with open(os.path.join(self.cachedir, f'cappy-comps-{self.key()}.json'), 'w') as f:
+            json.dump([envs, groups], f)
+        self.comps_info = LoadInfo(info.key, time.monotonic() - start, info.from_cache)
+        logger.info(f'Loaded comps in {self.comps_info}')
+        return envs, groups
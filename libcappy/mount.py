@@ -0,0 +1,299 @@
+# LibCappy mount engine.
+# Mounts the install's volumes with mount(2), parents before the volumes nested
+# in them and siblings in parallel, binds the host's API filesystems into the
+# root once, and unmounts everything in reverse when something fails.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+
+from .trace import span
+
+logger = logging.getLogger(__name__)
+
+# <sys/mount.h>
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_SYNCHRONOUS = 16
+MS_DIRSYNC = 128
+MS_NOATIME = 1024
+MS_NODIRATIME = 2048
+MS_BIND = 4096
+MS_REC = 16384
+MS_SILENT = 32768
+MS_RELATIME = 1 << 21
+MS_STRICTATIME = 1 << 24
+MS_LAZYTIME = 1 << 25
+MNT_DETACH = 2
+
+# mount(8) options the kernel takes as flags: option -> (flag, whether it sets or clears it)
+FLAGS: dict[str, tuple[int, bool]] = {
+    'ro': (MS_RDONLY, True), 'rw': (MS_RDONLY, False),
+    'nosuid': (MS_NOSUID, True), 'suid': (MS_NOSUID, False),
+    'nodev': (MS_NODEV, True), 'dev': (MS_NODEV, False),
+    'noexec': (MS_NOEXEC, True), 'exec': (MS_NOEXEC, False),
+    'sync': (MS_SYNCHRONOUS, True), 'async': (MS_SYNCHRONOUS, False),
+    'dirsync': (MS_DIRSYNC, True),
+    'noatime': (MS_NOATIME, True), 'atime': (MS_NOATIME, False),
+    'nodiratime': (MS_NODIRATIME, True), 'diratime': (MS_NODIRATIME, False),
+    'relatime': (MS_RELATIME, True), 'norelatime': (MS_RELATIME, False),
+    'strictatime': (MS_STRICTATIME, True),
+    'lazytime': (MS_LAZYTIME, True), 'nolazytime': (MS_LAZYTIME, False),
+    'silent': (MS_SILENT, True), 'loud': (MS_SILENT, False),
+    'bind': (MS_BIND, True), 'rbind': (MS_BIND | MS_REC, True),
+}
+# options only mount(8) and other fstab readers look at, the kernel rejects them
+USERSPACE = {'defaults', 'auto', 'noauto', 'user', 'nouser', 'users', 'owner', 'group', 'nofail', '_netdev'}
+USERSPACE_PREFIXES = ('x-', 'X-', 'comment=', 'helper=')
+
+# fstab device tags, resolved with libblkid like mount(8) does
+DEVICE_TAGS = {'UUID', 'LABEL', 'PARTUUID', 'PARTLABEL'}
+
+# host paths bound into the root for commands run with chroot: (host path, path in the root,
+# recursive). /dev and /sys are bound recursively so /dev/pts and efivarfs come along.
+API_FILESYSTEMS = [
+    ('/dev', 'dev', True),
+    ('/proc', 'proc', False),
+    ('/sys', 'sys', True),
+]
+# bound only around the chroot commands that need DNS: packages own the root's resolv.conf,
+# and a bind on it would be installed over, imaged and extracted onto
+RESOLV_CONF = '/etc/resolv.conf'
+
+
+def _load_libc() -> ctypes.CDLL | None:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+    libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
+    libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+    return libc
+
+
+_libc = _load_libc()
+
+
+@dataclass
+class Mount:
+    """One filesystem to mount, on an absolute host path."""
+    source: str
+    target: str
+    fstype: str = ''
+    options: str = ''
+    # recursive binds are detached when unmounted, their submounts would keep them busy
+    lazy: bool = False
+
+
+def parse_options(options: str) -> tuple[int, str]:
+    """Splits mount(8) options into mount(2) flags and the filesystem's own options.
+
+    Options only userspace understands, like noauto, nofail and x-systemd.*, are dropped.
+    """
+    flags = 0
+    data = []
+    for opt in filter(None, options.split(',')):
+        if opt in FLAGS:
+            flag, on = FLAGS[opt]
+            flags = flags | flag if on else flags & ~flag
+        elif opt not in USERSPACE and not opt.startswith(USERSPACE_PREFIXES):
+            data.append(opt)
+    return flags, ','.join(data)
+
+
+def resolve_device(spec: str) -> str:
+    """The device node of an fstab device: UUID=, LABEL=, PARTUUID= and PARTLABEL= tags or a path.
+
+    Tags are looked up with blkid, which probes the devices itself, so this works right after
+    mkfs and without udev, and for labels that udev would escape in /dev/disk/by-label.
+    """
+    tag, sep, value = spec.partition('=')
+    if not sep or tag not in DEVICE_TAGS:
+        return spec
+    value = value.strip('"')
+    proc = subprocess.run(['blkid', '-o', 'device', '-t', f'{tag}={value}'], capture_output=True, text=True)
+    devices = proc.stdout.split()
+    if proc.returncode != 0 or not devices:
+        raise OSError(errno.ENOENT, f'No device with {spec}')
+    return devices[0]
+
+
+def _under(path: str, parent: str) -> bool:
+    return path == parent or path.startswith(parent.rstrip('/') + '/')
+
+
+def levels(mounts: list[Mount]) -> list[list[Mount]]:
+    """Groups mounts by depth in the mountpoint tree.
+
+    A mount's level is one more than the deepest mount whose target contains its own, so every
+    level only needs the levels before it: /boot/efi comes after /boot, while /home and /var,
+    or /boot and /home, share a level. Mounts stacked on the same target keep their order.
+    """
+    placed: list[tuple[str, int]] = []
+    grouped: list[list[Mount]] = []
+    # fewer path components first, the sort is stable so stacked mounts stay in order
+    for m in sorted(mounts, key=lambda m: os.path.normpath(m.target).count('/')):
+        target = os.path.normpath(m.target)
+        level = max((lv + 1 for t, lv in placed if _under(target, t)), default=0)
+        placed.append((target, level))
+        if level == len(grouped):
+            grouped.append([])
+        grouped[level].append(m)
+    return grouped
+
+
+def _sys_mount(m: Mount):
+    flags, data = parse_options(m.options)
+    source = resolve_device(m.source)
+    if _libc is None or (m.fstype in ('', 'auto') and not flags & MS_BIND):
+        # mount(8) probes for the filesystem type
+        cmd = ['mount'] + (['-t', m.fstype] if m.fstype else []) + (['-o', m.options] if m.options else [])
+        proc = subprocess.run(cmd + [source, m.target], capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise OSError(errno.EINVAL, f'Could not mount {source} on {m.target}: {proc.stderr.strip()}')
+        return
+    fstype = m.fstype.encode() if m.fstype and not flags & MS_BIND else None
+    if _libc.mount(source.encode(), m.target.encode(), fstype, flags, data.encode() or None) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, f'Could not mount {source} on {m.target}: {os.strerror(err)}')
+
+
+def _sys_umount(m: Mount):
+    if _libc is None:
+        subprocess.run(['umount'] + (['-l'] if m.lazy else []) + [m.target], check=True, capture_output=True)
+        return
+    if _libc.umount2(m.target.encode(), MNT_DETACH if m.lazy else 0) == 0:
+        return
+    err = ctypes.get_errno()
+    if err == errno.EBUSY:
+        logger.warning(f'{m.target} is busy, detaching it')
+        if _libc.umount2(m.target.encode(), MNT_DETACH) == 0:
+            return
+        err = ctypes.get_errno()
+    if err != errno.EINVAL:  # EINVAL: not mounted anymore
+        raise OSError(err, f'Could not unmount {m.target}: {os.strerror(err)}')
+
+
+class MountTable:
+    """[summary]
+    The filesystems mounted under an install root, kept so they can be unmounted in reverse.
+
+    mount_all() mounts the volumes level by level down the mountpoint tree, the volumes of a
+    level in parallel, creating each mountpoint once its parent is mounted. If a mount fails,
+    everything mounted so far is unmounted again, nested volumes first, and the error raised.
+
+    bind_api() binds the host's /dev, /proc and /sys into the root once, for everything run in
+    it with chroot. Paths something else already mounted are left alone. resolv() binds the
+    host's resolv.conf for the duration of a block.
+
+    Arguments:
+    root: string, the directory the install is mounted on
+    workers: int, how many volumes are mounted at once
+    """
+
+    def __init__(self, root: str, workers: int = 8):
+        self.root = root
+        self.workers = workers
+        self.mounted: list[Mount] = []
+        self.api: list[Mount] = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is not None:
+            self.unmount_all()
+
+    def path(self, mountpoint: str) -> str:
+        return os.path.normpath(os.path.join(self.root, mountpoint.lstrip('/')))
+
+    def volumes(self, table: list[dict]) -> list[Mount]:
+        """Mounts for cfgparse.fstab() entries. Swap and other entries without a mountpoint are skipped."""
+        return [Mount(str(e['device']), self.path(str(e['mountpoint'])), str(e.get('filesystem', '')), str(e.get('opts', '')))
+                for e in table if str(e['mountpoint']).startswith('/') and e.get('filesystem') != 'swap']
+
+    def mount(self, m: Mount):
+        os.makedirs(m.target, exist_ok=True)
+        with span('mount', target=m.target, device=m.source):
+            _sys_mount(m)
+        with self._lock:
+            self.mounted.append(m)
+
+    def mount_all(self, mounts: list[Mount]):
+        try:
+            for level in levels(mounts):
+                if len(level) == 1:
+                    self.mount(level[0])
+                    continue
+                # the pool waits for every mount of the level, so the ones that did succeed are
+                # all recorded before a failure is raised
+                with ThreadPoolExecutor(min(self.workers, len(level))) as pool:
+                    list(pool.map(self.mount, level))
+        except BaseException:
+            self.unmount_all()
+            raise
+
+    def bind_api(self):
+        if self.api:
+            return
+        try:
+            for host, inside, recursive in API_FILESYSTEMS:
+                target = self.path(inside)
+                if not os.path.exists(host) or os.path.ismount(target):
+                    logger.debug(f'Not binding {host} on {target}')
+                    continue
+                os.makedirs(target, exist_ok=True)
+                m = Mount(host, target, options='rbind' if recursive else 'bind', lazy=recursive)
+                _sys_mount(m)
+                self.api.append(m)
+        except BaseException:
+            self.unmount_api()
+            raise
+
+    @contextmanager
+    def resolv(self) -> Iterator[bool]:
+        """Binds the host's resolv.conf over the root's for the block. Yields whether it did.
+
+        Only a regular file is bound over: a missing one is not created, and a symlink, such as
+        systemd-resolved's into /run, is left alone.
+        """
+        target = self.path(RESOLV_CONF)
+        if not os.path.isfile(RESOLV_CONF) or os.path.islink(target) or not os.path.isfile(target):
+            logger.debug(f'Not binding {RESOLV_CONF} on {target}')
+            yield False
+            return
+        m = Mount(RESOLV_CONF, target, options='bind')
+        _sys_mount(m)
+        try:
+            yield True
+        finally:
+            self._unmount([m])
+
+    def _unmount(self, mounts: list[Mount]):
+        # failures are logged, not raised, so as much as possible is unmounted
+        while mounts:
+            m = mounts.pop()
+            try:
+                _sys_umount(m)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.warning(f'{e}')
+
+    def unmount_api(self):
+        self._unmount(self.api)
+
+    def unmount_all(self):
+        """Unmounts the API binds, then the volumes in reverse."""
+        self._unmount(self.api)
+        self._unmount(self.mounted)
@@ -0,0 +1,133 @@
+# LibCappy systemd-nspawn sessions.
+# Boots the chroot container once and streams commands into a single shell,
+# instead of paying for a fresh container on every Installer.nspawn() call.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import logging
+import subprocess
+import threading
+import uuid
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+NSPAWN_ARGS = [
+    'systemd-nspawn',
+    '--quiet',
+    '--capability=CAP_SYS_ADMIN,CAP_SYS_RAWIO',
+]
+# the session's shell reads its commands from a pipe: without a TTY on stdin, nspawn would
+# otherwise default to --console=read-only and the shell would never see them
+SESSION_ARGS = ['--pipe']
+
+
+@dataclass
+class NspawnResult:
+    """The outcome of a single command run inside the chroot."""
+    command: str
+    returncode: int
+    output: str
+
+
+class NspawnSession:
+    """[summary]
+    A long-lived systemd-nspawn container running one shell.
+
+    Commands are written to the shell's stdin wrapped in markers, so every
+    command gets its own exit code and output even though they share a
+    container. Independent commands are started as background jobs and are
+    collected the next time a dependent command runs, or on wait().
+
+    Arguments:
+    chroot_path: string, the root directory of the container
+    """
+
+    def __init__(self, chroot_path: str):
+        self.chroot_path = chroot_path
+        self.token = f'__CAPPY_{uuid.uuid4().hex}__'
+        self.results: list[NspawnResult] = []
+        self.proc: subprocess.Popen[str] | None = None
+        self._pending: dict[int, str] = {}
+        self._next = 0
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def start(self):
+        logger.debug(f'Starting nspawn session on {self.chroot_path}')
+        self.proc = subprocess.Popen(
+            NSPAWN_ARGS + SESSION_ARGS + ['-D', self.chroot_path, '/bin/bash', '--noprofile', '--norc', '-s'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+        )
+
+    def _send(self, script: str):
+        assert self.proc and self.proc.stdin, 'nspawn session is not running'
+        self.proc.stdin.write(script)
+        self.proc.stdin.flush()
+
+    def _collect(self, n: int, command: str) -> NspawnResult:
+        """Reads stdout until the end marker of command n shows up."""
+        assert self.proc and self.proc.stdout, 'nspawn session is not running'
+        output: list[str] = []
+        for line in self.proc.stdout:
+            if line.startswith(self.token):
+                _, num, rc = line.split()
+                assert int(num) == n, f'nspawn session out of sync: expected {n}, got {num}'
+                # drop the newline we printed in front of the marker
+                result = NspawnResult(command, int(rc), ''.join(output)[:-1])
+                self.results.append(result)
+                if result.returncode != 0:
+                    logger.warning(f'Command "{command}" exited with {result.returncode}')
+                return result
+            output.append(line)
+        raise RuntimeError(f'nspawn session on {self.chroot_path} exited while running "{command}"')
+
+    def run(self, command: str) -> NspawnResult:
+        """Runs a command and waits for it, after any outstanding independent commands."""
+        with self._lock:
+            self.wait()
+            n = self._next
+            self._next += 1
+            self._send(f"( {command}\n) </dev/null 2>&1; printf '\\n%s %d %d\\n' {self.token} {n} $?\n")
+            return self._collect(n, command)
+
+    def submit(self, command: str):
+        """Starts a command in the background; its result is collected by wait()."""
+        with self._lock:
+            n = self._next
+            self._next += 1
+            self._pending[n] = command
+            self._send(f"( {command}\n) </dev/null >/tmp/{self.token}{n}.log 2>&1 & pid{n}=$!\n")
+
+    def wait(self) -> list[NspawnResult]:
+        """Waits for every background command and returns their results in submission order."""
+        with self._lock:
+            results: list[NspawnResult] = []
+            for n, command in self._pending.items():
+                log = f'/tmp/{self.token}{n}.log'
+                self._send(f"wait $pid{n}; rc=$?; cat {log}; rm -f {log}; printf '\\n%s %d %d\\n' {self.token} {n} $rc\n")
+                results.append(self._collect(n, command))
+            self._pending.clear()
+            return results
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.wait()
+            self._send('exit 0\n')
+        finally:
+            assert self.proc.stdin
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+            logger.debug(f'Closed nspawn session on {self.chroot_path}')
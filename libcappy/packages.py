@@ -1,52 +1,254 @@
 import dnf
 import os
+import queue
+import threading
+import time
+from dataclasses import dataclass
 import dnf.cli.progress
 import dnf.callback
 import dnf.cli.output
+import hawkey
 import logging
+import rpm
+from .cache import PackageCache
+from .metadata import Metadata
+from .trace import span
 logger = logging.getLogger(__name__)
+@dataclass
+class PipelineStats:
+    # timings of a pipelined install, in seconds
+    batches: int = 0
+    download_time: float = 0.0
+    install_time: float = 0.0
+    wall_time: float = 0.0
+    @property
+    def overlap_time(self) -> float:
+        # time during which a download and an rpm transaction ran at the same time
+        return max(self.download_time + self.install_time - self.wall_time, 0.0)
+def strongly_connected(graph: list[list[int]]) -> list[list[int]]:
+    # Tarjan's algorithm, iterative. Components come out dependencies first,
+    # which for an edge "package -> its requirement" is exactly install order.
+    index = [-1] * len(graph)
+    low = [0] * len(graph)
+    onstack = [False] * len(graph)
+    stack: list[int] = []
+    sccs: list[list[int]] = []
+    counter = 0
+    for root in range(len(graph)):
+        if index[root] >= 0:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        onstack[root] = True
+        work = [(root, iter(graph[root]))]
+        while work:
+            v, it = work[-1]
+            for w in it:
+                if index[w] < 0:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    onstack[w] = True
+                    work.append((w, iter(graph[w])))
+                    break
+                if onstack[w]:
+                    low[v] = min(low[v], index[w])
+            else:
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+                if low[v] == index[v]:
+                    scc: list[int] = []
+                    while True:
+                        w = stack.pop()
+                        onstack[w] = False
+                        scc.append(w)
+                        if w == v:
+                            break
+                    sccs.append(scc)
+    return sccs
 class Packages:
     # class for managing packages via DNF
     # Simply macros to quickly call DNF functions without writing long transactions manually.
-    def __init__(self, installroot=None, opts=None):
-        self.dnf = dnf.Base()
+    def __init__(self, installroot=None, opts=None, cache: PackageCache | None = None, repos: list[dict] | None = None, system_repos: bool = True):
+        # repos: extra repositories as dicts of repo options, e.g. {'id': 'local', 'baseurl': 'file:///srv/repo'}
+        # system_repos: whether to also load the repos configured on the system
+        self.metadata = Metadata(installroot, opts, cachedir=cache.metadata_dir if cache else None, repos=repos, system_repos=system_repos)
+        self.dnf = self.metadata.base
         self.conf = self.dnf.conf
+        self.cache = cache
         self.transdisplay = dnf.cli.output.CliTransactionDisplay()
         self.downprogress = dnf.cli.progress.MultiFileProgressMeter()
         if installroot:
             self.chroot = os.path.abspath(installroot)
-            self.conf.set_or_append_opt_value('installroot', self.chroot)
-            self.conf.set_or_append_opt_value('cachedir', os.path.join(self.chroot, 'var/cache/dnf'))
+            # repo metadata stays on the host, only the RPMs go into the chroot
+            for repo in self.dnf.repos.iter_enabled():
+                repo.pkgdir = os.path.join(self.chroot, 'var/cache/dnf', repo.id, 'packages')
         else:
             self.chroot = os.path.abspath(os.sep)
-        if opts:
-            for opt in opts:
-                match opt:
-                    case 'arch':
-                        self.conf.substitutions['arch'] = opts[opt]
-                    case 'releasever':
-                        self.conf.substitutions['releasever'] = str(opts[opt])
-                    case 'basearch':
-                        self.conf.substitutions['basearch'] = opts[opt]
-                    case _:
-                        self.conf._set_value(opt, opts[opt])
-        # load the new configuration
-        self.dnf.read_all_repos(opts=self.conf.substitutions)
-        #print(self.dnf._repos)
         #self.dnf.setup_loggers()
         logger.info('Loading Repositories...')
-        self.dnf.fill_sack()
-    def install(self, pkgs: list):
+        self.load_info = self.metadata.fill()
+    def install(self, pkgs: list, pipeline: bool = False, batch_size: int = 200, parallel_downloads: int | None = None):
         # install a list of packages
-        self.dnf.install_specs(pkgs)
-        try:
-            self.dnf.resolve(allow_erasing=True)
-        except dnf.exceptions.DepsolveError as e:
-            logger.error(f'Transaction resolution failed: {e}')
+        if not self.resolve(pkgs):
             return False
-        self.dnf.download_packages(self.dnf.transaction.install_set, self.downprogress)
+        return self.transact(pipeline, batch_size, parallel_downloads)
+    def resolve(self, pkgs: list) -> bool:
+        # resolve the transaction for installing a list of packages without running it
+        with span('depsolve', specs=len(pkgs)) as attrs:
+            self.dnf.install_specs(pkgs)
+            try:
+                self.dnf.resolve(allow_erasing=True)
+            except dnf.exceptions.DepsolveError as e:
+                logger.error(f'Transaction resolution failed: {e}')
+                return False
+            attrs['packages'] = len(self.dnf.transaction.install_set)
+        return True
+    def resolved_nevras(self) -> list[str]:
+        # the NEVRAs the resolved transaction installs, sorted
+        return sorted(str(pkg) for pkg in self.dnf.transaction.install_set)
+    def locked_packages(self, nevras: list[str]) -> list | None:
+        # look up exact NEVRAs, e.g. from a lockfile. None if any of them is not available anymore
+        pkgs = self.dnf.sack.query().available().filterm(nevra_strict=nevras).run()
+        if len(pkgs) != len(set(nevras)):
+            return None
+        return pkgs
+    def transact(self, pipeline: bool = False, batch_size: int = 200, parallel_downloads: int | None = None, pkgs: list | None = None):
+        # download and install the resolved transaction.
+        # pkgs installs an exact package set instead, without a depsolve; those always go through librpm.
+        if pkgs is not None:
+            if pipeline:
+                return self.pipeline_install(pkgs, batch_size, parallel_downloads)
+            self.download(pkgs, self.downprogress)
+            return self.rpm_install(pkgs)
+        if pipeline:
+            return self.pipeline_install(self.dnf.transaction.install_set, batch_size, parallel_downloads)
+        self.download(self.dnf.transaction.install_set, self.downprogress)
         # Yes, we're stealing the progress bar from dnf's CLI.
-        self.dnf.do_transaction(self.transdisplay)
+        with span('rpm transaction', packages=len(self.dnf.transaction.install_set)):
+            self.dnf.do_transaction(self.transdisplay)
+    def download(self, pkgs, progress=None):
+        # download packages, serving whatever we can from the shared package cache first
+        pkgs = list(pkgs)
+        if self.cache:
+            for pkg in pkgs:
+                if checksum := self._checksum(pkg):
+                    self.cache.fetch(checksum, pkg.localPkg())
+        # only what the cache did not have goes over the network
+        size = sum(pkg.downloadsize or 0 for pkg in pkgs if not os.path.exists(pkg.localPkg()))
+        with span('download', packages=len(pkgs), bytes=size) as attrs:
+            start = time.monotonic()
+            self.dnf.download_packages(pkgs, progress)
+            attrs['throughput'] = size / max(time.monotonic() - start, 1e-6)
+        if self.cache:
+            for pkg in pkgs:
+                if checksum := self._checksum(pkg):
+                    self.cache.store(checksum, pkg.localPkg())
+            self.cache.evict()
+            logger.info(f'Package cache: {self.cache.stats}')
+    @staticmethod
+    def _checksum(pkg) -> str | None:
+        if not pkg.chksum:
+            return None
+        algo, digest = pkg.chksum
+        return f'{hawkey.chksum_name(algo)}:{digest.hex()}'
+    def dependency_batches(self, pkgs, batch_size: int = 200) -> list[list]:
+        # split packages into batches so that everything a batch requires is in it or in an earlier one.
+        # dependency cycles always stay inside one batch.
+        pkgs = list(pkgs)
+        index = {pkg: i for i, pkg in enumerate(pkgs)}
+        q = self.dnf.sack.query().filterm(pkg=pkgs)
+        graph = [[index[dep] for dep in q.filter(provides=pkg.requires) if dep != pkg] if pkg.requires else [] for pkg in pkgs]
+        batches: list[list] = [[]]
+        for scc in strongly_connected(graph):
+            if len(batches[-1]) >= batch_size:
+                batches.append([])
+            batches[-1].extend(pkgs[i] for i in scc)
+        return [b for b in batches if b]
+    def pipeline_install(self, pkgs, batch_size: int = 200, parallel_downloads: int | None = None) -> PipelineStats:
+        # Download batch N+1 while batch N goes through rpm.
+        # Each batch is its own rpm transaction, run straight through librpm against the installroot.
+        if parallel_downloads:
+            self.conf.max_parallel_downloads = parallel_downloads
+        batches = self.dependency_batches(pkgs, batch_size)
+        stats = PipelineStats(batches=len(batches))
+        logger.info(f'Installing {sum(map(len, batches))} packages in {len(batches)} batches')
+        # at most one downloaded batch waits for the installer at any time
+        ready: queue.Queue = queue.Queue(maxsize=1)
+        # set when the installer stops, so the downloader does not start on batches nobody installs
+        cancel = threading.Event()
+        def downloader():
+            try:
+                for batch in batches:
+                    if cancel.is_set():
+                        return
+                    start = time.monotonic()
+                    self.download(batch, dnf.callback.NullDownloadProgress())
+                    stats.download_time += time.monotonic() - start
+                    ready.put(batch)
+            except BaseException as e:
+                ready.put(e)
+        start = time.monotonic()
+        thread = threading.Thread(target=downloader, name='cappy-download', daemon=True)
+        thread.start()
+        try:
+            for n in range(len(batches)):
+                batch = ready.get()
+                if isinstance(batch, BaseException):
+                    raise batch
+                logger.info(f'Installing batch {n + 1}/{len(batches)} ({len(batch)} packages)')
+                t = time.monotonic()
+                self.rpm_install(batch)
+                stats.install_time += time.monotonic() - t
+        finally:
+            cancel.set()
+            # a downloader blocked on a full queue can hand over its batch and see the cancel
+            try:
+                ready.get_nowait()
+            except queue.Empty:
+                pass
+            thread.join()
+        stats.wall_time = time.monotonic() - start
+        logger.info(f'Pipelined install took {stats.wall_time:.1f}s: download {stats.download_time:.1f}s, '
+                    f'rpm {stats.install_time:.1f}s, overlapped {stats.overlap_time:.1f}s')
+        return stats
+    def rpm_install(self, pkgs):
+        # install already downloaded packages into the installroot in a single rpm transaction.
+        # This goes around dnf.Base.do_transaction, so the installed system's dnf history has no
+        # entry for these packages; the rpmdb has them all.
+        with span('rpm transaction', packages=len(pkgs)):
+            self._rpm_install(pkgs)
+    def _rpm_install(self, pkgs):
+        ts = rpm.TransactionSet(self.chroot)
+        for pkg in pkgs:
+            fd = os.open(pkg.localPkg(), os.O_RDONLY)
+            try:
+                ts.addInstall(ts.hdrFromFdno(fd), pkg.localPkg(), 'u')
+            finally:
+                os.close(fd)
+        if problems := ts.check():
+            raise dnf.exceptions.TransactionCheckError(f'rpm transaction check failed: {problems}')
+        ts.order()
+        files: dict[str, int] = {}
+        failed: list[str] = []
+        def callback(what, amount, total, key, data):
+            if what == rpm.RPMCALLBACK_INST_OPEN_FILE:
+                files[key] = os.open(key, os.O_RDONLY)
+                return files[key]
+            elif what == rpm.RPMCALLBACK_INST_CLOSE_FILE:
+                os.close(files.pop(key))
+            elif what in (rpm.RPMCALLBACK_UNPACK_ERROR, rpm.RPMCALLBACK_CPIO_ERROR):
+                failed.append(str(key))
+            elif what == rpm.RPMCALLBACK_SCRIPT_ERROR:
+                # like dnf, a failed scriptlet is a warning, not a failed transaction
+                logger.warning(f'A scriptlet of {key} failed')
+        # None on success, a (possibly empty) list when some elements failed
+        errors = ts.run(callback, '')
+        if errors is not None or failed:
+            raise dnf.exceptions.Error(f'rpm transaction failed: {errors or failed}')
     def remove(self, pkgs: list):
         # remove a list of packages
         for pkg in pkgs:
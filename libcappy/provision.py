@@ -0,0 +1,180 @@
+# LibCappy disk provisioning.
+# Partitions disks and creates the filesystems of install volumes, every device
+# as soon as the disk it is on is partitioned, and fills in the new UUIDs.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import Any
+
+from .scheduler import Scheduler
+from .trace import span
+
+logger = logging.getLogger(__name__)
+
+# mkfs per filesystem: (command, label flag, UUID flag). The commands overwrite whatever
+# filesystem was on the device before.
+MKFS: dict[str, tuple[list[str], str | None, str | None]] = {
+    'ext2': (['mkfs.ext2', '-F', '-q'], '-L', '-U'),
+    'ext3': (['mkfs.ext3', '-F', '-q'], '-L', '-U'),
+    'ext4': (['mkfs.ext4', '-F', '-q'], '-L', '-U'),
+    'xfs': (['mkfs.xfs', '-f', '-q'], '-L', None),
+    'btrfs': (['mkfs.btrfs', '-f', '-q'], '-L', '-U'),
+    'vfat': (['mkfs.vfat'], '-n', None),
+    'swap': (['mkswap', '-f'], '-L', '-U'),
+}
+# how long to wait for the partition device nodes after partitioning
+PARTITION_TIMEOUT = 10.0
+
+
+def partition_path(disk: str, number: int) -> str:
+    """The device node of a partition: /dev/vda1, but /dev/nvme0n1p1 and /dev/loop0p1."""
+    return f'{disk}p{number}' if disk[-1].isdigit() else f'{disk}{number}'
+
+
+def sfdisk_script(disk: dict[str, Any]) -> str:
+    """An sfdisk script for a provision.disks entry. A partition without a size takes the rest of the disk."""
+    lines = [f"label: {disk.get('table', 'gpt')}"]
+    for part in disk.get('partitions', []):
+        fields = [f"size={part['size']}"] if part.get('size') else []
+        fields.append(f"type={part.get('type', 'linux')}")
+        if part.get('name'):
+            fields.append(f'name="{part["name"]}"')
+        lines.append(', '.join(fields))
+    return '\n'.join(lines) + '\n'
+
+
+def mkfs_command(filesystem: str, device: str, label: str | None = None, uuid: str | None = None,
+                 options: str | list[str] = '') -> list[str]:
+    """The command creating a filesystem, with the label and UUID set if mkfs can set them."""
+    cmd, label_flag, uuid_flag = MKFS.get(filesystem, ([f'mkfs.{filesystem}'], None, None))
+    cmd = list(cmd)
+    if label and label_flag:
+        cmd += [label_flag, label]
+    if uuid and uuid_flag:
+        cmd += [uuid_flag, uuid]
+    cmd += shlex.split(options) if isinstance(options, str) else options
+    return cmd + [device]
+
+
+def blkid_uuid(device: str) -> str:
+    # probe the device itself, the blkid cache does not know the new filesystem yet
+    return subprocess.run(['blkid', '-p', '-s', 'UUID', '-o', 'value', device],
+                          capture_output=True, text=True, check=True).stdout.strip()
+
+
+def _run(cmd: list[str], stdin: str | None = None):
+    proc = subprocess.run(cmd, input=stdin, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f'{shlex.join(cmd)} failed: {proc.stderr.strip()}')
+
+
+class Provisioner:
+    """[summary]
+    Partitions the disks of `provision.disks` and creates the filesystems of the volumes marked
+    `format: true`, then fills in the volumes' `uuid` so CfgParser.fstab() mounts them by UUID.
+
+    Every disk and every filesystem is a Scheduler step: a filesystem waits only for the disk
+    it is on, so filesystems on different devices are created at the same time. Volumes that
+    share a device, like btrfs subvolumes, share its one filesystem, and the subvolumes their
+    subvol= options name are created in it. report() has the time each device took.
+
+    Arguments:
+    volumes: the install's `volumes` entries, updated in place
+    disks: the `provision.disks` entries, each a device, a partition table type and partitions
+    max_workers: int, how many devices are worked on at once (default: all of them)
+    """
+
+    def __init__(self, volumes: list[dict[str, Any]], disks: list[dict[str, Any]] | None = None,
+                 max_workers: int | None = None):
+        self.volumes = volumes
+        self.disks = disks or []
+        self.sched = Scheduler(max_workers)
+        self.uuids: dict[str, str] = {}
+
+    def _devices(self) -> dict[str, list[dict[str, Any]]]:
+        # the volumes to format by device, in config order
+        devices: dict[str, list[dict[str, Any]]] = {}
+        for volume in self.volumes:
+            if volume.get('format'):
+                if 'device' not in volume:
+                    raise ValueError(f"Volume {volume.get('mountpoint')} has format set but no device")
+                devices.setdefault(volume['device'], []).append(volume)
+        for device, volumes in devices.items():
+            if len({v['filesystem'] for v in volumes}) > 1:
+                raise ValueError(f'Volumes on {device} have different filesystems')
+        return devices
+
+    def plan(self) -> Scheduler:
+        """Adds a step per disk and per device to format, each filesystem after its disk's partitioning."""
+        disk_of: dict[str, str] = {}
+        for disk in self.disks:
+            name = f"partition {disk['device']}"
+            self.sched.add(name, lambda disk=disk: self.partition(disk))
+            disk_of[disk['device']] = name
+            for n in range(1, len(disk.get('partitions', [])) + 1):
+                disk_of[partition_path(disk['device'], n)] = name
+        for device, volumes in self._devices().items():
+            deps = [disk_of[device]] if device in disk_of else []
+            self.sched.add(f'mkfs {device}', lambda device=device, volumes=volumes: self.format(device, volumes), deps)
+        return self.sched
+
+    def partition(self, disk: dict[str, Any]):
+        device = disk['device']
+        with span('partition', device=device):
+            _run(['sfdisk', '--quiet', '--wipe', 'always', device], sfdisk_script(disk))
+            parts = [partition_path(device, n) for n in range(1, len(disk.get('partitions', [])) + 1)]
+            if shutil.which('udevadm'):
+                subprocess.run(['udevadm', 'settle'], capture_output=True)
+            deadline = time.monotonic() + PARTITION_TIMEOUT
+            while not all(os.path.exists(p) for p in parts):
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'The partitions of {device} did not show up')
+                # loop devices and some kernels need the partitions added by hand
+                subprocess.run(['partx', '-u', device], capture_output=True)
+                time.sleep(0.1)
+
+    def format(self, device: str, volumes: list[dict[str, Any]]):
+        first = volumes[0]
+        filesystem = first['filesystem']
+        with span('mkfs', device=device, filesystem=filesystem):
+            _run(mkfs_command(filesystem, device, first.get('label'), first.get('uuid'), first.get('mkfs_options', '')))
+            uuid = blkid_uuid(device)
+        if first.get('uuid') and first['uuid'] != uuid:
+            logger.warning(f"mkfs.{filesystem} can not set the UUID {first['uuid']} of {device}, it is {uuid}")
+        if filesystem == 'btrfs':
+            self.subvolumes(device, volumes)
+        for volume in volumes:
+            volume['uuid'] = uuid
+        self.uuids[device] = uuid
+        logger.info(f'Created {filesystem} on {device}: UUID={uuid}')
+
+    @staticmethod
+    def subvolumes(device: str, volumes: list[dict[str, Any]]):
+        """Creates the subvolumes named by the subvol= options of the volumes on a new btrfs."""
+        names = [opt.split('=', 1)[1].strip('/') for v in volumes for opt in str(v.get('opts', '')).split(',')
+                 if opt.startswith('subvol=')]
+        if not names:
+            return
+        with tempfile.TemporaryDirectory(prefix='cappy-btrfs-') as top:
+            _run(['mount', '-t', 'btrfs', device, top])
+            try:
+                for name in names:
+                    _run(['btrfs', 'subvolume', 'create', os.path.join(top, name)])
+            finally:
+                _run(['umount', top])
+
+    def run(self) -> dict[str, str]:
+        """Partitions and formats everything. Returns the new UUIDs by device."""
+        if not self.sched.steps:
+            self.plan()
+        self.sched.run()
+        return self.uuids
+
+    def report(self) -> str:
+        return self.sched.report()
@@ -1,16 +1,45 @@
+import asyncio
+import bz2
+import configparser
+import contextlib
+import gzip
+import hashlib
+import lzma
 import os
-import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import json
 import platform
 import logging
+import random
+from collections import deque
+from typing import AsyncIterator
+from urllib.parse import urlencode
+from .cache import place
+from .common import CACHE_DIR
+from .httpcache import CachingAdapter, HTTPCache
 logger = logging.getLogger(__name__)
+COPR_URL = 'https://copr.fedorainfracloud.org'
+# where the host side keeps the keys of Copr repos added to an installroot
+COPR_KEY_DIR = os.path.join(CACHE_DIR, 'copr-keys')
+class CoprError(Exception):
+    # raised when the Copr API cannot be reached or answers with an error
+    pass
+class _Retry(CoprError):
+    # a response worth retrying: rate limited or a server error
+    pass
 # Copr repo management for libcappy.
 # This is essentially a wrapper around the Copr API so that we can actually easily manage Copr repos.
 class Copr:
-    def __init__(self):
+    def __init__(self, cache: HTTPCache | None = None):
+        # cache: keep responses on disk and revalidate them instead of fetching them again
         self.request = requests.Session()
+        self.cache = cache
+        if cache:
+            adapter = CachingAdapter(cache)
+            self.request.mount('https://', adapter)
+            self.request.mount('http://', adapter)
     def list_projects(self,page_amount=100,page=1,copr_url='https://copr.fedorainfracloud.org', search:str =None):
         """[summary]
         Lists copr repos as a list of dictionaries.
@@ -38,7 +67,7 @@ class Copr:
             response.raise_for_status()
             return response.json()['projects']
         except requests.exceptions.HTTPError as e:
-            print(e)
+            raise CoprError(f'Could not list Copr projects: {e}') from e
     def get_repo(self, copr, chroot, copr_url='https://copr.fedorainfracloud.org'):
         """[summary]
         Fetches the Copr repo file from Copr
@@ -67,11 +96,336 @@ class Copr:
         return response.text
 
 
+class AsyncCopr:
+    """[summary]
+    asyncio client for the Copr API.
+
+    Requests share one pool of keep-alive connections, at most `concurrency` of them run at a
+    time, and failed requests (connection errors, 429 and 5xx) are retried with exponential
+    backoff. Use it as an async context manager.
+
+    Arguments:
+    copr_url: string, the Copr API URL
+    concurrency: int, the maximum number of requests in flight
+    retries: int, how many times a failed request is retried
+    backoff: float, the delay before the first retry in seconds, doubled for every further one
+    timeout: float, the total timeout of a single request in seconds
+    """
+
+    def __init__(self, copr_url=COPR_URL, concurrency=8, retries=3, backoff=0.5, timeout=30, cache: HTTPCache | None = None):
+        self.copr_url = copr_url
+        self.cache = cache
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = None
+
+    async def __aenter__(self):
+        # aiohttp is only needed by the async client, keep it off the import path of everything else
+        import aiohttp
+        self._aiohttp = aiohttp
+        self._sem = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *_):
+        await self.session.close()
+        self.session = None
+
+    async def _get(self, path, params=None, json_body=True):
+        assert self.session, 'AsyncCopr must be used as an async context manager'
+        url = self.copr_url + path + ('?' + urlencode(params) if params else '')
+        body = await self._fetch(url)
+        return json.loads(body) if json_body else body.decode()
+
+    async def _fetch(self, url) -> bytes:
+        # the HTTPCache logic of CachingAdapter, for aiohttp
+        cached = self.cache.get(url) if self.cache else None
+        headers = {}
+        if cached:
+            if self.cache.fresh(cached[0]):
+                self.cache.stats.hits += 1
+                return cached[1]
+            headers = self.cache.conditional_headers(cached[0])
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._sem, self.session.get(url, headers=headers) as response:
+                    if response.status == 304 and cached:
+                        self.cache.stats.revalidations += 1
+                        self.cache.touch(url, cached[0])
+                        return cached[1]
+                    if response.status == 429 or response.status >= 500:
+                        raise _Retry(f'{url} answered {response.status}')
+                    if response.status >= 400:
+                        # client errors will not get better by retrying
+                        raise CoprError(f'{url} answered {response.status}: {await response.text()}')
+                    body = await response.read()
+                    if self.cache:
+                        self.cache.stats.misses += 1
+                        self.cache.put(url, response.status, dict(response.headers), body)
+                    return body
+            except (_Retry, self._aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    if cached:
+                        logger.warning(f'{url} is unreachable, using the cached response')
+                        self.cache.stats.stale += 1
+                        return cached[1]
+                    raise CoprError(f'Giving up on {url} after {attempt + 1} attempts: {e}') from e
+                delay = self.backoff * 2 ** attempt * (1 + random.random() / 2)
+                logger.debug(f'Retrying {url} in {delay:.2f}s: {e}')
+                await asyncio.sleep(delay)
+
+    async def list_projects(self, page_amount=100, page=1, search=None):
+        """One page of Copr projects, like Copr.list_projects()."""
+        params = {
+            'limit': page_amount,
+            'offset': page_amount * (page - 1),
+            'search_query': search if search is not None else platform.machine(),
+        }
+        return (await self._get('/api_2/projects', params))['projects']
+
+    async def iter_pages(self, page_amount=100, search=None) -> AsyncIterator[list]:
+        """Yields every page of projects in order.
+
+        Up to `concurrency` pages are fetched ahead; the listing ends at the first short page.
+        """
+        tasks: deque = deque()
+        page = 1
+        end = False
+        try:
+            while True:
+                while not end and len(tasks) < self.concurrency:
+                    tasks.append(asyncio.create_task(self.list_projects(page_amount, page, search)))
+                    page += 1
+                if not tasks:
+                    return
+                projects = await tasks.popleft()
+                if len(projects) < page_amount:
+                    end = True
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    tasks.clear()
+                if projects:
+                    yield projects
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def iter_projects(self, page_amount=100, search=None):
+        """Yields every project, one at a time."""
+        async for projects in self.iter_pages(page_amount, search):
+            for project in projects:
+                yield project
+
+    async def get_repo(self, copr, chroot):
+        """The .repo file of a Copr project for a chroot, like Copr.get_repo()."""
+        if '/' not in copr:
+            return None
+        username, projectname = copr.split('/', 1)
+        return await self._get(f'/coprs/{username}/{projectname}/repo/{chroot}/{username}-{projectname}-{chroot}.repo', json_body=False)
+
+    async def get_url(self, url) -> bytes:
+        """Fetches an arbitrary URL, such as a GPG key, through the same pool, retries and cache."""
+        assert self.session, 'AsyncCopr must be used as an async context manager'
+        return await self._fetch(url)
+
+
+# Copr repos in an installroot
+
+# repo options passed on to dnf, anything else in a .repo file is only written to the chroot
+REPO_KEYS = {'name', 'baseurl', 'metalink', 'mirrorlist', 'gpgcheck', 'gpgkey', 'repo_gpgcheck',
+             'skip_if_unavailable', 'enabled', 'priority', 'cost', 'module_hotfixes'}
+REPO_BOOLS = {'gpgcheck', 'repo_gpgcheck', 'skip_if_unavailable', 'enabled', 'module_hotfixes'}
+
+
+def copr_chroot(opts=None):
+    """The Copr chroot matching dnf options, e.g. fedora-36-x86_64.
+
+    The release and arch default to the host's when dnf_options does not set them.
+    """
+    opts = opts or {}
+    release = opts.get('releasever') or platform.freedesktop_os_release().get('VERSION_ID', 'rawhide')
+    arch = opts.get('basearch') or opts.get('arch') or platform.machine()
+    return f'fedora-{release}-{arch}'
+
+
+def _repo_filename(copr, copr_url=COPR_URL):
+    # the name dnf copr enable uses, so the plugin recognizes the repo later
+    host = copr_url.split('://', 1)[-1].rstrip('/')
+    return f"_copr:{host}:{copr.replace('/', ':')}.repo"
+
+
+def parse_repo_file(text, substitutions=None):
+    """Parses a .repo file into a list of repo option dicts for libcappy.metadata.Metadata.
+
+    $variables such as $releasever and $basearch are replaced from substitutions.
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read_string(text)
+    repos = []
+    for section in parser.sections():
+        repo = {'id': section}
+        for key, value in parser.items(section):
+            if key not in REPO_KEYS:
+                continue
+            for var, sub in (substitutions or {}).items():
+                value = value.replace(f'${var}', str(sub))
+            if key in REPO_BOOLS:
+                repo[key] = value.strip().lower() in ('1', 'true', 'yes', 'on')
+            elif key in ('baseurl', 'gpgkey'):
+                repo[key] = value.split()
+            elif key in ('priority', 'cost'):
+                repo[key] = int(value)
+            else:
+                repo[key] = value
+        repos.append(repo)
+    return repos
+
+
+async def _fetch_copr(copr: AsyncCopr, project, chroot):
+    text = await copr.get_repo(project, chroot)
+    if text is None:
+        raise CoprError(f'{project!r} is not a Copr project, expected owner/project')
+    keys = set()
+    for repo in parse_repo_file(text):
+        keys.update(repo.get('gpgkey', []))
+    keys = sorted(k for k in keys if not k.startswith('file://'))
+    bodies = await asyncio.gather(*(copr.get_url(k) for k in keys))
+    return text, dict(zip(keys, bodies))
+
+
+async def fetch_coprs(projects, chroot, copr_url=COPR_URL, cache=None, concurrency=8):
+    """Fetches the .repo files of Copr projects and the GPG keys they reference, all at once.
+
+    Returns {project: (repo file, {key url: key})}.
+    """
+    async with AsyncCopr(copr_url, concurrency=concurrency, cache=cache) as copr:
+        results = await asyncio.gather(*(_fetch_copr(copr, p, chroot) for p in projects))
+    return dict(zip(projects, results))
+
+
+def prepare_coprs(projects, opts=None, copr_url=COPR_URL, cache=None, keydir=COPR_KEY_DIR):
+    """Fetches Copr projects for an installroot, without writing anything into it yet.
+
+    Returns the files to add to the installroot by their path in it, the .repo files for
+    etc/yum.repos.d and their keys for etc/pki/rpm-gpg with gpgkey pointing at the local
+    copies, and the repos as option dicts for libcappy.metadata.Metadata. The host side
+    reads the keys from copies in keydir.
+    """
+    chroot = copr_chroot(opts)
+    release, arch = chroot.split('-')[1:]
+    fetched = asyncio.run(fetch_coprs(projects, chroot, copr_url, cache))
+    os.makedirs(keydir, exist_ok=True)
+    files: dict[str, bytes] = {}
+    repos = []
+    for project, (text, keys) in fetched.items():
+        local = {}
+        for n, (url, key) in enumerate(keys.items()):
+            name = f"copr-{project.replace('/', '-')}" + (f'-{n}' if n else '') + '.gpg'
+            with open(os.path.join(keydir, name), 'wb') as f:
+                f.write(key)
+            files[f'etc/pki/rpm-gpg/{name}'] = key
+            local[url] = name
+        for url, name in local.items():
+            text = text.replace(url, f'file:///etc/pki/rpm-gpg/{name}')
+        files[f'etc/yum.repos.d/{_repo_filename(project, copr_url)}'] = text.encode()
+        installed = {f'file:///etc/pki/rpm-gpg/{name}': name for name in local.values()}
+        for repo in parse_repo_file(text, {'releasever': release, 'basearch': arch}):
+            if 'gpgkey' in repo:
+                repo['gpgkey'] = [f'file://{os.path.abspath(keydir)}/{installed[k]}' if k in installed else k for k in repo['gpgkey']]
+            repos.append(repo)
+        logger.info(f'Fetched Copr {project} for {chroot} with {len(keys)} keys')
+    return files, repos
+
+
+def add_files(root, files):
+    """Writes files, given by their path relative to root, into root."""
+    for path, data in files.items():
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
 # Repo functions
 
-def repo_from_cache(cache_folder, output):
+RPM_MANIFEST = '.cappy-manifest.json'
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_compressed(path) -> bytes:
+    """Reads a possibly compressed metadata file, as found in repodata/."""
+    if path.endswith('.gz'):
+        with gzip.open(path) as f:
+            return f.read()
+    if path.endswith('.xz'):
+        with lzma.open(path) as f:
+            return f.read()
+    if path.endswith('.bz2'):
+        with bz2.open(path) as f:
+            return f.read()
+    if path.endswith('.zst'):
+        return subprocess.run(['zstd', '-dc', path], check=True, capture_output=True).stdout
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def find_comps(cache_folder):
+    """Finds the comps groupfiles dnf left in the repodata/ folders of a cache."""
+    found = []
+    for root, dirs, files in os.walk(cache_folder):
+        if os.path.basename(root) != 'repodata':
+            continue
+        # prefer the uncompressed groupfile if a repo ships several
+        comps = sorted((f for f in files if 'comps' in f and '.xml' in f), key=lambda f: not f.endswith('.xml'))
+        if comps:
+            found.append(os.path.join(root, comps[0]))
+    return found
+
+
+def merge_comps(paths, output):
+    """Merges comps groupfiles into one at output. Returns False if there was nothing to merge."""
+    if not paths:
+        return False
+    try:
+        import libcomps
+    except ImportError:
+        logger.warning(f'libcomps is not available, only using the groupfile from {paths[0]}')
+        with open(output, 'wb') as f:
+            f.write(read_compressed(paths[0]))
+        return True
+    merged = libcomps.Comps()
+    for path in paths:
+        comps = libcomps.Comps()
+        comps.fromxml_str(read_compressed(path).decode())
+        merged += comps
+    merged.xml_f(output)
+    return True
+
+
+def repo_from_cache(cache_folder, output, incremental=True, workers=None):
     """
     Creates a repo file from all the cached RPMs in a folder.
+
+    In incremental mode only RPMs whose size or mtime changed since the last run are hashed,
+    and of those only the ones whose content changed are placed (hardlinked or reflinked where
+    possible), and the metadata is updated in place with createrepo --update. The comps
+    groupfiles of the cached repos are merged into the repo so that groups and environments
+    resolve against it.
+
+    Returns the number of changed packages.
     """
     # create output folder
     if not os.path.exists(output):
@@ -79,12 +433,63 @@ def repo_from_cache(cache_folder, output):
     # then create a packages folder inside
     package_dir = os.path.join(output, 'packages')
     os.makedirs(package_dir, exist_ok=True)
-    # recursively find all RPM files in the cache folder, then copy them to our repo folder
+    manifest_path = os.path.join(output, RPM_MANIFEST)
+    manifest = {}
+    if incremental and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    # recursively find all RPM files in the cache folder
+    sources = {}
     for root, dirs, files in os.walk(cache_folder):
         for file in files:
             if file.endswith('.rpm'):
-                print(f'{file} -> {package_dir}')
-                shutil.copy(os.path.join(root, file), package_dir)
-    # create the repo
-    os.system(f'createrepo {output}')
-    #TODO: Add groupfiles
\ No newline at end of file
+                sources[file] = os.path.join(root, file)
+    candidates = []
+    for file, path in sources.items():
+        st = os.stat(path)
+        old = manifest.get(file)
+        if old is None or old['size'] != st.st_size or old['mtime'] != st.st_mtime:
+            candidates.append((file, path, st))
+    removed = [file for file in manifest if file not in sources]
+    for file in removed:
+        logger.debug(f'{file} is gone from the cache, removing it')
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(package_dir, file))
+        del manifest[file]
+
+    def add(entry):
+        file, path, st = entry
+        digest = _sha256(path)
+        old = manifest.get(file)
+        # only touched, e.g. downloaded again: the placed copy and its metadata are still right
+        same = old is not None and old['size'] == st.st_size and old.get('sha256') == digest
+        if not same:
+            place(path, os.path.join(package_dir, file))
+        return file, {'size': st.st_size, 'mtime': st.st_mtime, 'sha256': digest}, not same
+
+    changed = []
+    # placing and hashing is I/O bound, and hashlib drops the GIL on large buffers
+    with ThreadPoolExecutor(workers) as pool:
+        for file, entry, placed in pool.map(add, candidates):
+            manifest[file] = entry
+            if placed:
+                changed.append(file)
+    logger.info(f'{len(changed)} new or changed, {len(removed)} removed, {len(sources)} packages in total')
+
+    groupfile = os.path.join(output, 'comps.xml')
+    comps_before = _sha256(groupfile) if os.path.exists(groupfile) else None
+    has_comps = merge_comps(find_comps(cache_folder), groupfile)
+    comps_changed = has_comps and _sha256(groupfile) != comps_before
+    repodata = os.path.join(output, 'repodata')
+    if changed or removed or comps_changed or not os.path.exists(repodata):
+        # create the repo
+        cmd = ['createrepo', '--workers', str(workers or os.cpu_count() or 1)]
+        if incremental and os.path.exists(repodata):
+            # reuses the existing metadata of every package whose size and mtime did not change
+            cmd.append('--update')
+        if has_comps:
+            cmd += ['--groupfile', groupfile]
+        subprocess.run(cmd + [output], check=True)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return len(changed)
@@ -0,0 +1,138 @@
+# LibCappy step scheduler.
+# Runs named steps as a dependency graph, as many at once as the graph allows.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from .trace import span
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Step:
+    name: str
+    fn: Callable[[], Any]
+    deps: list[str] = field(default_factory=list)
+    start: float = 0.0
+    seconds: float = 0.0
+
+
+class Scheduler:
+    """[summary]
+    Runs a graph of named steps on a thread pool, starting each one as soon as its dependencies are done.
+
+    Arguments:
+    max_workers: int, how many steps may run at once (default: as many as are ready)
+    """
+
+    def __init__(self, max_workers: int | None = None):
+        self.steps: dict[str, Step] = {}
+        self.max_workers = max_workers
+        self.results: dict[str, Any] = {}
+        self.started = 0.0
+        self.wall_time = 0.0
+
+    def add(self, name: str, fn: Callable[[], Any], deps: list[str] | tuple[str, ...] = ()):
+        if name in self.steps:
+            raise ValueError(f'Step {name!r} is defined twice')
+        self.steps[name] = Step(name, fn, list(deps))
+
+    def order(self) -> list[str]:
+        """The steps in a topological order. Raises ValueError on unknown dependencies or cycles."""
+        order: list[str] = []
+        state: dict[str, int] = {}  # 1: visiting, 2: done
+
+        def visit(name: str, path: tuple[str, ...]):
+            if name not in self.steps:
+                raise ValueError(f'Step {path[-1]!r} depends on unknown step {name!r}')
+            if state.get(name) == 2:
+                return
+            if state.get(name) == 1:
+                raise ValueError(f'Dependency cycle: {" -> ".join(path + (name,))}')
+            state[name] = 1
+            for dep in self.steps[name].deps:
+                visit(dep, path + (name,))
+            state[name] = 2
+            order.append(name)
+
+        for name in self.steps:
+            visit(name, ())
+        return order
+
+    def _run_step(self, step: Step):
+        logger.debug(f'Starting step {step.name}')
+        step.start = time.monotonic() - self.started
+        t = time.monotonic()
+        try:
+            with span(f'step {step.name}'):
+                return step.fn()
+        finally:
+            step.seconds = time.monotonic() - t
+            logger.debug(f'Finished step {step.name} in {step.seconds:.2f}s')
+
+    def run(self) -> dict[str, Any]:
+        """Runs every step and returns their results by name.
+
+        If a step fails, no new steps are started, the running ones are waited for and the
+        first error is raised.
+        """
+        self.order()
+        self.started = time.monotonic()
+        pending = dict(self.steps)
+        done: set[str] = set()
+        running: dict[Future, str] = {}
+        error: BaseException | None = None
+        with ThreadPoolExecutor(self.max_workers or len(self.steps) or 1, thread_name_prefix='cappy-step') as pool:
+            while pending or running:
+                if error is None:
+                    for name, step in list(pending.items()):
+                        if all(d in done for d in step.deps):
+                            running[pool.submit(self._run_step, step)] = name
+                            del pending[name]
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        logger.error(f'Step {name} failed: {future.exception()}')
+                        error = error or future.exception()
+                    else:
+                        self.results[name] = future.result()
+                        done.add(name)
+        self.wall_time = time.monotonic() - self.started
+        if error is not None:
+            raise error
+        return self.results
+
+    def critical_path(self) -> tuple[list[str], float]:
+        """The chain of dependent steps with the longest total run time, and that time."""
+        finish: dict[str, float] = {}
+        prev: dict[str, str | None] = {}
+        for name in self.order():
+            step = self.steps[name]
+            before = max(step.deps, key=lambda d: finish[d], default=None)
+            prev[name] = before
+            finish[name] = step.seconds + (finish[before] if before else 0.0)
+        if not finish:
+            return [], 0.0
+        last: str | None = max(finish, key=lambda n: finish[n])
+        total = finish[last]
+        path: list[str] = []
+        while last:
+            path.append(last)
+            last = prev[last]
+        return path[::-1], total
+
+    def report(self) -> str:
+        lines = [f'{"step":<20} {"start":>8} {"time":>8}']
+        for step in sorted(self.steps.values(), key=lambda s: s.start):
+            lines.append(f'{step.name:<20} {step.start:>7.1f}s {step.seconds:>7.1f}s')
+        path, total = self.critical_path()
+        lines.append(f'wall time {self.wall_time:.1f}s, critical path {total:.1f}s: {" -> ".join(path)}')
+        return '\n'.join(lines)
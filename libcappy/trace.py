@@ -0,0 +1,137 @@
+# LibCappy tracing.
+# Structured spans around the phases of an install, exportable as a Chrome
+# trace (chrome://tracing, Perfetto) or as JSON lines.
+# Copyright (C) 2022 Cappy Ishihara and contributors under the MIT License.
+
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Iterator
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+@dataclass
+class Span:
+    """[summary]
+    One timed phase. The counters are deltas over the span for the whole process (and its
+    waited-for children for CPU time), so spans that overlap share them.
+    """
+    name: str
+    start: float
+    seconds: float = 0.0
+    thread: int = 0
+    cpu_user: float = 0.0
+    cpu_system: float = 0.0
+    rss: int = 0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    attrs: dict[str, Any] = field(default_factory=dict)
+
+
+_spans: list[Span] = []
+_subscribers: list[Callable[[Span], None]] = []
+_lock = threading.Lock()
+
+
+def _counters() -> tuple[float, float, int, int, int]:
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        rss = me.ru_maxrss * 1024
+    io = {}
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        pass
+    return (me.ru_utime + children.ru_utime, me.ru_stime + children.ru_stime, rss,
+            int(io.get('read_bytes', 0)), int(io.get('write_bytes', 0)))
+
+
+def subscribe(fn: Callable[[Span], None]) -> Callable[[], None]:
+    """Calls fn with every span as it finishes. Returns a function that unsubscribes again, once."""
+    with _lock:
+        _subscribers.append(fn)
+
+    def unsubscribe():
+        with _lock:
+            if fn in _subscribers:
+                _subscribers.remove(fn)
+    return unsubscribe
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[dict[str, Any]]:
+    """Records the block as a span named name.
+
+    Yields the span's attribute dict, so the block can attach results such as byte counts.
+    """
+    s = Span(name, time.time(), thread=threading.get_ident(), attrs=attrs)
+    before = _counters()
+    t = time.monotonic()
+    try:
+        yield s.attrs
+    finally:
+        s.seconds = time.monotonic() - t
+        after = _counters()
+        s.cpu_user, s.cpu_system = after[0] - before[0], after[1] - before[1]
+        s.rss = after[2]
+        s.read_bytes, s.write_bytes = after[3] - before[3], after[4] - before[4]
+        with _lock:
+            _spans.append(s)
+            subscribers = list(_subscribers)
+        for fn in subscribers:
+            fn(s)
+
+
+def spans() -> list[Span]:
+    with _lock:
+        return list(_spans)
+
+
+def clear():
+    with _lock:
+        _spans.clear()
+
+
+def export_jsonl(path: str, recorded: list[Span] | None = None):
+    """Writes one JSON object per span."""
+    with open(path, 'w') as f:
+        for s in recorded if recorded is not None else spans():
+            f.write(json.dumps(asdict(s), default=str) + '\n')
+
+
+def export_chrome(path: str, recorded: list[Span] | None = None):
+    """Writes the spans in the Chrome trace event format."""
+    events = []
+    for s in recorded if recorded is not None else spans():
+        args = {k: v for k, v in asdict(s).items() if k not in ('name', 'start', 'seconds', 'thread', 'attrs')}
+        args.update(s.attrs)
+        events.append({
+            'name': s.name,
+            'cat': 'cappy',
+            'ph': 'X',
+            'ts': s.start * 1e6,
+            'dur': s.seconds * 1e6,
+            'pid': os.getpid(),
+            'tid': s.thread,
+            'args': args,
+        })
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+
+def export(path: str):
+    """Exports recorded spans to path: JSON lines for *.jsonl, a Chrome trace otherwise."""
+    if path.endswith('.jsonl'):
+        export_jsonl(path)
+    else:
+        export_chrome(path)
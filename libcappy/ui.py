@@ -2,6 +2,7 @@ import curses
 from typing import Any, Callable, Optional
 
 from .common import DS
+from .listmodel import FilterIndex, TableModel, Viewport
 
 
 class Interface:
@@ -171,7 +172,10 @@ class Entry:
 
 
 class ScrollList:
-    sels: list[str] = []
+    pad: Optional['curses._CursesWindow'] = None
+    head: Optional['curses._CursesWindow'] = None
+    status: Optional[str] = None
+    shown: list[tuple[str, bool] | None] = []
 
     def __init__(self, box: Box):
         curses.update_lines_cols()
@@ -183,92 +187,157 @@ class ScrollList:
         curses.init_pair(4, curses.COLOR_BLACK, curses.COLOR_GREEN)
         curses.init_pair(5, curses.COLOR_GREEN, curses.COLOR_BLUE)
 
-    @staticmethod
-    def build_table(ds: DS):
-        cols = list(ds[0].keys())
-        cw = [max(len(cols[n]), [max(len(d[cols[n]])for d in ds)for n in range(len(cols))][n])for n in range(len(cols))]
-        rows = [[d[col]for col in cols]for d in ds]
-        f = "│".join(col+' '*(cw[i]-len(col))for i, col in enumerate(cols))+'\n'
-        return sum(cw)+len(cols)-3, f+"\n".join("│".join(v+' '*(cw[i]-len(v))for i, v in enumerate(r))for r in rows)
-
-    def write(self, ls: list[str], sel: int = 0):
-        w = self.box.w
-        y = 1
-        w.addstr(y, 1, ls.pop(0)[0:self.box.c-2], curses.color_pair(1))
-        while any(ls):
-            y += 1
-            w.addstr(y, 1, ls.pop(0), curses.color_pair(2 if y-2 == sel else 0))
-        w.refresh()
-
-    def find(self, ds: DS, sel: int) -> int:
-        curses.update_lines_cols()
-        box = Box(self.box.ui, 4, 50, *get_mid(*self.box.ui.w.getmaxyx(), 4, 50))
-        box.write("FIND: ")
-        en = box.add_entry(42)
-        en.show(1, 7)
-        en.activate()
-        found: list[int] = []
-        for i, d in enumerate(ds):
-            for v in d.values():
-                if en.t in v:
-                    if i > sel:
-                        return i
-                    found.append(i)
-        if any(found):
-            return found[0]
-        else:
-            box.t = "Not found!"
-            box.write()
-            box.w.getkey()
-            return sel
-
-    def hdl(self, dsFn: Callable[[], DS], keyFn: Callable[[str, int], Any], h: Optional[int] = 0, w: Optional[int] = 0):
-        """This includes showing it. No you can't sep them."""
-        self.box.ui.redraw()
-        self.box.write()
+    def lines(self, model: TableModel, view: Viewport, rows: list[int] | None = None) -> list[tuple[str, bool] | None]:
+        """The (text, selected) of every line of the view, None past the end of the list.
+
+        While the list is filtered, rows are the model rows shown on the lines of the view.
+        Only these rows are formatted, however long the list is.
+        """
+        width = model.width
+        while True:
+            lines: list[tuple[str, bool] | None] = []
+            for pos in range(view.sy, view.sy + view.rows):
+                if pos < view.length:
+                    lines.append((model.line(pos if rows is None else rows[pos]), pos == view.sel))
+                else:
+                    lines.append(None)
+            if model.width == width:
+                return lines
+            # a longer value widened a column, which moves every line
+            width = model.width
+            view.resize(view.length, width)
+
+    def paint(self, model: TableModel, view: Viewport, rows: list[int] | None = None, status: str = '', full: bool = False):
+        """Repaints the lines of the list that differ from what is on screen, or the whole box if full.
+
+        Rows are drawn into pads as wide as the table, so horizontal scrolling only moves the
+        part of the pads that is copied to the screen. status goes into the bottom border.
+        """
+        if full:
+            self.box.ui.redraw()
+            self.box.write()
+            self.status = None
+        lines = self.lines(model, view, rows)
+        if full or self.pad is None or self.pad.getmaxyx() != (view.rows, model.width + 1):
+            self.head = curses.newpad(1, model.width + 1)
+            self.pad = curses.newpad(view.rows, model.width + 1)
+            self.head.addstr(0, 0, model.header, curses.color_pair(1))
+            self.shown = []
+        if status != self.status:
+            text = status[:self.box.c - 4]
+            self.box.w.addstr(self.box.l - 2, 0, '╚═' + text + '═'*(self.box.c - 3 - len(text)) + '╝')
+            self.status = status
+        for n, line in enumerate(lines):
+            if n < len(self.shown) and self.shown[n] == line:
+                continue
+            self.pad.move(n, 0)
+            self.pad.clrtoeol()
+            if line is not None:
+                self.pad.addstr(n, 0, line[0], curses.color_pair(2 if line[1] else 0))
+        self.shown = lines
+        y, x = self.box.w.getbegyx()
+        self.box.w.noutrefresh()
+        self.head.noutrefresh(0, view.sx, y + 1, x + 1, y + 1, x + view.cols)
+        self.pad.noutrefresh(0, view.sx, y + 2, x + 1, y + 1 + view.rows, x + view.cols)
+        curses.doupdate()
+
+    def hdl(self, dsFn: Callable[[], 'DS | TableModel'], keyFn: Callable[[str, int], Any], h: Optional[int] = 0, w: Optional[int] = 0):
+        """This includes showing it. No you can't sep them.
+
+        dsFn may return a TableModel, e.g. over a generator, to show rows as they are streamed in.
+        keyFn may return 'redraw' when it drew over the list, e.g. with a popup.
+        '/' or ^F filters the list as you type, ENTER stops typing and ESC drops the filter.
+        Selections are kept in the dataset, so they stay when rows are filtered out.
+        """
         h = h or self.box.l - 2
         w = w or self.box.c - 2
-        ds = dsFn()
-        cw, table = self.build_table(ds)
-        ls = table.splitlines()
-        self.sels = ls[1:]
-        sy: int = 0
-        sx: int = 0
-        self.write([l[sx:sx+w] for l in ls[sy:sy+h-1]])
-        sel = 0
+        model = TableModel.of(dsFn())
+        model.load(2 * h)
+        view = Viewport(len(model), h - 2, w, model.width)
+        index: FilterIndex | None = None
+        query = ''
+        typing = False
+        # the model rows shown while the list is filtered, best match first
+        rows: list[int] | None = None
+
+        def status() -> str:
+            if not typing and rows is None:
+                return ' / to filter '
+            shown = len(model) if rows is None else len(rows)
+            return f" /{query}{'_' if typing else ''}  {shown}/{len(model)} "
+
+        self.pad = None
+        self.paint(model, view, status=status(), full=True)
         while True:
             k = self.box.w.getkey()
-            match k:
-                case 'KEY_PPAGE': sel -= h - 3
-                case 'KEY_NPAGE': sel += h - 3
-                case 'KEY_HOME': sx = 0
-                case 'KEY_END': sx = cw-w+2
-                case 'KEY_UP': sel -= 1
-                case 'KEY_DOWN': sel += 1
-                case 'KEY_LEFT': sx -= 1
-                case 'KEY_RIGHT': sx += 1
-                case '\n': return
-                case '\x06': sel = self.find(ds, sel)
-                case _: keyFn(k, sel)
-            if sel >= len(self.sels):
-                sel = 0
-            if sel < 0:
-                sel = len(self.sels)-1
-            if sy + h - 3 < sel:
-                sy = sel - h + 3
-            if sy > sel:
-                sy = sel
-            if sx > cw-w+2:
-                sx = 0
-            if sx < 0:
-                sx = cw-w+2
+            full = False
+            sel = view.sel
+            refilter = False
+            edited: list[int] = []
+            if typing and k in ('KEY_BACKSPACE', '\x7f', '\b'):
+                query = query[:-1]
+                refilter = True
+            elif typing and len(k) == 1 and k.isprintable():
+                query += k
+                refilter = True
+            else:
+                match k:
+                    case 'KEY_PPAGE': sel -= h - 3
+                    case 'KEY_NPAGE': sel += h - 3
+                    case 'KEY_HOME': view.scroll_x(0)
+                    case 'KEY_END': view.scroll_x(view.max_sx)
+                    case 'KEY_UP': sel -= 1
+                    case 'KEY_DOWN': sel += 1
+                    case 'KEY_LEFT': view.scroll_x(view.sx - 1)
+                    case 'KEY_RIGHT': view.scroll_x(view.sx + 1)
+                    case '\n' if typing: typing = False
+                    case '\n': return
+                    case '/' | '\x06':
+                        typing = True
+                        if index is None:
+                            # the filter searches every row, not just the ones streamed in so far
+                            model.load()
+                            index = FilterIndex(model)
+                    case '\x1b':
+                        typing = False
+                        query = ''
+                        refilter = rows is not None
+                    case _:
+                        if view.length:
+                            row = sel if rows is None else rows[sel]
+                            edited = [row]
+                            if keyFn(k, row) == 'redraw':
+                                full = True
             ds = dsFn()
-            cw, table = self.build_table(ds)
-            ls = table.splitlines()
-            self.sels = ls[1:]
-            self.box.ui.redraw()
-            self.box.write()
-            self.write([ls[0][sx:sx+w]] + [l[sx:sx+w] for l in ls[sy+1:sy+h-1]], sel-sy)
+            if ds is not model and ds is not model.rows:
+                # a new dataset altogether
+                model = TableModel.of(ds)
+                if index is not None:
+                    model.load()
+                    index = FilterIndex(model)
+                refilter = refilter or rows is not None
+            elif index is not None and index.sync(model, edited) and query:
+                # an edited row may match the query now, or not any more
+                refilter = True
+            if refilter:
+                # typing moves the cursor to the best match, otherwise it stays on its row
+                # if that row is still shown
+                current = sel if rows is None else rows[sel] if sel < len(rows) else None
+                rows = index.match(query) if index is not None else None
+                if current is None or typing or current >= len(model):
+                    sel = 0
+                elif rows is None:
+                    sel = current
+                else:
+                    sel = rows.index(current) if current in rows else 0
+                view.sy = 0
+            if rows is None:
+                # streamed rows are loaded a page ahead of the cursor, or all of them to wrap
+                # around to the end
+                model.load(None if sel < 0 else sel + 2 * view.rows)
+            view.resize(len(model) if rows is None else len(rows), model.width)
+            view.select(sel)
+            self.paint(model, view, rows, status(), full)
 
 
 def get_mid(y: int, x: int, h: int, w: int) -> tuple[int, int]:
@@ -50,6 +50,7 @@ setup(
         'pyyaml',
         'requests',
         'urllib3',
+        'aiohttp',
         'dnf-plugins-core',
     ],
     entry_points = {
@@ -0,0 +1,51 @@
+from libcappy import blockdev
+from libcappy.blockdev import BlockInventory, human_size
+from tests.hosts import device, large_host
+
+
+def test_human_size():
+    assert [human_size(s) for s in (None, 512, 600 << 20, 1 << 30, 1000204886016)] == ['', '512B', '600M', '1G', '931.5G']
+
+
+def test_inventory():
+    inv = BlockInventory(large_host(4, paths=2))
+    assert len(inv) == 1 + 3 + 4 * (2 + 1) + 2 * 2
+    assert inv['mpath0'].parents == ['sd0', 'sd1']
+    assert inv['sd0'].children == ['mpath0']
+    # LVs of a VG spanning two LUNs are one record with both parents
+    assert inv['/dev/vg0-lv1'].parents == ['mpath0', 'mpath1']
+    assert inv.by_mountpoint['/'].name == 'nvme0n1p3'
+    assert inv.by_mountpoint['/home'] is inv.by_mountpoint['/']
+    assert inv.by_uuid['6A1B-2C3D'].path == '/dev/nvme0n1p1'
+    rows = [r for r in inv.rows() if r['NAME'] == 'nvme0n1p3']
+    assert [r['MOUNTPOINTS'] for r in rows] == ['/home', '/']
+    assert rows[0]['SIZE'] == '510G' and rows[0]['FSAVAIL'] == '300G' and rows[0]['FSUSE%'] == '41%'
+
+
+def test_udev_events(monkeypatch):
+    inv = BlockInventory(large_host(2, paths=2))
+    present = {'/dev/nvme0n1p4': device('nvme0n1p4', 'part', 1 << 30, 'nvme0n1', uuid='new-uuid', mountpoints=['/mnt'])}
+    monkeypatch.setattr(blockdev, 'lsblk', lambda *devs: {'blockdevices': [present[d] for d in devs if d in present]})
+    inv.apply([('add', 'nvme0n1p4'), ('change', 'nvme0n1p4')])
+    assert inv['nvme0n1p4'].parents == ['nvme0n1']
+    assert 'nvme0n1p4' in inv['nvme0n1'].children
+    assert inv.by_uuid['new-uuid'] is inv.by_mountpoint['/mnt']
+    # losing one path keeps the multipath device, losing all of them drops it
+    inv.apply([('remove', 'sd0')])
+    assert inv['mpath0'].parents == ['sd1']
+    inv.apply([('remove', 'sd1')])
+    assert inv.get('mpath0') is None
+    assert inv['vg0-lv0'].parents == ['mpath1']
+    assert '/srv/vg0/lv0' in inv.by_mountpoint
+    # a change event for a device that is gone by the time lsblk runs removes it
+    present.clear()
+    inv.apply([('change', 'nvme0n1p4')])
+    assert inv.get('nvme0n1p4') is None and 'new-uuid' not in inv.by_uuid
+
+
+def test_large_host():
+    # how fast this is is up to benchmarks.blockdev
+    inv = BlockInventory(large_host(1000))
+    rows = inv.rows()
+    assert len(inv) == 1 + 3 + 1000 * 5 + 1000
+    assert len(rows) > len(inv)
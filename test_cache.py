@@ -0,0 +1,28 @@
+import os
+import time
+from libcappy.cache import PackageCache, parse_size
+
+
+def test_parse_size():
+    assert parse_size('512M') == 512 << 20
+    assert parse_size('1.5G') == 3 << 29
+    assert parse_size(4096) == 4096
+
+
+def test_package_cache(tmp_path):
+    cache = PackageCache(str(tmp_path / 'cache'), budget=10)
+    src = tmp_path / 'a.rpm'
+    src.write_bytes(b'123456')
+    assert not cache.fetch('sha256:aa', str(tmp_path / 'root/a.rpm'))
+    cache.store('sha256:aa', str(src))
+    assert cache.fetch('sha256:aa', str(tmp_path / 'root/a.rpm'))
+    assert (tmp_path / 'root/a.rpm').read_bytes() == b'123456'
+    # the older object goes first once the budget is exceeded
+    os.utime(cache.object_path('sha256:aa'), (time.time() - 60, time.time() - 60))
+    other = tmp_path / 'b.rpm'
+    other.write_bytes(b'abcdef')
+    cache.store('sha256:bb', str(other))
+    cache.evict()
+    assert not os.path.exists(cache.object_path('sha256:aa'))
+    assert os.path.exists(cache.object_path('sha256:bb'))
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.evicted) == (1, 1, 1)
@@ -0,0 +1,116 @@
+import functools
+import gzip
+import http.server
+import io
+import lzma
+import os
+import threading
+import pytest
+from libcappy import comps
+
+COMPS = '''<?xml version="1.0" encoding="UTF-8"?>
+<comps>
+  <group>
+    <id>core</id>
+    <name>Core</name>
+    <name xml:lang="de">Kern</name>
+    <description>Smallest possible installation</description>
+    <display_order>1</display_order>
+    <packagelist><packagereq type="mandatory">bash</packagereq></packagelist>
+  </group>
+  <group>
+    <id>editors</id>
+    <name>Editors</name>
+    <description>Sometimes called text editors</description>
+    <description xml:lang="de_DE">Texteditoren</description>
+  </group>
+  <group>
+    <id>admin-tools</id>
+    <name>Administration Tools</name>
+  </group>
+  <environment>
+    <id>workstation-product-environment</id>
+    <name>Fedora Workstation</name>
+    <description>Fedora Workstation is a user friendly desktop system.</description>
+    <display_order>2</display_order>
+    <grouplist><groupid>core</groupid></grouplist>
+  </environment>
+  <environment>
+    <id>minimal-environment</id>
+    <name>Minimal Install</name>
+    <display_order>1</display_order>
+  </environment>
+  <category>
+    <id>desktops</id>
+    <name>Desktops</name>
+    <description>Desktop environments</description>
+  </category>
+</comps>
+'''
+
+REPOMD = '''<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <data type="primary"><location href="repodata/primary.xml.gz"/></data>
+  <data type="group"><location href="repodata/comps.xml"/></data>
+  <data type="group_xz"><location href="repodata/comps.xml.xz"/></data>
+</repomd>
+'''
+
+
+def test_parse():
+    envs, groups = comps.parse(io.BytesIO(COMPS.encode()), languages=[])
+    assert [e['id'] for e in envs] == ['minimal-environment', 'workstation-product-environment']
+    assert envs[0]['description'] == ''
+    assert [g['id'] for g in groups] == ['core', 'admin-tools', 'editors']
+    assert groups[2] == {'id': 'editors', 'name': 'Editors', 'description': 'Sometimes called text editors'}
+
+
+def test_parse_translated():
+    envs, groups = comps.parse(io.BytesIO(COMPS.encode()), languages=['de_DE', 'de'])
+    assert groups[0]['name'] == 'Kern'
+    assert groups[2]['description'] == 'Texteditoren'
+    assert groups[2]['name'] == 'Editors'
+
+
+def write_repo(root, repoid, compress=gzip.compress, suffix='.gz'):
+    repodata = root / repoid / 'repodata'
+    repodata.mkdir(parents=True)
+    (repodata / f'abc-comps-Everything.x86_64.xml{suffix}').write_bytes(compress(COMPS.encode()))
+    return repodata
+
+
+def test_load_cached(tmp_path):
+    old = write_repo(tmp_path, 'fedora-0123456789abcdef')
+    os.utime(next(old.iterdir()), (0, 0))
+    write_repo(tmp_path, 'fedora-fedcba9876543210', lzma.compress, '.xz')
+    updates = write_repo(tmp_path, 'updates-0123456789abcdef')
+    # zchunk can not be read, even when it is the newest copy
+    (updates / 'abc-comps-Everything.x86_64.xml.zck').write_bytes(b'\0ZCK1')
+    files = comps.cached_groupfiles([str(tmp_path)])
+    assert [os.path.basename(os.path.dirname(os.path.dirname(f))) for f in files] == ['fedora-fedcba9876543210', 'updates-0123456789abcdef']
+    assert files[1].endswith('.xml.gz')
+    envs, groups = comps.load([str(tmp_path)], download=False)
+    assert len(envs) == 2 and len(groups) == 3
+
+
+def test_load_nothing(tmp_path):
+    assert comps.load([str(tmp_path)], download=False) is None
+
+
+@pytest.fixture
+def repo_url(tmp_path):
+    (tmp_path / 'repodata').mkdir()
+    (tmp_path / 'repodata' / 'repomd.xml').write_text(REPOMD)
+    (tmp_path / 'repodata' / 'comps.xml.xz').write_bytes(lzma.compress(COMPS.encode()))
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(tmp_path))
+    handler.log_message = lambda *_: None
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}/'
+    httpd.shutdown()
+
+
+def test_download(repo_url):
+    envs, groups = comps.download_groupfile({'id': 'test', 'baseurl': [repo_url]})
+    assert len(envs) == 2 and len(groups) == 3
+    assert comps.download_groupfile({'id': 'test', 'baseurl': [repo_url + 'missing/']}) is None
@@ -0,0 +1,111 @@
+import asyncio
+import http.server
+import json
+import threading
+from urllib.parse import parse_qs, urlparse
+import pytest
+from libcappy.repository import AsyncCopr, CoprError, add_files, prepare_coprs
+
+PROJECTS = [{'project': {'id': i, 'name': f'project{i}'}} for i in range(250)]
+
+REPO = '''[copr:copr.fedorainfracloud.org:cappy:keyed]
+name=Copr repo for keyed owned by cappy
+baseurl={host}/results/cappy/keyed/fedora-$releasever-$basearch/
+type=rpm-md
+gpgcheck=1
+gpgkey={host}/results/cappy/keyed/pubkey.gpg
+enabled=1
+'''
+
+
+class FakeCopr(http.server.BaseHTTPRequestHandler):
+    # a stand-in for the Copr API that fails every page once before answering
+    protocol_version = 'HTTP/1.1'
+    failed: set = set()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/api_2/projects':
+            q = parse_qs(url.query)
+            offset, limit = int(q['offset'][0]), int(q['limit'][0])
+            if offset not in self.failed:
+                self.failed.add(offset)
+                return self.reply(503, b'try again')
+            return self.reply(200, json.dumps({'projects': PROJECTS[offset:offset + limit]}).encode())
+        if url.path == '/coprs/cappy/test/repo/fedora-36-x86_64/cappy-test-fedora-36-x86_64.repo':
+            return self.reply(200, b'[copr:cappy:test]\n')
+        if url.path == '/coprs/cappy/keyed/repo/fedora-36-x86_64/cappy-keyed-fedora-36-x86_64.repo':
+            host = f'http://127.0.0.1:{self.server.server_port}'
+            return self.reply(200, REPO.format(host=host).encode())
+        if url.path == '/results/cappy/keyed/pubkey.gpg':
+            return self.reply(200, b'KEY')
+        self.reply(404, b'not found')
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+@pytest.fixture
+def copr_url():
+    FakeCopr.failed = set()
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeCopr)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+
+def test_async_copr(copr_url):
+    async def run():
+        async with AsyncCopr(copr_url, concurrency=4, backoff=0.01) as copr:
+            pages = [page async for page in copr.iter_pages(page_amount=100)]
+            repo = await copr.get_repo('cappy/test', 'fedora-36-x86_64')
+            with pytest.raises(CoprError):
+                await copr.get_repo('cappy/missing', 'fedora-36-x86_64')
+        return pages, repo
+    pages, repo = asyncio.run(run())
+    assert [len(p) for p in pages] == [100, 100, 50]
+    assert [p['project']['id'] for page in pages for p in page] == list(range(250))
+    assert repo == '[copr:cappy:test]\n'
+
+
+def test_async_copr_gives_up(copr_url):
+    async def run():
+        async with AsyncCopr(copr_url, retries=0) as copr:
+            await copr.list_projects()
+    with pytest.raises(CoprError, match='Giving up'):
+        asyncio.run(run())
+
+
+def test_add_coprs(copr_url, tmp_path):
+    # what Installer.copr_repos() and add_coprs() do: fetch first, write once the root is mounted
+    opts = {'releasever': 36, 'arch': 'x86_64'}
+    root = tmp_path / 'root'
+    files, repos = prepare_coprs(['cappy/test', 'cappy/keyed'], opts, copr_url=copr_url, keydir=str(tmp_path / 'keys'))
+    assert not root.exists()
+    add_files(str(root), files)
+    host = copr_url.split('://')[1]
+    assert (root / f'etc/yum.repos.d/_copr:{host}:cappy:test.repo').read_text() == '[copr:cappy:test]\n'
+    assert (root / 'etc/pki/rpm-gpg/copr-cappy-keyed.gpg').read_bytes() == b'KEY'
+    keyed = (root / f'etc/yum.repos.d/_copr:{host}:cappy:keyed.repo').read_text()
+    assert 'gpgkey=file:///etc/pki/rpm-gpg/copr-cappy-keyed.gpg' in keyed
+    assert repos[0] == {'id': 'copr:cappy:test'}
+    assert repos[1]['baseurl'] == [f'{copr_url}/results/cappy/keyed/fedora-36-x86_64/']
+    assert repos[1]['gpgkey'] == [f'file://{tmp_path}/keys/copr-cappy-keyed.gpg']
+    assert repos[1]['gpgcheck'] is True
+
+
+def test_prepare_coprs(copr_url, tmp_path):
+    # nothing goes into the installroot before it is mounted, the host reads the keys from keydir
+    opts = {'releasever': 36, 'arch': 'x86_64'}
+    files, repos = prepare_coprs(['cappy/keyed'], opts, copr_url=copr_url, keydir=str(tmp_path / 'keys'))
+    host = copr_url.split('://')[1]
+    assert files['etc/pki/rpm-gpg/copr-cappy-keyed.gpg'] == b'KEY'
+    assert b'gpgkey=file:///etc/pki/rpm-gpg/copr-cappy-keyed.gpg' in files[f'etc/yum.repos.d/_copr:{host}:cappy:keyed.repo']
+    assert repos[0]['gpgkey'] == [f'file://{tmp_path}/keys/copr-cappy-keyed.gpg']
+    assert (tmp_path / 'keys/copr-cappy-keyed.gpg').read_bytes() == b'KEY'
@@ -0,0 +1,53 @@
+import pytest
+from libcappy.coprindex import CoprIndex
+
+
+def project(i, name, owner='someone', description='', instructions=''):
+    return {'project': {'id': i, 'name': name, 'owner': owner, 'description': description, 'instructions': instructions}}
+
+
+@pytest.fixture
+def index(tmp_path):
+    with CoprIndex(str(tmp_path / 'copr.sqlite')) as index:
+        index.update([
+            project(1, 'ultramarine', 'cappyishihara', 'Ultramarine Linux packages'),
+            project(2, 'ultramarine-extras', 'cappyishihara', 'Extra packages'),
+            project(3, 'neovim-nightly', 'agriffis', 'Nightly builds of Neovim'),
+            project(4, 'terra', 'lleyton', 'A rolling repo', 'dnf install terra-release'),
+        ])
+        yield index
+
+
+def test_prefix_search(index):
+    assert [r['id'] for r in index.search('ultra')][:2] == [1, 2]
+    assert index.search('neov')[0]['full_name'] == 'agriffis/neovim-nightly'
+    # descriptions and instructions are searched too, ranked below names
+    assert index.search('terra-release')[0]['id'] == 4
+    assert index.search('nightly neo', fuzzy=False)[0]['id'] == 3
+    assert index.search('zzz', fuzzy=False) == []
+
+
+def test_fuzzy_search(index):
+    assert index.search('ultramrine')[0]['id'] == 1
+    assert index.search('neovm')[0]['id'] == 3
+
+
+def test_incremental_update(index, tmp_path):
+    stats = index.update([project(1, 'ultramarine', 'cappyishihara', 'Ultramarine Linux packages'),
+                          project(3, 'helix-nightly', 'agriffis'), project(5, 'new')])
+    assert (stats.added, stats.updated, stats.unchanged) == (1, 1, 1)
+    assert index.search('neovim', fuzzy=False) == []
+    assert index.search('helix')[0]['id'] == 3
+    assert len(index) == 5
+    # the index persists across instances
+    with CoprIndex(str(tmp_path / 'copr.sqlite')) as again:
+        assert again.search('helix')[0]['id'] == 3
+
+
+def test_search_large(tmp_path):
+    # how fast this is is up to benchmarks.coprindex
+    with CoprIndex(str(tmp_path / 'big.sqlite')) as index:
+        index.update(project(i, f'project-{i}', f'owner{i % 500}', f'Packages number {i}') for i in range(20000))
+        assert index.search('project-1999')[0]['id'] == 1999
+        assert index.search('owner42 proj')[0]['full_name'].startswith('owner42/')
+        assert index.search('prjoect-77')[0]['id'] == 77
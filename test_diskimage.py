@@ -0,0 +1,107 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from libcappy.diskimage import DiskImage, compress, data_extents
+from libcappy.mount import MountTable
+from libcappy.provision import Provisioner
+
+
+def sparse(path, size: int, blocks: dict[int, bytes]):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        for offset, data in blocks.items():
+            f.seek(offset)
+            f.write(data)
+
+
+def test_data_extents(tmp_path):
+    path = tmp_path / 'disk.raw'
+    sparse(path, 64 << 20, {1 << 20: b'a' * 4096, 32 << 20: b'b' * 8192})
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        extents = list(data_extents(fd))
+    finally:
+        os.close(fd)
+    if extents == [(0, 64 << 20)]:
+        pytest.skip('the filesystem does not report holes')
+    assert extents == [(1 << 20, 4096), (32 << 20, 8192)]
+
+
+@pytest.mark.parametrize('method', ['zstd', 'xz'])
+def test_compress(tmp_path, method):
+    if not shutil.which(method):
+        pytest.skip(f'needs {method}')
+    path = tmp_path / 'disk.raw'
+    sparse(path, 64 << 20, {0: b'\x55\xaa' * 256, 40 << 20: os.urandom(1 << 20)})
+    read = compress(str(path), str(tmp_path / 'disk.raw.out'), method, level=1, threads=2)
+    assert read < 4 << 20
+    out = subprocess.run([method, '-dc', tmp_path / 'disk.raw.out'], capture_output=True, check=True).stdout
+    assert out == path.read_bytes()
+
+
+def test_emit(tmp_path):
+    if not shutil.which('zstd'):
+        pytest.skip('needs zstd')
+    image = DiskImage(str(tmp_path / 'disk.raw'), '16M', compress='zstd')
+    sparse(image.path, image.size, {8 << 20: b'x' * 4096})
+    report = image.emit()
+    assert (report.size, report.output) == (16 << 20, image.path + '.zst')
+    assert report.output_size < 4096 and not os.path.exists(image.path)
+    assert 'disk.raw.zst' in str(report)
+
+
+def test_layout():
+    partitions, numbers = DiskImage.layout([
+        {'mountpoint': '/boot/efi', 'filesystem': 'vfat', 'size': '100M'},
+        {'mountpoint': '/', 'filesystem': 'btrfs', 'partition': 'system', 'opts': 'subvol=root'},
+        {'mountpoint': 'swap', 'filesystem': 'swap', 'size': '1G'},
+        {'mountpoint': '/home', 'filesystem': 'btrfs', 'partition': 'system', 'opts': 'subvol=home', 'size': '4G'},
+    ])
+    assert partitions == [{'size': '100M', 'type': 'uefi'}, {'size': '4G', 'type': 'linux'}, {'size': '1G', 'type': 'swap'}]
+    assert numbers == [1, 2, 3, 2]
+
+
+needs_loop = pytest.mark.skipif(os.geteuid() != 0 or not os.path.exists('/dev/loop-control'), reason='needs root and loop devices')
+
+
+@needs_loop
+def test_attach(tmp_path):
+    image = DiskImage(str(tmp_path / 'disk.raw'), '256M', compress='none')
+    config = {'volumes': [
+        {'mountpoint': '/boot/efi', 'filesystem': 'vfat', 'size': '100M'},
+        {'mountpoint': '/', 'filesystem': 'ext4'},
+    ]}
+    with image.attach(config) as loop:
+        disk = config['provision']['disks'][0]
+        assert disk == {'device': loop, 'table': 'gpt', 'partitions': [{'size': '100M', 'type': 'uefi'}, {'size': None, 'type': 'linux'}]}
+        assert [v['device'] for v in config['volumes']] == [f'{loop}p1', f'{loop}p2']
+        assert all(v['format'] for v in config['volumes'])
+    assert os.stat(image.path).st_blocks == 0
+    assert image.emit().allocated == 0
+
+
+@needs_loop
+@pytest.mark.skipif(not shutil.which('sfdisk') or not shutil.which('mkfs.ext4'), reason='needs sfdisk and mkfs.ext4')
+def test_provision_and_mount_image(tmp_path):
+    image = DiskImage(str(tmp_path / 'disk.raw'), '256M', compress='none')
+    config = {'volumes': [
+        {'mountpoint': '/boot', 'filesystem': 'ext4', 'size': '64M'},
+        {'mountpoint': '/', 'filesystem': 'ext4', 'partition': 'root'},
+        {'mountpoint': '/srv', 'filesystem': 'ext4', 'partition': 'root'},
+    ]}
+    with image.attach(config):
+        provisioner = Provisioner(config['volumes'], config['provision']['disks'])
+        uuids = provisioner.run()
+        assert len(uuids) == 2 and config['volumes'][1]['uuid'] == config['volumes'][2]['uuid']
+        with MountTable(str(tmp_path / 'root')) as table:
+            table.mount_all(table.volumes([{'device': f"UUID={v['uuid']}", 'mountpoint': v['mountpoint'],
+                                            'filesystem': 'ext4', 'opts': 'rw'} for v in config['volumes']]))
+            with open(os.path.join(table.root, 'srv/hello'), 'w') as f:
+                f.write('hi')
+            # /srv is the root filesystem again
+            assert os.path.exists(os.path.join(table.root, 'hello'))
+            table.unmount_all()
+    assert image.emit().data > 0
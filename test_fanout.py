@@ -0,0 +1,133 @@
+import functools
+import os
+import shutil
+import subprocess
+import types
+
+import pytest
+
+from libcappy import fanout
+from libcappy.imagecache import ImageCache
+from libcappy.installer import Installer
+
+CONFIG = {
+    'installroot': '/mnt/sysimage',
+    'nspawn_session': True,
+    'bootloader': 'grub',
+    'hostname': 'ultramarine',
+    'packages': ['@core'],
+    'dnf_options': {'releasever': 36},
+    'volumes': [{'device': '/dev/sda', 'mountpoint': '/', 'filesystem': 'ext4'}],
+    'fanout': {'workers': 2, 'mode': 'copy'},
+}
+
+
+def test_target_configs():
+    config = dict(CONFIG, targets=[
+        {'installroot': '/mnt/a'},
+        {'installroot': '/mnt/b', 'hostname': 'b', 'volumes': [{'uuid': 'f0f0', 'mountpoint': '/', 'filesystem': 'xfs'}]},
+    ])
+    a, b = fanout.target_configs(config)
+    assert (a['installroot'], a['hostname'], a['volumes']) == ('/mnt/a', 'ultramarine', CONFIG['volumes'])
+    assert (b['hostname'], b['volumes'][0]['uuid']) == ('b', 'f0f0')
+    assert 'targets' not in a and 'fanout' not in b
+    with pytest.raises(ValueError):
+        fanout.target_configs(dict(CONFIG, targets=[{'installroot': '/mnt/a', 'packages': ['kernel']}]))
+    with pytest.raises(ValueError):
+        fanout.target_configs(dict(CONFIG, targets=[{'installroot': '/mnt/a'}, {'installroot': '/mnt/a/'}]))
+    with pytest.raises(ValueError):
+        fanout.target_configs(dict(CONFIG, targets=[{'hostname': 'c'}]))
+
+
+@pytest.fixture
+def fan(tmp_path, monkeypatch):
+    # no repos to load: every installer gets a stand-in for the shared Packages
+    monkeypatch.setattr(fanout, 'Installer', functools.partial(Installer, packages=object()))
+    roots = [str(tmp_path / name) for name in 'abc']
+    fan = fanout.FanOut(dict(CONFIG, targets=[{'installroot': r, 'hostname': os.path.basename(r)} for r in roots]))
+    fan.resolved = (['a-1.0-1.noarch'], None)
+    fan.images = ImageCache(str(tmp_path / 'images'), format='tar.zst', threads=2)
+    return fan
+
+
+@pytest.mark.skipif(not shutil.which('zstd'), reason='needs zstd')
+def test_copy_mode(fan, monkeypatch):
+    def instRoot(resolved):
+        os.makedirs(os.path.join(fan.primary.chroot_path, 'etc'))
+        with open(os.path.join(fan.primary.chroot_path, 'etc/os-release'), 'w') as f:
+            f.write('NAME=Ultramarine\n')
+    monkeypatch.setattr(fan.primary, 'instRoot', instRoot)
+
+    def one(n, installer):
+        fan.rootfs(n)()
+        # each target's own configuration goes in after the first one is imaged
+        with open(os.path.join(installer.chroot_path, 'etc/hostname'), 'w') as f:
+            f.write(installer.config['hostname'])
+    assert set(fan.run(one).values()) == {None}
+    for installer in fan.installers:
+        with open(os.path.join(installer.chroot_path, 'etc/hostname')) as f:
+            assert f.read() == os.path.basename(installer.chroot_path)
+        assert os.path.exists(os.path.join(installer.chroot_path, 'etc/os-release'))
+    assert all(os.path.exists(os.path.join(i.chroot_path, '.autorelabel')) for i in fan.installers[1:])
+
+
+def test_failed_target(fan):
+    def one(n, installer):
+        if n == 0:
+            raise RuntimeError('mount failed')
+        # copy mode waits for the first target, and gets its error
+        fan.rootfs(n)()
+    errors = fan.run(one)
+    assert [str(e) for e in errors.values()] == ['mount failed'] * 3
+
+
+class Repo:
+    def __init__(self, id):
+        self.id = id
+        self.pkgdir = '/mnt/sysimage/var/cache/dnf'
+
+
+class Package:
+    def __init__(self, name, repo):
+        self.name = name
+        self.repo = repo
+
+    def localPkg(self):
+        return os.path.join(self.repo.pkgdir, f'{self.name}.rpm')
+
+
+class FakePackages:
+    # the parts of Packages rpm mode uses, without dnf
+    def __init__(self):
+        repo = Repo('fedora')
+        self.dnf = types.SimpleNamespace(repos=types.SimpleNamespace(iter_enabled=lambda: [repo]),
+                                         transaction=types.SimpleNamespace(install_set=[Package('a', repo), Package('b', repo)]))
+        self.downprogress = None
+        self.downloaded = []
+
+    def download(self, pkgs, progress=None):
+        self.downloaded.append([p.localPkg() for p in pkgs])
+
+
+def test_rpm_mode(tmp_path, monkeypatch):
+    monkeypatch.setattr(fanout, 'Installer', functools.partial(Installer, packages=FakePackages()))
+    roots = [str(tmp_path / name) for name in 'ab']
+    fan = fanout.FanOut(dict(CONFIG, fanout={'mode': 'rpm'}, targets=[{'installroot': r} for r in roots]))
+    monkeypatch.setattr(fan.primary, 'resolve', lambda: (['a-1.0-1.noarch', 'b-1.0-1.noarch'], None))
+    fan.primary.copr_files.update({'etc/yum.repos.d/cappy.repo': b'[copr:cappy]\n'})
+    ran = []
+    monkeypatch.setattr(fanout.subprocess, 'run', lambda cmd, **kw: ran.append(cmd) or subprocess.CompletedProcess(cmd, 0))
+    try:
+        fan.prepare()
+        # downloaded once, to the staging directory and not the unmounted first installroot
+        staged = [os.path.join(fan.staging, 'fedora', f'{name}.rpm') for name in 'ab']
+        assert fan.primary.packages.downloaded == [staged]
+        assert fan.paths == staged
+        assert set(fan.run(lambda n, installer: fan.rootfs(n)()).values()) == {None}
+    finally:
+        fan.close()
+    assert sorted(ran) == sorted(['rpm', '--root', root, '--install', '--quiet', *staged] for root in roots)
+    for root in roots:
+        with open(os.path.join(root, 'etc/yum.repos.d/cappy.repo'), 'rb') as f:
+            assert f.read() == b'[copr:cappy]\n'
+        assert os.path.exists(os.path.join(root, '.autorelabel'))
@@ -0,0 +1,91 @@
+import http.server
+import threading
+import pytest
+import requests
+from libcappy import httpcache
+from libcappy.httpcache import HTTPCache
+from libcappy.repository import Copr
+
+
+class RepoServer(http.server.BaseHTTPRequestHandler):
+    # serves a .repo file with an ETag and answers 304 when it matches
+    requests: list = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = b'[copr:cappy:test]\n'
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+@pytest.fixture
+def server():
+    RepoServer.requests = []
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RepoServer)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+
+
+def test_http_cache(server, tmp_path):
+    url = f'http://127.0.0.1:{server.server_port}'
+    cache = HTTPCache(str(tmp_path), ttl=3600)
+    copr = Copr(cache=cache)
+    assert copr.get_repo('cappy/test', 'fedora-36-x86_64', copr_url=url) == '[copr:cappy:test]\n'
+    assert copr.get_repo('cappy/test', 'fedora-36-x86_64', copr_url=url) == '[copr:cappy:test]\n'
+    assert RepoServer.requests == [None]
+    # expired: revalidated with the ETag
+    cache.ttl = 0
+    assert copr.get_repo('cappy/test', 'fedora-36-x86_64', copr_url=url) == '[copr:cappy:test]\n'
+    assert RepoServer.requests == [None, '"v1"']
+    # offline: the stale copy is served
+    server.shutdown()
+    server.server_close()
+    assert copr.get_repo('cappy/test', 'fedora-36-x86_64', copr_url=url) == '[copr:cappy:test]\n'
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.revalidations, cache.stats.stale) == (1, 1, 1, 1)
+
+
+def test_http_cache_eviction(tmp_path):
+    cache = HTTPCache(str(tmp_path), max_size=10)
+    cache.put('http://a', 200, {}, b'123456')
+    cache.put('http://b', 200, {}, b'123456')
+    assert cache.get('http://a') is None and cache.get('http://b')
+    assert cache.stats.evicted == 1
+
+
+def test_http_cache_from_config(tmp_path):
+    # nothing is written to the host's cache directory until something is stored
+    assert HTTPCache.from_config(False) is None
+    assert HTTPCache.from_config({'path': str(tmp_path), 'ttl': 5}).ttl == 5
+    for value in (True, None):
+        cache = HTTPCache.from_config(value)
+        assert (cache.ttl, cache.max_size) == (3600, 64 << 20)
+    with pytest.raises(ValueError):
+        HTTPCache.from_config('yes')
+
+
+def test_http_cache_timeout(tmp_path, monkeypatch):
+    cache = HTTPCache(str(tmp_path / 'http'), ttl=0)
+    assert not (tmp_path / 'http').exists()
+    cache.put('http://copr.invalid/repo', 200, {}, b'[copr:cappy:test]\n')
+    session = requests.Session()
+    session.mount('http://', httpcache.CachingAdapter(cache))
+
+    def timeout(*args, **kwargs):
+        raise requests.exceptions.ReadTimeout('Copr is slow')
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, 'send', timeout)
+    # a slow server is like an unreachable one: the stale copy is served
+    assert session.get('http://copr.invalid/repo').content == b'[copr:cappy:test]\n'
+    assert cache.stats.stale == 1
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        session.get('http://copr.invalid/other')
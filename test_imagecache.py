@@ -0,0 +1,26 @@
+import os
+import shutil
+import pytest
+from libcappy.imagecache import ImageCache
+
+
+def test_key():
+    assert ImageCache.key(['b-1.0-1.noarch', 'a-1.0-1.noarch'], {'releasever': 36}) == ImageCache.key(['a-1.0-1.noarch', 'b-1.0-1.noarch'], {'releasever': 36})
+    assert ImageCache.key(['a-1.0-1.noarch'], {'releasever': 36}) != ImageCache.key(['a-1.0-1.noarch'], {'releasever': 37})
+
+
+@pytest.mark.skipif(not shutil.which('zstd'), reason='needs zstd')
+def test_tar_roundtrip(tmp_path):
+    root = tmp_path / 'root'
+    (root / 'etc').mkdir(parents=True)
+    (root / 'proc').mkdir()
+    (root / 'etc/os-release').write_text('NAME=Ultramarine\n')
+    (root / 'proc/junk').write_text('x')
+    images = ImageCache(str(tmp_path / 'images'), format='tar.zst', threads=2)
+    key = ImageCache.key(['a-1.0-1.noarch'])
+    assert images.lookup(key) is None
+    images.store(key, str(root))
+    assert images.lookup(key)
+    images.extract(key, str(tmp_path / 'new'))
+    assert (tmp_path / 'new/etc/os-release').read_text() == 'NAME=Ultramarine\n'
+    assert os.path.isdir(tmp_path / 'new/proc') and not os.path.exists(tmp_path / 'new/proc/junk')
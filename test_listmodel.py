@@ -0,0 +1,124 @@
+from libcappy.listmodel import FilterIndex, TableModel, Viewport
+from tests.terminal import measure
+
+
+def rows(n: int):
+    return [{'*': '', 'NAME': f'pkg{i}', 'SIZE': '1K'} for i in range(n)]
+
+
+def test_table_model_lines():
+    ds = rows(5)
+    model = TableModel(ds)
+    assert model.rows is ds
+    assert model.header == '*│NAME│SIZE'
+    assert model.line(3) == ' │pkg3│1K  '
+    assert model.width == len(model.header)
+    # edits show up when the row is drawn again, a longer value widens its column
+    ds[3]['*'] = '*'
+    assert model.line(3) == '*│pkg3│1K  '
+    ds[1]['NAME'] = 'a-much-longer-name'
+    assert model.line(0) == ' │pkg0│1K  '
+    assert model.line(1) == ' │a-much-longer-name│1K  '
+    assert model.line(0) == ' │pkg0              │1K  '
+    assert model.width == len(model.line(4))
+
+
+def test_table_model_stream():
+    pulled = []
+
+    def listing():
+        # a paged API listing, 100 rows a page
+        for page in range(1000):
+            pulled.append(page)
+            yield from ({'*': '', 'NAME': f'pkg{page}-{i}'} for i in range(100))
+    model = TableModel(listing())
+    assert (len(model), model.cols, model.done) == (0, [], False)
+    assert model.load(150) == 150
+    assert (len(model), pulled, model.widths) == (150, [0, 1], [1, 7])
+    assert model.load(100) == 0
+    assert model[149] == {'*': '', 'NAME': 'pkg1-49'}
+    assert TableModel.of(model) is model
+    assert model.load() == 100000 - 150
+    assert model.done and len(pulled) == 1000
+    assert model.widths == [1, 9]
+
+
+def test_viewport_select():
+    view = Viewport(100, 10, 20, 40)
+    assert view.select(1) == {0, 1}
+    assert view.select(9) == {1, 9}
+    # moving past the bottom scrolls, which repaints everything
+    assert view.select(10) is None
+    assert (view.sy, view.line(10), view.line(0)) == (1, 9, None)
+    assert view.select(9) == {8, 9}
+    assert view.select(-1) is None
+    assert (view.sel, view.sy) == (99, 90)
+    assert view.select(100) is None
+    assert (view.sel, view.sy) == (0, 0)
+    assert list(Viewport(3, 10, 20, 40).visible()) == [0, 1, 2]
+
+
+def test_viewport_scroll_x():
+    view = Viewport(100, 10, 20, 50)
+    view.scroll_x(-1)
+    assert view.sx == 30
+    view.scroll_x(31)
+    assert view.sx == 0
+    view.scroll_x(25)
+    view.resize(100, 30)
+    assert view.sx == 10
+    view.resize(100, 10)
+    assert (view.max_sx, view.sx) == (0, 0)
+
+
+def locales(n: int):
+    names = ['English', 'German', 'French', 'Spanish', 'Swiss German', 'Portuguese']
+    return [{'*': '', 'Locale': f'xx_{i:05d}.UTF-8', 'Name': f'{names[i % len(names)]} locale {i}'} for i in range(n)]
+
+
+def test_filter_ranking():
+    ds = locales(12) + [{'*': '', 'Locale': 'gsw_CH.UTF-8', 'Name': 'Alemannic German'}]
+    model = TableModel(ds)
+    index = FilterIndex(model)
+    assert index.match('') is None
+    # the field starting with it first, then a word starting with it
+    assert index.match('german') == [1, 7, 4, 10, 12]
+    assert index.match('GERMAN LOC') == [1, 7, 4, 10]
+    assert index.match('erman') == [1, 4, 7, 10, 12]
+    # typos only find fuzzy matches, the closest first
+    assert index.match('portugese') == [5, 11]
+    assert index.match('zzzz') == []
+
+
+def test_filter_sync():
+    ds = locales(10)
+    model = TableModel(ds)
+    index = FilterIndex(model)
+    assert index.match('french') == [2, 8]
+    # selecting a row changes nothing that is searched, filtering keeps the selection
+    ds[2]['*'] = '*'
+    assert not index.sync(model, [2])
+    assert index.match('frenc') == [2, 8]
+    assert model[2]['*'] == '*'
+    ds[3]['Name'] = 'French locale 3'
+    assert index.sync(model, [3])
+    assert index.match('french') == [2, 3, 8]
+    ds.append({'*': '', 'Locale': 'fr_FR.UTF-8', 'Name': 'French'})
+    assert index.sync(model)
+    assert index.match('french') == [2, 3, 8, 10]
+
+
+def test_filter_large():
+    # how fast this is is up to benchmarks.listmodel
+    index = FilterIndex(TableModel(locales(30000)))
+    assert index.match('locale 12')[:3] == [12, 120, 121]
+    assert index.match('xx_0123')[:10] == list(range(1230, 1240))
+    assert len(index.match('swis')) == 5000
+
+
+def test_keypress_repaints_little():
+    # a full frame of the benchmark's list is about 1.8K; toggling a row and moving
+    # the selection inside the page should only send the lines that changed
+    keys = measure(50, presses=5, quiet=0.1)[0]
+    assert keys['toggle']['bytes'] < 200
+    assert keys['down']['bytes'] < 200
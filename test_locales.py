@@ -0,0 +1,45 @@
+import os
+from libcappy import locales
+
+LOCALE_AV = '''locale: C.utf8          directory: /usr/lib/locale/C.utf8
+-------------------------------------------------------------------------------
+    title | C locale
+    email | bug-glibc-locales@gnu.org
+  codeset | UTF-8
+
+locale: en_US.utf8      archive: /usr/lib/locale/locale-archive
+-------------------------------------------------------------------------------
+    title | English locale for the USA
+   source | Free Software Foundation, Inc.
+  codeset | UTF-8
+'''
+
+
+def test_parse_locale_av():
+    assert locales.parse_locale_av(LOCALE_AV) == [['C.utf8', 'C locale'], ['en_US.utf8', 'English locale for the USA']]
+
+
+def test_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(locales, 'CACHE_PATH', str(tmp_path / 'cache'))
+    source = tmp_path / 'locale-archive'
+    source.write_text('a')
+    calls = []
+
+    def load():
+        calls.append(1)
+        return [['C.utf8', 'C locale']]
+    assert locales.cached('locales', [str(source)], load) == [['C.utf8', 'C locale']]
+    assert locales.cached('locales', [str(source)], load) == [['C.utf8', 'C locale']]
+    assert len(calls) == 1
+    st = source.stat()
+    os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    locales.cached('locales', [str(source)], load)
+    assert len(calls) == 2
+
+
+def test_keymap_dir_names(tmp_path):
+    for path in ('i386/qwerty/us.map.gz', 'i386/qwertz/de.map.gz', 'i386/include/qwerty-layout.inc',
+                 'i386/include/euro.map', 'legacy/i386/azerty/fr.map'):
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text('')
+    assert locales._keymap_dir_names([str(tmp_path)]) == ['de', 'fr', 'us']
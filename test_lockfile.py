@@ -0,0 +1,14 @@
+from libcappy.lockfile import Lockfile
+
+
+def test_lockfile(tmp_path):
+    path = str(tmp_path / 'cappy.lock.yml')
+    specs, opts, sums = ['@core', 'kernel'], {'releasever': 36}, {'fedora': 'aa', 'updates': 'bb'}
+    assert Lockfile(path).packages(specs, opts, sums) is None
+    Lockfile(path).write(specs, opts, sums, ['kernel-5.19.6-200.fc36.x86_64', 'bash-5.1.16-2.fc36.x86_64'])
+    lock = Lockfile(path)
+    assert lock.packages(specs, opts, sums) == ['bash-5.1.16-2.fc36.x86_64', 'kernel-5.19.6-200.fc36.x86_64']
+    # any change to the metadata, specs or options invalidates it
+    assert lock.packages(specs, opts, {'fedora': 'aa', 'updates': 'cc'}) is None
+    assert lock.packages(specs + ['nano'], opts, sums) is None
+    assert lock.packages(specs, {'releasever': 37}, sums) is None
@@ -0,0 +1,93 @@
+import json
+import os
+import time
+import types
+import pytest
+
+pytest.importorskip('dnf')
+from libcappy.metadata import STAMP_FILE, LoadInfo, Metadata
+
+COMPS = types.SimpleNamespace(
+    environments_iter=lambda: [types.SimpleNamespace(id='minimal-environment', ui_name='Minimal Install', ui_description=None)],
+    groups_iter=lambda: [types.SimpleNamespace(id='core', ui_name='Core', ui_description='Smallest possible installation')],
+)
+
+
+@pytest.fixture
+def metadata(tmp_path, monkeypatch):
+    # Metadata for one local repo, with fill_sack only counting its calls
+    fills = []
+
+    def make():
+        meta = Metadata(cachedir=str(tmp_path), system_repos=False, repos=[{'id': 'local', 'baseurl': 'file:///srv/repo'}])
+        monkeypatch.setattr(meta.base, 'fill_sack', lambda **kw: fills.append(meta))
+        monkeypatch.setattr(meta.base, '_comps', COMPS)
+        return meta
+    make.fills = fills
+    return make
+
+
+def write_repomd(meta, text):
+    repodata = os.path.join(meta.base.repos['local']._repo.getCachedir(), 'repodata')
+    os.makedirs(repodata, exist_ok=True)
+    with open(os.path.join(repodata, 'repomd.xml'), 'w') as f:
+        f.write(text)
+
+
+def test_load_info():
+    assert str(LoadInfo('0123456789abcdef', 0.25, True)) == '250ms (cached, 0123456789ab)'
+    assert str(LoadInfo('0123456789abcdef', 1.5, False)) == '1500ms (refreshed, 0123456789ab)'
+
+
+def test_cache_miss_then_hit(metadata, tmp_path):
+    first = metadata()
+    write_repomd(first, '<repomd>1</repomd>')
+    assert not first.fresh()
+    info = first.fill()
+    assert not info.from_cache and info.key == first.key()
+    # filled once
+    assert first.fill() is info and len(metadata.fills) == 1
+    with open(tmp_path / STAMP_FILE) as f:
+        assert json.load(f)[first.config_key()]['key'] == info.key
+    second = metadata()
+    assert second.fresh()
+    cached = second.fill()
+    assert cached.from_cache and cached.key == info.key
+    assert len(metadata.fills) == 2
+
+
+def test_cache_invalidation(metadata, tmp_path):
+    first = metadata()
+    write_repomd(first, '<repomd>1</repomd>')
+    first.fill()
+    # the mirror published new metadata
+    write_repomd(first, '<repomd>2</repomd>')
+    second = metadata()
+    assert not second.fresh()
+    assert not second.fill().from_cache
+    # expired
+    with open(tmp_path / STAMP_FILE) as f:
+        stamps = json.load(f)
+    stamps[second.config_key()]['time'] = time.time() - second.conf.metadata_expire - 1
+    with open(tmp_path / STAMP_FILE, 'w') as f:
+        json.dump(stamps, f)
+    assert not metadata().fresh()
+
+
+def test_comps_cache(metadata, tmp_path):
+    first = metadata()
+    write_repomd(first, '<repomd>1</repomd>')
+    envs, groups = first.comps()
+    assert envs == [{'id': 'minimal-environment', 'name': 'Minimal Install', 'description': ''}]
+    assert groups == [{'id': 'core', 'name': 'Core', 'description': 'Smallest possible installation'}]
+    assert not first.comps_info.from_cache
+    assert os.path.exists(tmp_path / f'cappy-comps-{first.key()}.json')
+    # served from the JSON cache, without filling the sack
+    second = metadata()
+    assert second.comps() == (envs, groups)
+    assert second.comps_info.from_cache and len(metadata.fills) == 1
+    # new metadata: the cached comps are not used
+    write_repomd(second, '<repomd>2</repomd>')
+    third = metadata()
+    assert third.comps() == (envs, groups)
+    assert not third.comps_info.from_cache and len(metadata.fills) == 2
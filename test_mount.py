@@ -0,0 +1,117 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from libcappy import mount
+from libcappy.mount import Mount, MountTable
+
+
+def _can_mount() -> bool:
+    if os.geteuid() != 0 or mount._libc is None:
+        return False
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        try:
+            mount._sys_mount(Mount('tmpfs', d, 'tmpfs'))
+        except OSError:
+            return False
+        mount._sys_umount(Mount('tmpfs', d))
+    return True
+
+
+needs_mount = pytest.mark.skipif(not _can_mount(), reason='needs privileges to mount tmpfs')
+
+
+def test_parse_options():
+    assert mount.parse_options('rw') == (0, '')
+    assert mount.parse_options('defaults,noatime,nofail,x-systemd.device-timeout=0') == (mount.MS_NOATIME, '')
+    assert mount.parse_options('ro,nosuid,compress=zstd:1,subvol=home') == (mount.MS_RDONLY | mount.MS_NOSUID, 'compress=zstd:1,subvol=home')
+    # the last of a pair wins, as with mount(8)
+    assert mount.parse_options('ro,rw,umask=0077') == (0, 'umask=0077')
+
+
+def test_resolve_device():
+    assert mount.resolve_device('/dev/vda1') == '/dev/vda1'
+    assert mount.resolve_device('tmpfs') == 'tmpfs'
+    with pytest.raises(OSError):
+        mount.resolve_device('UUID=00000000-0000-0000-0000-00000000cafe')
+
+
+def test_levels():
+    table = MountTable('/mnt/sysimage')
+    volumes = table.volumes([
+        {'device': 'UUID=efi', 'mountpoint': '/boot/efi', 'filesystem': 'vfat', 'opts': 'umask=0077'},
+        {'device': 'UUID=home', 'mountpoint': '/home', 'filesystem': 'btrfs', 'opts': 'subvol=home'},
+        {'device': 'UUID=swap', 'mountpoint': 'none', 'filesystem': 'swap', 'opts': 'defaults'},
+        {'device': 'UUID=boot', 'mountpoint': '/boot', 'filesystem': 'ext4', 'opts': 'rw'},
+        {'device': 'UUID=root', 'mountpoint': '/', 'filesystem': 'btrfs', 'opts': 'subvol=root'},
+        {'device': 'UUID=booted', 'mountpoint': '/bootloader', 'filesystem': 'ext4', 'opts': 'rw'},
+    ])
+    assert [[m.target for m in level] for level in mount.levels(volumes)] == [
+        ['/mnt/sysimage'],
+        ['/mnt/sysimage/home', '/mnt/sysimage/boot', '/mnt/sysimage/bootloader'],
+        ['/mnt/sysimage/boot/efi'],
+    ]
+
+
+@needs_mount
+def test_mount_all(tmp_path):
+    root = str(tmp_path / 'root')
+    fstab = [{'device': 'tmpfs', 'mountpoint': m, 'filesystem': 'tmpfs', 'opts': 'size=1M,nofail'}
+             for m in ['/boot/efi', '/home', '/', '/boot', '/var']]
+    with MountTable(root) as table:
+        table.mount_all(table.volumes(fstab))
+        # the nested mountpoint was created on /boot's filesystem, not under it
+        assert all(os.path.ismount(table.path(e['mountpoint'])) for e in fstab)
+        assert [m.target for m in table.mounted[:1]] == [root]
+        table.bind_api()
+        table.bind_api()
+        assert os.path.ismount(os.path.join(root, 'proc'))
+        assert len(table.api) == len({m.target for m in table.api})
+        # no placeholder resolv.conf for a root without one
+        resolv = os.path.join(root, 'etc/resolv.conf')
+        with table.resolv() as bound:
+            assert not bound and not os.path.lexists(resolv)
+        if os.path.isfile('/etc/resolv.conf'):
+            os.makedirs(os.path.dirname(resolv))
+            open(resolv, 'w').close()
+            with table.resolv() as bound:
+                assert bound and os.path.samefile(resolv, '/etc/resolv.conf')
+            assert not os.path.samefile(resolv, '/etc/resolv.conf')
+        table.unmount_all()
+        shutil.rmtree(os.path.join(root, 'etc'), ignore_errors=True)
+    assert not os.path.ismount(root) and not os.listdir(root)
+
+
+@needs_mount
+def test_mount_all_failure(tmp_path):
+    root = str(tmp_path / 'root')
+    table = MountTable(root)
+    volumes = table.volumes([{'device': 'tmpfs', 'mountpoint': m, 'filesystem': 'tmpfs', 'opts': 'size=1M'}
+                             for m in ['/', '/home', '/var']])
+    volumes.append(Mount('none', table.path('/var/lib'), 'no-such-filesystem'))
+    with pytest.raises(OSError):
+        table.mount_all(volumes)
+    assert table.mounted == []
+    assert not os.path.ismount(root) and not os.listdir(root)
+
+
+@needs_mount
+@pytest.mark.skipif(not shutil.which('mkfs.ext4') or not shutil.which('losetup'), reason='needs mkfs.ext4 and losetup')
+def test_mount_by_tag_after_mkfs(tmp_path):
+    image = tmp_path / 'disk.img'
+    subprocess.run(['truncate', '-s', '64M', image], check=True)
+    loop = subprocess.run(['losetup', '-f', '--show', image], capture_output=True, text=True, check=True).stdout.strip()
+    try:
+        # no udev settle, and a label /dev/disk/by-label would escape
+        subprocess.run(['mkfs.ext4', '-q', '-L', 'my root/1', loop], check=True)
+        uuid = subprocess.run(['blkid', '-p', '-s', 'UUID', '-o', 'value', loop], capture_output=True, text=True, check=True).stdout.strip()
+        assert mount.resolve_device('LABEL="my root/1"') == loop
+        with MountTable(str(tmp_path / 'root')) as table:
+            table.mount_all(table.volumes([{'device': f'UUID={uuid}', 'mountpoint': '/', 'filesystem': 'ext4', 'opts': 'rw'}]))
+            assert os.path.ismount(table.root)
+            table.unmount_all()
+    finally:
+        subprocess.run(['losetup', '-d', loop])
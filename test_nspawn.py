@@ -0,0 +1,38 @@
+import pytest
+import libcappy.nspawn as nspawn
+
+
+@pytest.fixture
+def session(monkeypatch, tmp_path):
+    # run the session shell on the host: drop "--pipe -D <root>" and exec the rest
+    monkeypatch.setattr(nspawn, 'NSPAWN_ARGS', ['sh', '-c', 'shift 3; exec "$@"', 'nspawn'])
+    with nspawn.NspawnSession(str(tmp_path)) as s:
+        yield s
+
+
+def test_nspawn_session(session):
+    assert session.run('echo hello; echo world').output == 'hello\nworld\n'
+    assert session.run('exit 3').returncode == 3
+    session.submit('sleep 0.2; echo slow')
+    session.submit('echo fast >&2; false')
+    slow, fast = session.wait()
+    assert (slow.output, slow.returncode) == ('slow\n', 0)
+    assert (fast.output, fast.returncode) == ('fast\n', 1)
+    assert session.run('printf x').output == 'x'
+    assert len(session.results) == 5
+
+
+def test_session_argv(monkeypatch, tmp_path):
+    started = []
+
+    def popen(argv, **kwargs):
+        started.append(argv)
+        raise OSError('not starting it')
+    monkeypatch.setattr(nspawn.subprocess, 'Popen', popen)
+    with pytest.raises(OSError):
+        nspawn.NspawnSession(str(tmp_path)).start()
+    argv = started[0]
+    assert argv[0] == 'systemd-nspawn'
+    # commands come from a pipe, which nspawn only passes on with the pipe console
+    assert '--pipe' in argv
+    assert argv[argv.index('-D') + 1:] == [str(tmp_path), '/bin/bash', '--noprofile', '--norc', '-s']
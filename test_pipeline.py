@@ -0,0 +1,100 @@
+import threading
+import types
+import pytest
+
+pytest.importorskip('dnf')
+pytest.importorskip('rpm')
+from libcappy.packages import Packages, strongly_connected
+
+
+def test_strongly_connected():
+    # 3 needs 0, 0 needs 1, and 1 and 2 need each other; 4 stands alone
+    graph = [[1], [2], [1], [0], []]
+    sccs = strongly_connected(graph)
+    assert sorted(map(sorted, sccs)) == [[0], [1, 2], [3], [4]]
+    order = {v: n for n, scc in enumerate(sccs) for v in scc}
+    # every requirement comes in the same component or an earlier one
+    assert all(order[w] <= order[v] for v, deps in enumerate(graph) for w in deps)
+
+
+class Query(list):
+    def filterm(self, pkg):
+        return Query(pkg)
+
+    def filter(self, provides):
+        return Query(p for p in self if p.name in provides)
+
+
+class Package:
+    # hashable, like hawkey packages
+    def __init__(self, name, *requires):
+        self.name = name
+        self.requires = list(requires)
+
+
+def packages(**attrs) -> Packages:
+    # a Packages without dnf behind it, only what the pipeline uses
+    pkgs = Packages.__new__(Packages)
+    pkgs.__dict__.update(attrs)
+    return pkgs
+
+
+def test_dependency_batches():
+    glibc, bash, filesystem, setup, vim = (Package('glibc', 'filesystem'), Package('bash', 'glibc'),
+                                           Package('filesystem', 'setup'), Package('setup', 'filesystem'),
+                                           Package('vim', 'bash', 'glibc'))
+    pkgs = [vim, bash, glibc, filesystem, setup]
+    sack = types.SimpleNamespace(query=lambda: Query(pkgs))
+    loader = packages(dnf=types.SimpleNamespace(sack=sack))
+    batches = loader.dependency_batches(pkgs, batch_size=1)
+    # the setup/filesystem cycle stays in one batch, even over the batch size
+    assert sorted(p.name for p in batches[0]) == ['filesystem', 'setup']
+    assert [[p.name for p in b] for b in batches[1:]] == [['glibc'], ['bash'], ['vim']]
+    # a batch takes whole components until it reaches the batch size
+    assert [len(b) for b in loader.dependency_batches(pkgs, batch_size=3)] == [3, 2]
+
+
+def pipeline(batches, download, rpm_install):
+    return packages(dependency_batches=lambda pkgs, batch_size: batches, download=download, rpm_install=rpm_install)
+
+
+def test_pipeline_overlaps():
+    second = threading.Event()
+    installed = []
+
+    def download(batch, progress=None):
+        if batch == ['b']:
+            second.set()
+
+    def rpm_install(batch):
+        if batch == ['a']:
+            # the next batch downloads while this one installs
+            assert second.wait(5)
+        installed.append(batch)
+    stats = pipeline([['a'], ['b'], ['c']], download, rpm_install).pipeline_install(['a', 'b', 'c'])
+    assert installed == [['a'], ['b'], ['c']]
+    assert stats.batches == 3
+
+
+def test_pipeline_download_error():
+    installed = []
+
+    def download(batch, progress=None):
+        if batch == ['b']:
+            raise OSError('mirror went away')
+    with pytest.raises(OSError, match='mirror went away'):
+        pipeline([['a'], ['b'], ['c']], download, installed.append).pipeline_install([])
+    assert installed == [['a']]
+
+
+def test_pipeline_rpm_error_stops_downloader():
+    downloaded = []
+
+    def rpm_install(batch):
+        raise RuntimeError('rpm transaction failed')
+    batches = [[n] for n in range(10)]
+    with pytest.raises(RuntimeError, match='rpm transaction failed'):
+        pipeline(batches, lambda batch, progress=None: downloaded.append(batch), rpm_install).pipeline_install([])
+    # the downloader is not left blocked on the full queue, and stopped early
+    assert not any(t.name == 'cappy-download' for t in threading.enumerate())
+    assert len(downloaded) < len(batches)
@@ -0,0 +1,111 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from libcappy.installer import CfgParser
+from libcappy import provision
+from libcappy.provision import Provisioner, mkfs_command, partition_path, sfdisk_script
+
+
+def _can_loop() -> bool:
+    return os.geteuid() == 0 and bool(shutil.which('losetup')) and os.path.exists('/dev/loop-control')
+
+
+@pytest.fixture
+def loop(tmp_path):
+    """Attaches sparse files as loop devices, detached again after the test."""
+    devices = []
+
+    def attach(size: str = '64M', partscan: bool = False) -> str:
+        image = tmp_path / f'disk{len(devices)}.img'
+        subprocess.run(['truncate', '-s', size, image], check=True)
+        device = subprocess.run(['losetup', '-f', '--show'] + (['-P'] if partscan else []) + [image],
+                                capture_output=True, text=True, check=True).stdout.strip()
+        devices.append(device)
+        return device
+    yield attach
+    for device in devices:
+        subprocess.run(['losetup', '-d', device])
+
+
+def test_sfdisk_script():
+    disk = {'device': '/dev/nvme0n1', 'table': 'gpt', 'partitions': [
+        {'size': '600M', 'type': 'uefi', 'name': 'EFI System'},
+        {'size': '1G'},
+        {'type': 'linux'},
+    ]}
+    assert sfdisk_script(disk) == 'label: gpt\nsize=600M, type=uefi, name="EFI System"\nsize=1G, type=linux\ntype=linux\n'
+    assert partition_path('/dev/nvme0n1', 2) == '/dev/nvme0n1p2'
+    assert partition_path('/dev/vda', 3) == '/dev/vda3'
+
+
+def test_mkfs_command():
+    assert mkfs_command('ext4', '/dev/vda3', label='root', options='-O ^has_journal') == \
+        ['mkfs.ext4', '-F', '-q', '-L', 'root', '-O', '^has_journal', '/dev/vda3']
+    assert mkfs_command('vfat', '/dev/vda1', label='EFI', uuid='ignored', options=['-F', '32']) == \
+        ['mkfs.vfat', '-n', 'EFI', '-F', '32', '/dev/vda1']
+    assert mkfs_command('f2fs', '/dev/vdb') == ['mkfs.f2fs', '/dev/vdb']
+
+
+def test_plan():
+    volumes = [
+        {'device': '/dev/vda1', 'mountpoint': '/boot/efi', 'filesystem': 'vfat', 'format': True},
+        {'device': '/dev/vda2', 'mountpoint': '/', 'filesystem': 'btrfs', 'format': True, 'opts': 'subvol=root'},
+        {'device': '/dev/vda2', 'mountpoint': '/home', 'filesystem': 'btrfs', 'format': True, 'opts': 'subvol=home'},
+        {'device': '/dev/vdb', 'mountpoint': '/var', 'filesystem': 'xfs', 'format': True},
+        {'uuid': 'f0f0', 'mountpoint': '/srv', 'filesystem': 'ext4'},
+    ]
+    sched = Provisioner(volumes, [{'device': '/dev/vda', 'partitions': [{'size': '600M', 'type': 'uefi'}, {}]}]).plan()
+    assert {name: step.deps for name, step in sched.steps.items()} == {
+        'partition /dev/vda': [],
+        'mkfs /dev/vda1': ['partition /dev/vda'],
+        'mkfs /dev/vda2': ['partition /dev/vda'],
+        'mkfs /dev/vdb': [],
+    }
+    with pytest.raises(ValueError):
+        Provisioner([{'device': '/dev/vdb', 'filesystem': 'ext4', 'format': True},
+                     {'device': '/dev/vdb', 'filesystem': 'xfs', 'format': True}]).plan()
+
+
+def test_btrfs_subvolumes(monkeypatch):
+    ran = []
+    monkeypatch.setattr(provision, '_run', lambda cmd, stdin=None: ran.append(cmd))
+    Provisioner.subvolumes('/dev/vda2', [{'opts': 'subvol=root,compress=zstd'}, {'opts': 'subvol=/home'}, {'opts': 'rw'}])
+    top = ran[0][-1]
+    assert ran == [['mount', '-t', 'btrfs', '/dev/vda2', top],
+                   ['btrfs', 'subvolume', 'create', f'{top}/root'],
+                   ['btrfs', 'subvolume', 'create', f'{top}/home'],
+                   ['umount', top]]
+
+
+@pytest.mark.skipif(not _can_loop(), reason='needs root and loop devices')
+def test_provision_loop_devices(loop):
+    volumes = [
+        {'device': loop(), 'mountpoint': '/', 'filesystem': 'ext4', 'format': True, 'label': 'root'},
+        {'device': loop(), 'mountpoint': '/var', 'filesystem': 'ext4', 'format': True, 'mkfs_options': '-m 0'},
+        {'device': loop(), 'mountpoint': 'swap', 'filesystem': 'swap', 'format': True,
+         'uuid': '0b9b3c1e-5b1a-4f7e-9d55-3f2a3c4d5e6f'},
+    ]
+    provisioner = Provisioner(volumes)
+    uuids = provisioner.run()
+    assert volumes[2]['uuid'] == '0b9b3c1e-5b1a-4f7e-9d55-3f2a3c4d5e6f'
+    for volume in volumes:
+        found = subprocess.run(['blkid', '-p', '-o', 'export', volume['device']], capture_output=True, text=True).stdout
+        assert f"UUID={volume['uuid']}" in found and f"TYPE={volume['filesystem']}" in found
+        assert uuids[volume['device']] == volume['uuid']
+    assert CfgParser({'volumes': volumes}).fstab()[0]['device'] == f"UUID={volumes[0]['uuid']}"
+    # one line per device in the timing report
+    assert all(f"mkfs {v['device']}" in provisioner.report() for v in volumes)
+
+
+@pytest.mark.skipif(not _can_loop() or not shutil.which('sfdisk'), reason='needs root, loop devices and sfdisk')
+def test_provision_partitions(loop):
+    disk = loop('128M', partscan=True)
+    volumes = [
+        {'device': partition_path(disk, 1), 'mountpoint': '/boot', 'filesystem': 'ext4', 'format': True},
+        {'device': partition_path(disk, 2), 'mountpoint': '/', 'filesystem': 'ext4', 'format': True},
+    ]
+    Provisioner(volumes, [{'device': disk, 'table': 'gpt', 'partitions': [{'size': '32M'}, {}]}]).run()
+    assert all(v['uuid'] for v in volumes)
@@ -12,3 +12,55 @@ def test_copr():
         f.write(repos)
     # assert by checking if repos.json exists
     assert os.path.isfile('repos.json')
+
+
+@pytest.fixture
+def createrepo(monkeypatch):
+    # stands in for createrepo: records the commands and creates repodata/
+    from libcappy import repository
+    ran = []
+
+    def run(cmd, **kwargs):
+        ran.append(cmd)
+        os.makedirs(os.path.join(cmd[-1], 'repodata'), exist_ok=True)
+        return subprocess.CompletedProcess(cmd, 0)
+    monkeypatch.setattr(repository.subprocess, 'run', run)
+    return ran
+
+
+def test_repo_from_cache_incremental(tmp_path, createrepo):
+    from libcappy.repository import repo_from_cache
+    cache = tmp_path / 'cache'
+    out = tmp_path / 'repo'
+    (cache / 'fedora/packages').mkdir(parents=True)
+    (cache / 'fedora/repodata').mkdir()
+    (cache / 'fedora/repodata/comps.xml').write_text('<comps><group><id>core</id></group></comps>')
+    for name in 'ab':
+        (cache / f'fedora/packages/{name}.rpm').write_bytes(name.encode())
+    assert repo_from_cache(str(cache), str(out)) == 2
+    assert createrepo[-1][-3:] == ['--groupfile', str(out / 'comps.xml'), str(out)]
+    assert sorted(os.listdir(out / 'packages')) == ['a.rpm', 'b.rpm']
+    assert (out / 'comps.xml').exists()
+    # nothing changed: createrepo is not run again
+    assert repo_from_cache(str(cache), str(out)) == 0
+    assert len(createrepo) == 1
+    # touched: hashed, but the content is the same, so nothing is rewritten
+    os.utime(cache / 'fedora/packages/a.rpm', (0, 0))
+    assert repo_from_cache(str(cache), str(out)) == 0
+    assert len(createrepo) == 1
+    with open(out / '.cappy-manifest.json') as f:
+        assert json.load(f)['a.rpm']['mtime'] == 0
+    # added, changed and removed packages are updated, with the comps carried over
+    (cache / 'fedora/packages/c.rpm').write_bytes(b'c')
+    (cache / 'fedora/packages/b.rpm').write_bytes(b'bb')
+    (cache / 'fedora/packages/a.rpm').unlink()
+    assert repo_from_cache(str(cache), str(out)) == 2
+    assert '--update' in createrepo[-1] and '--groupfile' in createrepo[-1]
+    assert sorted(os.listdir(out / 'packages')) == ['b.rpm', 'c.rpm']
+    assert (out / 'packages/b.rpm').read_bytes() == b'bb'
+    with open(out / '.cappy-manifest.json') as f:
+        assert sorted(json.load(f)) == ['b.rpm', 'c.rpm']
+    # only the groups changed
+    (cache / 'fedora/repodata/comps.xml').write_text('<comps><group><id>editors</id></group></comps>')
+    assert repo_from_cache(str(cache), str(out)) == 0
+    assert len(createrepo) == 3
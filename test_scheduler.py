@@ -0,0 +1,56 @@
+import threading
+import time
+import pytest
+from libcappy.scheduler import Scheduler
+
+
+def test_scheduler():
+    both = threading.Barrier(2, timeout=5)
+    order = []
+    sched = Scheduler()
+    sched.add('mount', lambda: order.append('mount'))
+    sched.add('root', lambda: time.sleep(0.05) or 'ok', ['mount'])
+    # these two only finish if they run at the same time
+    sched.add('fstab', both.wait, ['root'])
+    sched.add('firstboot', lambda: (both.wait(), time.sleep(0.1)), ['root'])
+    sched.add('post', lambda: order.append('post'), ['fstab', 'firstboot'])
+    results = sched.run()
+    assert results['root'] == 'ok' and order == ['mount', 'post']
+    path, total = sched.critical_path()
+    assert path == ['mount', 'root', 'firstboot', 'post']
+    assert total >= 0.15
+    assert 'critical path' in sched.report()
+
+
+def test_scheduler_errors():
+    sched = Scheduler()
+    sched.add('a', lambda: None, ['b'])
+    sched.add('b', lambda: None, ['a'])
+    with pytest.raises(ValueError, match='cycle'):
+        sched.run()
+    ran = []
+    sched = Scheduler()
+    sched.add('fail', lambda: 1 / 0)
+    sched.add('after', lambda: ran.append(1), ['fail'])
+    with pytest.raises(ZeroDivisionError):
+        sched.run()
+    assert not ran
+
+
+def test_install_plan_stops_on_failed_depsolve(tmp_path, monkeypatch):
+    from contextlib import ExitStack
+    from libcappy.install import plan
+    from libcappy.installer import Installer
+    installer = Installer({'installroot': str(tmp_path), 'bootloader': 'grub', 'packages': ['@core'],
+                           'dnf_options': {}, 'volumes': []}, packages=object())
+    ran = []
+    for name in ('provision', 'mount', 'fstab', 'systemd_firstboot', 'grubTemplate', 'grubConfigure', 'postInstall'):
+        monkeypatch.setattr(installer, name, lambda *args, name=name: ran.append(name))
+    monkeypatch.setattr(installer, 'resolve', lambda: None)
+    with ExitStack() as stack:
+        sched = plan(installer, stack)
+        with pytest.raises(RuntimeError, match='Could not resolve'):
+            sched.run()
+    # nothing runs against the empty root
+    assert ran == ['provision', 'mount']
+    assert 'instRoot' not in sched.results
@@ -0,0 +1,34 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+HEAVY = ['dnf', 'hawkey', 'rpm', 'libcomps', 'requests', 'aiohttp', 'yaml', 'sqlite3']
+
+
+def python(*args):
+    return subprocess.run([sys.executable, *args], capture_output=True, text=True, cwd=os.path.dirname(__file__) or '.')
+
+
+def imported(module):
+    out = python('-c', f'import sys, {module}; print(" ".join(sorted(sys.modules)))')
+    assert out.returncode == 0, out.stderr
+    return set(out.stdout.split())
+
+
+def test_entry_point_imports_nothing_heavy():
+    # how long the import takes is up to benchmarks.startup
+    assert not set(HEAVY) & imported('libcappy.__main__')
+
+
+def test_installer_does_not_import_dnf():
+    # without dnf installed it could not be imported anyway
+    pytest.importorskip('dnf')
+    assert not {'dnf', 'hawkey', 'rpm'} & imported('libcappy.installer')
+
+
+def test_help():
+    out = python('-m', 'libcappy', '--help')
+    assert out.returncode == 0
+    assert '--skip-wizard' in out.stdout
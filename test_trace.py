@@ -0,0 +1,26 @@
+import json
+from libcappy import trace
+
+
+def test_trace(tmp_path):
+    trace.clear()
+    seen = []
+    unsubscribe = trace.subscribe(seen.append)
+    with trace.span('download', packages=2) as attrs:
+        attrs['bytes'] = 1024
+    unsubscribe()
+    # already gone
+    unsubscribe()
+    with trace.span('rpm transaction'):
+        sum(range(10000))
+    assert [s.name for s in seen] == ['download']
+    assert seen[0].attrs == {'packages': 2, 'bytes': 1024}
+    assert [s.name for s in trace.spans()] == ['download', 'rpm transaction']
+    assert all(s.seconds >= 0 and s.rss > 0 for s in trace.spans())
+
+    trace.export(str(tmp_path / 'trace.json'))
+    events = json.loads((tmp_path / 'trace.json').read_text())['traceEvents']
+    assert events[0]['ph'] == 'X' and events[0]['args']['bytes'] == 1024
+    trace.export(str(tmp_path / 'trace.jsonl'))
+    lines = (tmp_path / 'trace.jsonl').read_text().splitlines()
+    assert [json.loads(l)['name'] for l in lines] == ['download', 'rpm transaction']
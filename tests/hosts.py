@@ -0,0 +1,38 @@
+# lsblk JSON of synthetic hosts, for the block device tests and benchmarks.
+
+from libcappy.blockdev import LSBLK_COLUMNS
+
+
+def device(name, type, size, pkname=None, **fields):
+    """An lsblk record with every column of LSBLK_COLUMNS, the ones not given empty."""
+    d = {c.lower(): None for c in LSBLK_COLUMNS}
+    d.update(name=name, kname=name, path=f'/dev/{name}', pkname=pkname, type=type, size=size,
+             mountpoints=[None], rm=False, ro=False)
+    d.update(fields)
+    return d
+
+
+def large_host(luns: int, paths: int = 4) -> dict:
+    """lsblk JSON of a host with a system disk and luns multipath LUNs seen through paths paths each.
+
+    Every LUN is an LVM PV. Each volume group spans two LUNs, so its LVs have two parents and show
+    up under both in the tree, the way lsblk prints them.
+    """
+    root = device('nvme0n1', 'disk', 512 << 30, model='Samsung SSD 980 PRO', children=[
+        device('nvme0n1p1', 'part', 600 << 20, 'nvme0n1', fstype='vfat', fsver='FAT32', uuid='6A1B-2C3D', mountpoints=['/boot/efi']),
+        device('nvme0n1p2', 'part', 1 << 30, 'nvme0n1', fstype='ext4', fsver='1.0', uuid='b00b0000-0000-4000-8000-000000000001', mountpoints=['/boot']),
+        device('nvme0n1p3', 'part', 510 << 30, 'nvme0n1', fstype='btrfs', uuid='b00b0000-0000-4000-8000-000000000002',
+             fsavail=300 << 30, **{'fsuse%': '41%'}, mountpoints=['/home', '/']),
+    ])
+    devices = [root]
+    for lun in range(luns):
+        vg = lun // 2
+        lvs = [device(f'vg{vg}-lv{n}', 'lvm', 256 << 30, f'mpath{lun}', fstype='xfs',
+                    uuid=f'1a000000-0000-4000-8000-{vg:08x}{n:04x}', mountpoints=[f'/srv/vg{vg}/lv{n}'],
+                    fsavail=100 << 30, **{'fsuse%': '60%'}) for n in range(2)]
+        mpath = device(f'mpath{lun}', 'mpath', 1 << 40, fstype='LVM2_member', fsver='LVM2 001',
+                     uuid=f'pv{lun:06d}-0000-0000-0000-0000-0000-000000', children=lvs)
+        for p in range(paths):
+            sd = f'sd{lun * paths + p}'
+            devices.append(device(sd, 'disk', 1 << 40, model='LUN', children=[dict(mpath, pkname=sd)]))
+    return {'blockdevices': devices}
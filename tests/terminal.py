@@ -0,0 +1,122 @@
+# Drives the libcappy TUI list on a pseudo terminal, for the list tests and benchmarks.
+#
+# Runs a ScrollList in a child process on a pty, sends it keys and times each
+# one from the write until the terminal output settles, counting the bytes
+# written per key.
+
+import fcntl
+import os
+import pty
+import select
+import signal
+import struct
+import subprocess
+import termios
+import time
+
+TERM = 'xterm-256color'
+# terminfo capabilities of the keys pressed; curses turns keypad transmit mode on, so
+# the arrows have to be sent the way the terminal sends them in that mode
+KEYS = {'down': 'kcud1', 'up': 'kcuu1', 'toggle': ' ', 'right': 'kcuf1', 'pagedown': 'knp'}
+# typed into the list filter after the keys above, every character is one press
+FILTER = 'number 12'
+# the serial console link the byte counts are converted with, 8N1
+BAUD = 115200
+
+
+def _child(rows: int, stream: bool):
+    os.environ['TERM'] = TERM
+    os.environ['ESCDELAY'] = '10'
+    # the size comes from the pty; readline (pytest loads it) exports LINES and COLUMNS
+    # behind os.environ's back
+    os.unsetenv('LINES')
+    os.unsetenv('COLUMNS')
+    import curses
+
+    from libcappy.listmodel import TableModel
+    from libcappy.ui import Box, Interface, ScrollList
+    gen = ({'*': '', 'Locale': f'xx_{i:05d}.UTF-8', 'Name': f'Synthetic locale number {i}'} for i in range(rows))
+    ds = TableModel(gen) if stream else list(gen)
+
+    def keyhdl(k: str, sel: int):
+        if k == ' ':
+            ds[sel]['*'] = '' if ds[sel]['*'] else '*'
+
+    def main(w):
+        ui = Interface(w)
+        ui.draw('Benchmark', 'ScrollList keypress latency')
+        box = Box(ui, 30, 40, 3, 2)
+        ScrollList(box).hdl(lambda: ds, keyhdl)
+    curses.wrapper(main)
+
+
+def _keys() -> dict[str, bytes]:
+    # not curses.setupterm(): the child would inherit its terminal state and size
+    return {name: cap.encode() if cap == ' ' else subprocess.run(['tput', '-T', TERM, cap], capture_output=True, check=True).stdout
+            for name, cap in KEYS.items()}
+
+
+def _settle(fd: int, quiet: float) -> tuple[int, float]:
+    """Reads until the terminal is quiet for `quiet` seconds. Returns the bytes read and when the last one came."""
+    total = 0
+    last = time.perf_counter()
+    while select.select([fd], [], [], quiet)[0]:
+        try:
+            data = os.read(fd, 1 << 16)
+        except OSError:
+            data = b''
+        if not data:
+            raise RuntimeError('The list exited')
+        total += len(data)
+        last = time.perf_counter()
+    return total, last
+
+
+def _press(fd: int, keys: list[bytes], quiet: float) -> dict[str, float]:
+    latencies, sizes = [], []
+    for key in keys:
+        sent = time.perf_counter()
+        os.write(fd, key)
+        size, last = _settle(fd, quiet)
+        latencies.append((last - sent) * 1000)
+        sizes.append(size)
+    latencies.sort()
+    mean_bytes = sum(sizes) / len(sizes)
+    return {
+        'latency_ms': round(latencies[len(latencies) // 2], 3),
+        'bytes': round(mean_bytes, 1),
+        'serial_ms': round(mean_bytes * 10 / BAUD * 1000, 2),
+    }
+
+
+def measure(rows: int, presses: int = 100, quiet: float = 0.05, stream: bool = False) -> tuple[dict[str, dict[str, float]], int]:
+    """Per key kind and for typing into the filter: the median latency in ms and the mean bytes written per press.
+
+    Also returns the peak RSS of the list's process in KiB. With stream, the list is fed by a generator.
+    """
+    keys = _keys()
+    pid, fd = pty.fork()
+    if pid == 0:
+        try:
+            # wait for the parent to size the terminal before curses reads it
+            os.read(0, 1)
+            _child(rows, stream)
+        finally:
+            os._exit(0)
+    try:
+        fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('HHHH', 40, 100, 0, 0))
+        os.write(fd, b'\n')
+        _settle(fd, 0.5)
+        results = {name: _press(fd, [key] * presses, quiet) for name, key in keys.items()}
+        # starting the filter indexes every row, and loads them all from a stream first
+        os.write(fd, b'/')
+        _settle(fd, 1.0)
+        results['filter'] = _press(fd, [c.encode() for c in FILTER], quiet)
+    finally:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        usage = os.wait4(pid, 0)[2]
+        os.close(fd)
+    return results, usage.ru_maxrss